@@ -165,6 +165,24 @@ BROKER_URL = env.str("BROKER_URL", "redis://localhost:6379/0")
 CELERY_DEFAULT_QUEUE = "rp_sidekick"
 CELERY_QUEUES = (
     Queue("rp_sidekick", Exchange("rp_sidekick"), routing_key="rp_sidekick"),
+    # Latency critical: inbound messages and statuses on their way to RapidPro
+    Queue(
+        "rp_sidekick_interceptors",
+        Exchange("rp_sidekick_interceptors"),
+        routing_key="rp_sidekick_interceptors",
+    ),
+    # Airtime and data purchases, which can be slow and bursty
+    Queue(
+        "rp_sidekick_payments",
+        Exchange("rp_sidekick_payments"),
+        routing_key="rp_sidekick_payments",
+    ),
+    # Periodic monitoring tasks that can tolerate delays
+    Queue(
+        "rp_sidekick_low_priority",
+        Exchange("rp_sidekick_low_priority"),
+        routing_key="rp_sidekick_low_priority",
+    ),
 )
 
 CELERY_ALWAYS_EAGER = False
@@ -173,7 +191,28 @@ CELERY_ALWAYS_EAGER = False
 CELERY_IMPORTS = ("rp_transferto.tasks",)
 
 CELERY_CREATE_MISSING_QUEUES = True
-CELERY_ROUTES = {"celery.backend_cleanup": {"queue": "mediumpriority"}}
+CELERY_ROUTES = {
+    "celery.backend_cleanup": {"queue": "mediumpriority"},
+    "rp_interceptors.tasks.*": {"queue": "rp_sidekick_interceptors"},
+    "rp_transferto.tasks.*": {"queue": "rp_sidekick_payments"},
+    "rp_dtone.tasks.*": {"queue": "rp_sidekick_payments"},
+    "sidekick.tasks.check_rapidpro_group_membership_count": {
+        "queue": "rp_sidekick_low_priority"
+    },
+    "sidekick.tasks.raise_group_membership_error": {
+        "queue": "rp_sidekick_low_priority"
+    },
+    "rp_transferto.tasks.prune_msisdn_information": {
+        "queue": "rp_sidekick_low_priority"
+    },
+    "rp_transferto.tasks.learn_transferto_operator_prefixes": {
+        "queue": "rp_sidekick_low_priority"
+    },
+    "rp_dtone.tasks.learn_dtone_operator_prefixes": {
+        "queue": "rp_sidekick_low_priority"
+    },
+    "rp_transferto.tasks.send_failure_digests": {"queue": "rp_sidekick_low_priority"},
+}
 
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
@@ -183,17 +222,125 @@ CELERYBEAT_SCHEDULE = {
     "check-rapidpro-group-membership-count": {
         "task": "sidekick.tasks.check_rapidpro_group_membership_count",
         "schedule": crontab(minute="*/5"),
-    }
+    },
+    "drain-interceptor-backlogs": {
+        "task": "rp_interceptors.tasks.drain_backlogs",
+        "schedule": crontab(minute="*"),
+    },
+    "prune-msisdn-information": {
+        "task": "rp_transferto.tasks.prune_msisdn_information",
+        "schedule": crontab(minute="0", hour="2"),
+    },
+    "learn-transferto-operator-prefixes": {
+        "task": "rp_transferto.tasks.learn_transferto_operator_prefixes",
+        "schedule": crontab(minute="0", hour="3"),
+    },
+    "learn-dtone-operator-prefixes": {
+        "task": "rp_dtone.tasks.learn_dtone_operator_prefixes",
+        "schedule": crontab(minute="30", hour="3"),
+    },
+    "send-transferto-failure-digests": {
+        "task": "rp_transferto.tasks.send_failure_digests",
+        "schedule": crontab(minute="*/15"),
+    },
+    "reconcile-dtone-transactions": {
+        "task": "rp_dtone.tasks.reconcile_dtone_transactions",
+        "schedule": crontab(minute="*/5"),
+    },
 }
 
+# Connection pooling, retries and timeouts for the airtime provider clients. The
+# read timeouts for topups are longer, since they shouldn't be abandoned midway
+HTTP_CLIENT_POOL_SIZE = env.int("HTTP_CLIENT_POOL_SIZE", 10)
+HTTP_CLIENT_RETRIES = env.int("HTTP_CLIENT_RETRIES", 3)
+HTTP_CLIENT_CONNECT_TIMEOUT = env.float("HTTP_CLIENT_CONNECT_TIMEOUT", 5)
+TRANSFERTO_TIMEOUT = env.float("TRANSFERTO_TIMEOUT", 30)
+TRANSFERTO_TOPUP_TIMEOUT = env.float("TRANSFERTO_TOPUP_TIMEOUT", 120)
+DTONE_TIMEOUT = env.float("DTONE_TIMEOUT", 30)
+DTONE_TRANSACTION_TIMEOUT = env.float("DTONE_TRANSACTION_TIMEOUT", 60)
+
+# The fraction of payment task calls that log the full provider API payloads
+PAYMENT_LOG_PAYLOAD_SAMPLE_RATE = env.float("PAYMENT_LOG_PAYLOAD_SAMPLE_RATE", 1.0)
+
 TRANSFERTO_LOGIN = env.str("TRANSFERTO_LOGIN", "")
 TRANSFERTO_TOKEN = env.str("TRANSFERTO_TOKEN", "")
 TRANSFERTO_APIKEY = env.str("TRANSFERTO_APIKEY", "")
 TRANSFERTO_APISECRET = env.str("TRANSFERTO_APISECRET", "")
+# How long TransferTo catalogue data is cached for before being refreshed. Prices
+# change more often than the countries, operators and services that are offered.
+TRANSFERTO_PRICELIST_TTL = env.int("TRANSFERTO_PRICELIST_TTL", 60 * 60)
+TRANSFERTO_COVERAGE_TTL = env.int("TRANSFERTO_COVERAGE_TTL", 24 * 60 * 60)
+# MSISDN operator lookups older than this are refreshed in the background
+TRANSFERTO_MSISDN_INFO_TTL = env.int("TRANSFERTO_MSISDN_INFO_TTL", 30 * 24 * 60 * 60)
+# Limits for the bulk MSISDN lookup endpoint, and how many lookups it makes to
+# TransferTo at once
+TRANSFERTO_BULK_LOOKUP_MAX = env.int("TRANSFERTO_BULK_LOOKUP_MAX", 50000)
+TRANSFERTO_BULK_LOOKUP_WORKERS = env.int("TRANSFERTO_BULK_LOOKUP_WORKERS", 10)
+# Bulk lookups with more uncached MSISDNs than this are done in the background, so
+# that the request isn't held open for long
+TRANSFERTO_BULK_LOOKUP_SYNC_MAX = env.int("TRANSFERTO_BULK_LOOKUP_SYNC_MAX", 20)
+# Topup batches are sent with this many concurrent requests, starting at most this
+# many topups a second, to stay within TransferTo's rate limits
+TRANSFERTO_BATCH_MAX = env.int("TRANSFERTO_BATCH_MAX", 100000)
+TRANSFERTO_BATCH_WORKERS = env.int("TRANSFERTO_BATCH_WORKERS", 5)
+TRANSFERTO_BATCH_RATE = env.float("TRANSFERTO_BATCH_RATE", 10)
+# How long a product that wasn't available for an operator is skipped as a fallback
+TRANSFERTO_PRODUCT_UNAVAILABLE_TTL = env.int(
+    "TRANSFERTO_PRODUCT_UNAVAILABLE_TTL", 60 * 60
+)
+# Topup failures are emailed to orgs in a digest every 15 minutes, with at most
+# this many failures described in full
+TRANSFERTO_FAILURE_DIGEST_MAX_EVENTS = env.int(
+    "TRANSFERTO_FAILURE_DIGEST_MAX_EVENTS", 100
+)
+# DT One transaction batches are submitted with this many concurrent requests
+DTONE_BATCH_MAX = env.int("DTONE_BATCH_MAX", 100000)
+DTONE_BATCH_WORKERS = env.int("DTONE_BATCH_WORKERS", 10)
+# How long each operator's DT One product index is cached before being refreshed
+DTONE_PRODUCT_INDEX_TTL = env.int("DTONE_PRODUCT_INDEX_TTL", 60 * 60)
+# How long after being accepted DT One transactions are checked for delivery
+DTONE_RECONCILE_MAX_AGE = env.int("DTONE_RECONCILE_MAX_AGE", 7 * 24 * 60 * 60)
+
+# Operators are resolved from learned MSISDN prefixes where at least this share of at
+# least this many past lookups for the prefix were for the same operator
+OPERATOR_PREFIX_MIN_OBSERVATIONS = env.int("OPERATOR_PREFIX_MIN_OBSERVATIONS", 20)
+OPERATOR_PREFIX_MIN_SHARE = env.float("OPERATOR_PREFIX_MIN_SHARE", 0.99)
+# The share of prefix resolutions that are also looked up remotely to measure accuracy
+OPERATOR_PREFIX_VERIFY_RATE = env.float("OPERATOR_PREFIX_VERIFY_RATE", 0.01)
+OPERATOR_PREFIX_CACHE_TTL = env.int("OPERATOR_PREFIX_CACHE_TTL", 300)
+
+# Status updates from Turn are coalesced per interceptor for this many seconds before
+# being forwarded to RapidPro. 0 disables batching.
+INTERCEPTOR_BATCH_WINDOW = env.float("INTERCEPTOR_BATCH_WINDOW", 0)
+INTERCEPTOR_BATCH_MAX_COUNT = env.int("INTERCEPTOR_BATCH_MAX_COUNT", 100)
+INTERCEPTOR_BATCH_MAX_BYTES = env.int("INTERCEPTOR_BATCH_MAX_BYTES", 256 * 1024)
+# How long to remember that a Turn message or status was delivered to RapidPro, so
+# that redeliveries are dropped. 0, the default, disables deduplication.
+INTERCEPTOR_DEDUP_TTL = env.int("INTERCEPTOR_DEDUP_TTL", 0)
+# Forwarding to a RapidPro host stops for the cooldown period after this many
+# consecutive failures, and requests are parked until it recovers
+INTERCEPTOR_BREAKER_THRESHOLD = env.int("INTERCEPTOR_BREAKER_THRESHOLD", 5)
+INTERCEPTOR_BREAKER_COOLDOWN = env.int("INTERCEPTOR_BREAKER_COOLDOWN", 60)
+# Parked requests sent per second once the host recovers
+INTERCEPTOR_BACKLOG_DRAIN_RATE = env.int("INTERCEPTOR_BACKLOG_DRAIN_RATE", 50)
+# Requests are spooled to the database instead of parked once they have been parked
+# this many times, or once the host's backlog holds this many requests
+INTERCEPTOR_BACKLOG_MAX_PARKS = env.int("INTERCEPTOR_BACKLOG_MAX_PARKS", 5)
+INTERCEPTOR_BACKLOG_MAX_SIZE = env.int("INTERCEPTOR_BACKLOG_MAX_SIZE", 10000)
+# How long an interceptor is cached in-process before being reloaded from the database
+INTERCEPTOR_CACHE_TTL = env.int("INTERCEPTOR_CACHE_TTL", 60)
 
 RAPIDPRO_URL = env.str("RAPIDPRO_URL", "")
 RAPIDPRO_TOKEN = env.str("RAPIDPRO_TOKEN", "")
 
+# How long a Consent is cached in-process before being reloaded from the database
+CONSENT_CACHE_TTL = env.int("CONSENT_CACHE_TTL", 300)
+# How long browsers and link preview crawlers may cache consent pages for
+CONSENT_PAGE_MAX_AGE = env.int("CONSENT_PAGE_MAX_AGE", 60 * 60)
+# Repeated consent clicks by a contact within this many seconds don't start the flow
+# again. 0, the default, disables deduplication
+CONSENT_DEDUP_WINDOW = env.int("CONSENT_DEDUP_WINDOW", 0)
+
 ASOS_ADMIN_GROUP_ID = env.str("ASOS_ADMIN_GROUP_ID", "27825487140-1557840182")
 
 EMAIL_HOST = env.str("EMAIL_HOST", "localhost")
@@ -1,3 +1,10 @@
-# from django.contrib import admin
+from django.contrib import admin
 
-# Register your models here.
+from .models import OperatorPrefix
+
+
+@admin.register(OperatorPrefix)
+class OperatorPrefixAdmin(admin.ModelAdmin):
+    list_display = ("provider", "prefix", "operator_id", "observations", "source")
+    list_filter = ("provider", "source")
+    search_fields = ("prefix",)
@@ -0,0 +1,33 @@
+import csv
+
+from django.core.management.base import BaseCommand, CommandError
+
+from msisdn_utils.models import OperatorPrefix
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds operator prefixes from a numbering plan CSV file, with provider, "
+        "prefix and operator_id columns. An empty operator_id marks a prefix that is "
+        "split between operators. Seeded prefixes take precedence over learned ones."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", type=open)
+
+    def handle(self, *args, **options):
+        providers = OperatorPrefix.Provider.values
+        count = 0
+        for row in csv.DictReader(options["file"]):
+            if row["provider"] not in providers:
+                raise CommandError(f"Unknown provider {row['provider']}")
+            OperatorPrefix.objects.update_or_create(
+                provider=row["provider"],
+                prefix=row["prefix"].lstrip("+"),
+                defaults={
+                    "operator_id": row["operator_id"] or None,
+                    "source": OperatorPrefix.Source.SEEDED,
+                },
+            )
+            count += 1
+        self.stdout.write(f"Loaded {count} operator prefixes")
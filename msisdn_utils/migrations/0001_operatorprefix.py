@@ -0,0 +1,55 @@
+# Generated by Django 4.2.16 on 2026-10-19 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="OperatorPrefix",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "provider",
+                    models.CharField(
+                        choices=[("transferto", "TransferTo"), ("dtone", "DT One")],
+                        max_length=20,
+                    ),
+                ),
+                ("prefix", models.CharField(max_length=15)),
+                ("operator_id", models.IntegerField(null=True)),
+                ("observations", models.IntegerField(default=0)),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[
+                            ("learned", "Learned from past lookups"),
+                            ("seeded", "Seeded from a numbering plan"),
+                        ],
+                        default="learned",
+                        max_length=10,
+                    ),
+                ),
+                ("timestamp", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="operatorprefix",
+            constraint=models.UniqueConstraint(
+                fields=("provider", "prefix"), name="unique_provider_prefix"
+            ),
+        ),
+    ]
@@ -1,3 +1,39 @@
-# from django.db import models
+from django.db import models
 
-# Create your models here.
+
+class OperatorPrefix(models.Model):
+    """
+    An MSISDN prefix whose numbers all belong to the same operator, so that the
+    operator can be resolved without a remote lookup. A null operator marks a prefix
+    whose numbers are split between operators, eg. because of porting, within a
+    prefix that otherwise belongs to a single operator.
+
+    Operator IDs are specific to each provider.
+    """
+
+    class Provider(models.TextChoices):
+        TRANSFERTO = "transferto", "TransferTo"
+        DTONE = "dtone", "DT One"
+
+    class Source(models.TextChoices):
+        LEARNED = "learned", "Learned from past lookups"
+        SEEDED = "seeded", "Seeded from a numbering plan"
+
+    provider = models.CharField(max_length=20, choices=Provider.choices)
+    prefix = models.CharField(max_length=15)
+    operator_id = models.IntegerField(null=True)
+    observations = models.IntegerField(default=0)
+    source = models.CharField(
+        max_length=10, choices=Source.choices, default=Source.LEARNED
+    )
+    timestamp = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.provider} {self.prefix}: {self.operator_id}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["provider", "prefix"], name="unique_provider_prefix"
+            )
+        ]
@@ -1,11 +1,21 @@
 import json
 from datetime import datetime
-from unittest.mock import patch
+from io import StringIO
+from tempfile import NamedTemporaryFile
+from unittest.mock import Mock, patch
 
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient, APITestCase
 
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import _prefix_tables, learn_operator_prefixes, resolve_operator
+
+TRANSFERTO = OperatorPrefix.Provider.TRANSFERTO
+
 
 class GetMsisdnTimezonesTest(APITestCase):
     def setUp(self):
@@ -161,3 +171,85 @@ class GetMsisdnTimezonesTest(APITestCase):
             response.data, {"success": True, "timezones": ["Australia/Adelaide"]}
         )
         self.assertEqual(response.status_code, 200)
+
+
+@override_settings(OPERATOR_PREFIX_MIN_OBSERVATIONS=3, OPERATOR_PREFIX_VERIFY_RATE=0)
+class OperatorPrefixTests(TestCase):
+    def setUp(self):
+        _prefix_tables.clear()
+
+    def tearDown(self):
+        _prefix_tables.clear()
+
+    def learn(self, observations):
+        learn_operator_prefixes(TRANSFERTO, observations)
+        return dict(
+            OperatorPrefix.objects.filter(provider=TRANSFERTO).values_list(
+                "prefix", "operator_id"
+            )
+        )
+
+    def test_learn_operator_prefixes(self):
+        """
+        Only the shortest unambiguous prefixes should be stored, with split prefixes
+        stored without an operator if a shorter prefix would resolve them
+        """
+        observations = [(f"+2782000{i:04d}", 1) for i in range(10)]
+        observations += [(f"2783100{i:04d}", 2) for i in range(400)]
+        observations += [(f"2783200{i:04d}", 3 if i % 2 else 2) for i in range(4)]
+        # Not enough observations to learn from
+        observations += [("27840000001", 4), ("27840000002", 4)]
+
+        self.assertEqual(
+            self.learn(observations),
+            {"2782": 1, "2783": 2, "27832": None},
+        )
+
+        # Learning again replaces the learned prefixes
+        self.assertEqual(self.learn(observations[:10]), {"2782": 1})
+
+    def test_seeded_prefixes_kept(self):
+        """
+        Seeded prefixes should be kept, with only longer prefixes learned that
+        disagree with them
+        """
+        with NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write("provider,prefix,operator_id\ntransferto,+2782,5\n")
+            f.flush()
+            call_command("load_operator_prefixes", f.name, stdout=StringIO())
+
+        observations = [(f"2782000{i:04d}", 5) for i in range(10)]
+        observations += [(f"2783000{i:04d}", 6) for i in range(10)]
+        self.assertEqual(self.learn(observations), {"2782": 5, "2783": 6})
+        self.assertEqual(
+            OperatorPrefix.objects.get(prefix="2782").source,
+            OperatorPrefix.Source.SEEDED,
+        )
+
+    def test_resolve_operator(self):
+        """
+        Known prefixes should be resolved locally, and unknown or split prefixes
+        looked up
+        """
+        self.learn(
+            [(f"2782000{i:04d}", 1) for i in range(10)]
+            + [(f"2782100{i:04d}", 2 if i % 2 else 1) for i in range(4)]
+        )
+        lookup = Mock(return_value=7)
+
+        self.assertEqual(resolve_operator(TRANSFERTO, "+27820001234", lookup), 1)
+        lookup.assert_not_called()
+
+        self.assertEqual(resolve_operator(TRANSFERTO, "+27821001234", lookup), 7)
+        self.assertEqual(resolve_operator(TRANSFERTO, "+27830001234", lookup), 7)
+        self.assertEqual(lookup.call_count, 2)
+
+    @override_settings(OPERATOR_PREFIX_VERIFY_RATE=1)
+    def test_resolve_operator_verified(self):
+        """
+        Sampled resolutions should be looked up, and the looked up operator used
+        """
+        self.learn([(f"2782000{i:04d}", 1) for i in range(10)])
+        lookup = Mock(return_value=2)
+        self.assertEqual(resolve_operator(TRANSFERTO, "+27820001234", lookup), 2)
+        lookup.assert_called_once_with("+27820001234")
@@ -0,0 +1,141 @@
+import random
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from prometheus_client import Counter as MetricCounter
+
+from .models import OperatorPrefix
+
+# The prefix lengths, in digits including the country code, that are learned
+PREFIX_LENGTHS = range(4, 9)
+
+operator_prefix_lookups = MetricCounter(
+    "operator_prefix_lookups",
+    "Operator lookups by whether they were resolved from the prefix table",
+    ["provider", "result"],
+)
+operator_prefix_verifications = MetricCounter(
+    "operator_prefix_verifications",
+    "Sampled prefix table resolutions, by whether they matched the remote lookup",
+    ["provider", "result"],
+)
+
+# provider -> (monotonic expiry, {prefix: operator id})
+_prefix_tables = {}
+
+
+def get_prefix_table(provider):
+    expiry, table = _prefix_tables.get(provider, (0, None))
+    if expiry < time.monotonic():
+        table = dict(
+            OperatorPrefix.objects.filter(provider=provider).values_list(
+                "prefix", "operator_id"
+            )
+        )
+        expiry = time.monotonic() + settings.OPERATOR_PREFIX_CACHE_TTL
+        _prefix_tables[provider] = (expiry, table)
+    return table
+
+
+def get_prefix_operator(provider, msisdn):
+    """
+    Returns the operator ID for the longest matching prefix of the MSISDN, or None
+    if there is no matching prefix, or it is split between operators
+    """
+    msisdn = msisdn.lstrip("+")
+    table = get_prefix_table(provider)
+    for length in reversed(PREFIX_LENGTHS):
+        if len(msisdn) > length and msisdn[:length] in table:
+            return table[msisdn[:length]]
+
+
+def resolve_operator(provider, msisdn, lookup):
+    """
+    Returns the operator ID for the MSISDN from the prefix table, falling back to
+    lookup(msisdn) for unknown and split prefixes. OPERATOR_PREFIX_VERIFY_RATE of
+    the prefix table resolutions are also looked up, to measure their accuracy.
+    """
+    operator_id = get_prefix_operator(provider, msisdn)
+    if operator_id is None:
+        operator_prefix_lookups.labels(provider=provider, result="miss").inc()
+        return lookup(msisdn)
+
+    operator_prefix_lookups.labels(provider=provider, result="hit").inc()
+    return verify_operator(provider, msisdn, operator_id, lookup)
+
+
+def verify_operator(provider, msisdn, operator_id, lookup):
+    """
+    Looks up OPERATOR_PREFIX_VERIFY_RATE of the operators resolved from the prefix
+    table, returning the looked up operator if there is one
+    """
+    if random.random() < settings.OPERATOR_PREFIX_VERIFY_RATE:
+        actual = lookup(msisdn)
+        operator_prefix_verifications.labels(
+            provider=provider, result="match" if actual == operator_id else "mismatch"
+        ).inc()
+        if actual is not None:
+            return actual
+    return operator_id
+
+
+def learn_operator_prefixes(provider, observations):
+    """
+    Rebuilds the learned prefixes for the provider from (msisdn, operator id)
+    observations of past lookups.
+
+    A prefix is stored if at least OPERATOR_PREFIX_MIN_SHARE of at least
+    OPERATOR_PREFIX_MIN_OBSERVATIONS observations are for the same operator, and a
+    shorter prefix doesn't already resolve to that operator. Prefixes that are split
+    between operators are stored with no operator if a shorter prefix would
+    otherwise resolve them. Seeded prefixes are kept as they are.
+    """
+    counts = defaultdict(Counter)
+    for msisdn, operator_id in observations:
+        msisdn = msisdn.lstrip("+")
+        for length in PREFIX_LENGTHS:
+            if len(msisdn) > length:
+                counts[msisdn[:length]][operator_id] += 1
+
+    seeded = dict(
+        OperatorPrefix.objects.filter(
+            provider=provider, source=OperatorPrefix.Source.SEEDED
+        ).values_list("prefix", "operator_id")
+    )
+    # prefix -> the operator that it resolves to, whether stored or inherited
+    resolved = {}
+    prefixes = []
+    for prefix in sorted(counts, key=len):
+        inherited = resolved.get(prefix[:-1])
+        if prefix in seeded:
+            resolved[prefix] = seeded[prefix]
+            continue
+
+        total = sum(counts[prefix].values())
+        [(operator_id, count)] = counts[prefix].most_common(1)
+        if total < settings.OPERATOR_PREFIX_MIN_OBSERVATIONS:
+            resolved[prefix] = inherited
+            continue
+        if count / total < settings.OPERATOR_PREFIX_MIN_SHARE:
+            operator_id = None
+
+        resolved[prefix] = operator_id
+        if operator_id != inherited:
+            prefixes.append(
+                OperatorPrefix(
+                    provider=provider,
+                    prefix=prefix,
+                    operator_id=operator_id,
+                    observations=total,
+                )
+            )
+
+    with transaction.atomic():
+        OperatorPrefix.objects.filter(
+            provider=provider, source=OperatorPrefix.Source.LEARNED
+        ).delete()
+        OperatorPrefix.objects.bulk_create(prefixes, batch_size=1000)
+    _prefix_tables.pop(provider, None)
+    return len(prefixes)
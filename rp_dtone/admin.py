@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from .models import DtoneAccount, Transaction
+from .models import DtoneAccount, Transaction, TransactionBatch
 
 admin.site.register(DtoneAccount)
 admin.site.register(Transaction)
+admin.site.register(TransactionBatch)
@@ -1,11 +1,61 @@
+import json
+import time
 from urllib.parse import urljoin
 
+import redis
 import requests
+from django.conf import settings
+
+from sidekick.utils import get_http_session
+
+redis_conn = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+# key -> (fresh until, product index)
+_product_index_cache = {}
+
+
+def get_product_index_key(account_id, operator_id):
+    return f"dtone_product_index_{account_id}_{operator_id}"
+
+
+def get_product_index_entry(key):
+    """
+    Returns the cached (fresh until, product index) for the key, from the
+    in-process cache if it is still fresh there, otherwise from Redis
+    """
+    fresh_until, index = _product_index_cache.get(key, (0, None))
+    if fresh_until > time.time():
+        return fresh_until, index
+
+    entry = redis_conn.get(key)
+    if entry is None:
+        return None
+    entry = json.loads(entry)
+    _product_index_cache[key] = (entry["fresh_until"], entry["index"])
+    return entry["fresh_until"], entry["index"]
+
+
+def get_product_key(amount, subservice):
+    """
+    The key for a product in the product index, so that eg. amounts of 10 and 10.0
+    match
+    """
+    amount = float(amount)
+    if amount.is_integer():
+        amount = int(amount)
+    return f"{amount}:{subservice}"
 
 
 class DtoneClient:
-    def __init__(self, apikey, apisecret, production):
+    def __init__(self, apikey, apisecret, production, account_id=None, session=None):
         self.auth = requests.auth.HTTPBasicAuth(apikey, apisecret)
+        self.account_id = account_id
+        self.session = session or get_http_session("dtone")
+        self.timeout = (settings.HTTP_CLIENT_CONNECT_TIMEOUT, settings.DTONE_TIMEOUT)
+        self.transaction_timeout = (
+            settings.HTTP_CLIENT_CONNECT_TIMEOUT,
+            settings.DTONE_TRANSACTION_TIMEOUT,
+        )
 
         if production:
             self.base_url = "https://dvs-api.dtone.com"
@@ -13,29 +63,89 @@ class DtoneClient:
             self.base_url = "https://preprod-dvs-api.dtone.com"
 
     def get_operator_id(self, msisdn):
-        response = requests.get(
+        response = self.session.get(
             urljoin(self.base_url, f"/v1/lookup/mobile-number/{msisdn}"),
             auth=self.auth,
+            timeout=self.timeout,
         )
         response.raise_for_status()
         if len(response.json()) > 0:
             return response.json()[0]["id"]
 
-    def get_fixed_value_product(self, operator_id, value):
-        response = requests.get(
-            urljoin(
-                self.base_url,
-                f"/v1/products?type=FIXED_VALUE_RECHARGE&operator_id={operator_id}&per_page=100",
-            ),
-            auth=self.auth,
-        )
-        response.raise_for_status()
+    def get_products(self, operator_id):
+        """
+        Returns all of the operator's fixed value recharge products, from every page
+        """
+        products = []
+        page = 1
+        while page:
+            response = self.session.get(
+                urljoin(
+                    self.base_url,
+                    f"/v1/products?type=FIXED_VALUE_RECHARGE&operator_id={operator_id}"
+                    f"&per_page=100&page={page}",
+                ),
+                auth=self.auth,
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            products.extend(response.json())
+            page = response.headers.get("X-Next-Page")
+        return products
+
+    def refresh_product_index(self, operator_id):
+        """
+        Fetches the operator's products and returns an index of the product ID for
+        each destination amount and subservice. If more than one product has the
+        same amount and subservice, the first one listed is used.
+
+        The index is cached if this client is for a DtoneAccount.
+        """
+        index = {}
+        for product in self.get_products(operator_id):
+            subservice = product.get("service", {}).get("subservice", {}).get("name")
+            key = get_product_key(product["destination"]["amount"], subservice)
+            index.setdefault(key, product["id"])
+
+        if self.account_id is not None:
+            key = get_product_index_key(self.account_id, operator_id)
+            ttl = settings.DTONE_PRODUCT_INDEX_TTL
+            fresh_until = time.time() + ttl
+            # Stale indexes are kept for another TTL, to be used while refreshing
+            redis_conn.set(
+                key,
+                json.dumps({"fresh_until": fresh_until, "index": index}),
+                ex=ttl * 2,
+            )
+            _product_index_cache[key] = (fresh_until, index)
+            redis_conn.delete(f"{key}_refresh")
+        return index
+
+    def get_product_index(self, operator_id):
+        """
+        Returns the cached product index for the operator, fetching it if it isn't
+        cached, and refreshing it in the background once it is stale
+        """
+        if self.account_id is None:
+            return self.refresh_product_index(operator_id)
 
-        for product in response.json():
-            product_value = product["destination"]["amount"]
-            product_type = product.get("service", {}).get("subservice", {}).get("name")
-            if product_value == value and product_type == "Airtime":
-                return product["id"]
+        key = get_product_index_key(self.account_id, operator_id)
+        entry = get_product_index_entry(key)
+        if entry is None:
+            return self.refresh_product_index(operator_id)
+
+        fresh_until, index = entry
+        if fresh_until <= time.time() and redis_conn.set(
+            f"{key}_refresh", 1, nx=True, ex=60
+        ):
+            from .tasks import refresh_dtone_product_index
+
+            refresh_dtone_product_index.delay(self.account_id, operator_id)
+        return index
+
+    def get_fixed_value_product(self, operator_id, value):
+        index = self.get_product_index(operator_id)
+        return index.get(get_product_key(value, "Airtime"))
 
     def submit_transaction(self, transaction_uuid, msisdn, product_id):
         body = {
@@ -45,11 +155,36 @@ class DtoneClient:
             "credit_party_identifier": {"mobile_number": msisdn},
         }
 
-        return requests.post(
+        return self.session.post(
             urljoin(
                 self.base_url,
                 "/v1/async/transactions",
             ),
             auth=self.auth,
             json=body,
+            timeout=self.transaction_timeout,
         )
+
+    def get_transaction(self, dtone_id):
+        response = self.session.get(
+            urljoin(self.base_url, f"/v1/transactions/{dtone_id}"),
+            auth=self.auth,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def get_transaction_by_external_id(self, external_id):
+        """
+        Returns the transaction submitted with the external ID, or None if DT One
+        didn't receive it
+        """
+        response = self.session.get(
+            urljoin(self.base_url, "/v1/transactions"),
+            params={"external_id": str(external_id)},
+            auth=self.auth,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        transactions = response.json()
+        return transactions[0] if transactions else None
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.16 on 2026-10-19 17:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rp_dtone", "0003_transactionbatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="transaction",
+            name="delivery_status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("completed", "Completed"),
+                    ("failed", "Failed"),
+                ],
+                max_length=20,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="transaction",
+            name="dtone_id",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="transaction",
+            index=models.Index(
+                fields=["delivery_status", "timestamp"],
+                name="transaction_delivery_status",
+            ),
+        ),
+    ]
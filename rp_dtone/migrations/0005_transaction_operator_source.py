@@ -0,0 +1,22 @@
+# Generated by Django 4.2.16 on 2026-10-19 18:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rp_dtone", "0004_transaction_delivery_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="transaction",
+            name="operator_source",
+            field=models.CharField(
+                choices=[("lookup", "DT One lookup"), ("prefix", "Prefix table")],
+                max_length=20,
+                null=True,
+            ),
+        ),
+    ]
@@ -5,6 +5,7 @@ from django.db import models
 from django.utils import timezone
 
 from sidekick.models import Organization
+from sidekick.utils import get_http_session
 
 from .dtone_client import DtoneClient
 
@@ -22,12 +23,59 @@ class DtoneAccount(models.Model):
     )
 
     def get_dtone_client(self):
-        return DtoneClient(self.apikey, self.apisecret, self.production)
+        return DtoneClient(
+            self.apikey,
+            self.apisecret,
+            self.production,
+            account_id=self.id,
+            session=get_http_session("dtone", self.id),
+        )
 
     def __str__(self):
         return self.name
 
 
+class TransactionBatch(models.Model):
+    """
+    A batch of Transactions that are submitted together
+    """
+
+    class Status(models.TextChoices):
+        CREATED = "created", "Created"
+        RUNNING = "running", "Running"
+        DONE = "done", "Done"
+
+    status = models.CharField(
+        max_length=20, choices=Status.choices, default=Status.CREATED
+    )
+    org = models.ForeignKey(
+        Organization,
+        related_name="transaction_batches",
+        null=False,
+        on_delete=models.CASCADE,
+    )
+    timestamp = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def get_summary(self):
+        """
+        Returns the status of the batch, and the number of transactions in each
+        status
+        """
+        counts = dict(
+            self.transactions.values_list("status").annotate(count=models.Count("id"))
+        )
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": sum(counts.values()),
+            "transactions": counts,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
 class Transaction(models.Model):
     class Status(models.TextChoices):
         CREATED = "created", "Created"
@@ -36,10 +84,22 @@ class Transaction(models.Model):
         ERROR = "error", "Error"
         SUCCESS = "success", "Success"
 
+    class OperatorSource(models.TextChoices):
+        LOOKUP = "lookup", "DT One lookup"
+        PREFIX = "prefix", "Prefix table"
+
+    class DeliveryStatus(models.TextChoices):
+        PENDING = "pending", "Pending"
+        COMPLETED = "completed", "Completed"
+        FAILED = "failed", "Failed"
+
     uuid = models.UUIDField(default=uuid.uuid4, editable=False)
     msisdn = models.CharField(max_length=30, null=False, blank=False)
     value = models.IntegerField(null=False, blank=False)
     operator_id = models.IntegerField(null=True)
+    operator_source = models.CharField(
+        max_length=20, choices=OperatorSource.choices, null=True
+    )
     product_id = models.IntegerField(null=True)
     status = models.CharField(
         max_length=20, choices=Status.choices, default=Status.CREATED
@@ -52,20 +112,41 @@ class Transaction(models.Model):
         on_delete=models.CASCADE,
     )
     timestamp = models.DateTimeField(default=timezone.now)
+    batch = models.ForeignKey(
+        TransactionBatch,
+        related_name="transactions",
+        null=True,
+        on_delete=models.CASCADE,
+    )
+    # DT One's ID for the transaction, and whether the airtime was delivered, once
+    # it has been accepted
+    dtone_id = models.BigIntegerField(null=True)
+    delivery_status = models.CharField(
+        max_length=20, choices=DeliveryStatus.choices, null=True
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["delivery_status", "timestamp"],
+                name="transaction_delivery_status",
+            )
+        ]
 
     def __str__(self):
-        return json.dumps(
-            {
-                "id": self.id,
-                "uuid": str(self.uuid),
-                "msisdn": self.msisdn,
-                "value": self.value,
-                "operator_id": self.operator_id,
-                "product_id": self.product_id,
-                "status": self.status,
-                "response": self.response,
-                "org": self.org.name,
-                "timestamp": self.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-            },
-            indent=2,
-        )
+        return json.dumps(self.as_dict(), indent=2)
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "uuid": str(self.uuid),
+            "msisdn": self.msisdn,
+            "value": self.value,
+            "operator_id": self.operator_id,
+            "product_id": self.product_id,
+            "status": self.status,
+            "delivery_status": self.delivery_status,
+            "response": self.response,
+            "org": self.org.name,
+            "timestamp": self.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+        }
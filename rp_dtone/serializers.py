@@ -0,0 +1,10 @@
+from rest_framework import serializers
+
+
+class AirtimeRecipientSerializer(serializers.Serializer):
+    msisdn = serializers.CharField(max_length=30)
+    value = serializers.IntegerField(min_value=1)
+
+
+class TransactionBatchSerializer(serializers.Serializer):
+    recipients = AirtimeRecipientSerializer(many=True, allow_empty=False)
@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+
+from config.celery import app
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import learn_operator_prefixes
+from sidekick.utils import start_flow
+
+from .models import DtoneAccount, Transaction, TransactionBatch
+from .utils import reconcile_transactions, send_airtime_batch, submit_transaction
+
+
+@app.task(ignore_result=True)
+def learn_dtone_operator_prefixes():
+    """
+    Rebuilds the DT One operator prefix table from the operators of past
+    transactions. Only operators from DT One lookups are used, so that the table
+    isn't learned from its own guesses.
+    """
+    observations = (
+        Transaction.objects.filter(operator_source=Transaction.OperatorSource.LOOKUP)
+        .exclude(operator_id=None)
+        .values_list("msisdn", "operator_id")
+        .iterator()
+    )
+    learn_operator_prefixes(OperatorPrefix.Provider.DTONE, observations)
+
+
+@app.task(ignore_result=True)
+def process_transaction_batch(batch_id):
+    batch = TransactionBatch.objects.get(id=batch_id)
+    client = batch.org.dtone_account.first().get_dtone_client()
+    send_airtime_batch(batch, client)
+
+
+@app.task(ignore_result=True)
+def send_airtime_async(
+    transaction_id, user_uuid=None, flow_start=None, fail_flow_start=None
+):
+    """
+    Submits a transaction created by the async send view, and then starts the
+    RapidPro contact on the success or failure flow, if one is given. Errors
+    before the transaction is sent to DT One fail it, and other errors leave it
+    pending until it is reconciled.
+    """
+    transaction = Transaction.objects.select_related("org").get(id=transaction_id)
+    client = transaction.org.dtone_account.first().get_dtone_client()
+    try:
+        success, _ = submit_transaction(client, transaction)
+    except Exception as e:
+        transaction.response = {"error": str(e)}
+        if transaction.product_id is not None and not isinstance(
+            e, requests.exceptions.ConnectionError
+        ):
+            # DT One may have accepted the transaction before the error, such as a
+            # read timeout, so leave it for reconcile_dtone_transactions to find
+            transaction.delivery_status = Transaction.DeliveryStatus.PENDING
+            transaction.save()
+            return
+        transaction.status = Transaction.Status.ERROR
+        transaction.save()
+        success = False
+
+    flow_uuid = flow_start if success else fail_flow_start
+    if user_uuid and flow_uuid:
+        start_flow(org=transaction.org, user_uuid=user_uuid, flow_uuid=flow_uuid)
+
+
+@app.task(ignore_result=True)
+def refresh_dtone_product_index(account_id, operator_id):
+    account = DtoneAccount.objects.get(id=account_id)
+    account.get_dtone_client().refresh_product_index(operator_id)
+
+
+@app.task(ignore_result=True)
+def reconcile_dtone_transactions(batch_size=1000):
+    """
+    Updates the delivery status of transactions that are still pending, either
+    because DT One accepted them, or because it isn't known whether DT One received
+    them. Transactions older than DTONE_RECONCILE_MAX_AGE are no longer checked.
+    """
+    pending = Transaction.objects.filter(
+        delivery_status=Transaction.DeliveryStatus.PENDING,
+        timestamp__gte=timezone.now()
+        - timedelta(seconds=settings.DTONE_RECONCILE_MAX_AGE),
+    )
+
+    for org_id in pending.values_list("org_id", flat=True).distinct():
+        account = DtoneAccount.objects.filter(org_id=org_id).first()
+        if account is None:
+            continue
+        client = account.get_dtone_client()
+
+        org_pending = pending.filter(org_id=org_id).order_by("id")
+        last_id = 0
+        while True:
+            transactions = list(org_pending.filter(id__gt=last_id)[:batch_size])
+            if not transactions:
+                break
+            reconcile_transactions(client, transactions)
+            last_id = transactions[-1].id
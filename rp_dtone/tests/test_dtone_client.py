@@ -1,10 +1,12 @@
 import json
 import uuid
+from unittest.mock import patch
 
 import responses
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from freezegun import freeze_time
 
-from rp_dtone.dtone_client import DtoneClient
+from rp_dtone.dtone_client import DtoneClient, _product_index_cache, redis_conn
 
 
 class TestDtoneClient(TestCase):
@@ -34,7 +36,7 @@ class TestDtoneClient(TestCase):
     def test_get_fixed_value_product(self):
         responses.add(
             method=responses.GET,
-            url="https://preprod-dvs-api.dtone.com/v1/products?type=FIXED_VALUE_RECHARGE&operator_id=123&per_page=100",
+            url="https://preprod-dvs-api.dtone.com/v1/products?type=FIXED_VALUE_RECHARGE&operator_id=123&per_page=100&page=1",
             json=[
                 {
                     "id": 111,
@@ -86,6 +88,63 @@ class TestDtoneClient(TestCase):
             "Basic ZmFrZV9hcGlrZXk6ZmFrZV9hcGlzZWNyZXQ=",
         )
 
+    @responses.activate
+    def test_get_fixed_value_product_pages(self):
+        url = (
+            "https://preprod-dvs-api.dtone.com/v1/products?type=FIXED_VALUE_RECHARGE"
+            "&operator_id=123&per_page=100&page={}"
+        )
+        airtime = {"subservice": {"id": 11, "name": "Airtime"}}
+        responses.add(
+            method=responses.GET,
+            url=url.format(1),
+            json=[{"id": 111, "destination": {"amount": 10}, "service": airtime}],
+            headers={"X-Next-Page": "2"},
+            status=200,
+        )
+        responses.add(
+            method=responses.GET,
+            url=url.format(2),
+            json=[{"id": 222, "destination": {"amount": 5.0}, "service": airtime}],
+            status=200,
+        )
+
+        product_id = self.client.get_fixed_value_product(123, 5)
+
+        self.assertEqual(product_id, 222)
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    def test_get_transaction(self):
+        responses.add(
+            method=responses.GET,
+            url="https://preprod-dvs-api.dtone.com/v1/transactions/555",
+            json={"id": 555, "status": {"class": {"message": "COMPLETED"}}},
+            status=200,
+        )
+
+        transaction = self.client.get_transaction(555)
+
+        self.assertEqual(transaction["status"]["class"]["message"], "COMPLETED")
+
+    @responses.activate
+    def test_get_transaction_by_external_id(self):
+        responses.add(
+            method=responses.GET,
+            url="https://preprod-dvs-api.dtone.com/v1/transactions?external_id=abc",
+            json=[{"id": 555}],
+            status=200,
+        )
+        responses.add(
+            method=responses.GET,
+            url="https://preprod-dvs-api.dtone.com/v1/transactions?external_id=def",
+            json=[],
+            status=200,
+        )
+
+        self.assertEqual(self.client.get_transaction_by_external_id("abc")["id"], 555)
+        self.assertIsNone(self.client.get_transaction_by_external_id("def"))
+
     @responses.activate
     def test_submit_transaction(self):
         responses.add(
@@ -99,6 +158,7 @@ class TestDtoneClient(TestCase):
         self.client.submit_transaction(transaction_uuid, "+27123", 123)
 
         request = responses.calls[0].request
+        self.assertEqual(request.req_kwargs["timeout"], self.client.transaction_timeout)
         self.assertEqual(
             request.headers["Authorization"],
             "Basic ZmFrZV9hcGlrZXk6ZmFrZV9hcGlzZWNyZXQ=",
@@ -113,3 +173,56 @@ class TestDtoneClient(TestCase):
                 "credit_party_identifier": {"mobile_number": "+27123"},
             },
         )
+
+
+@override_settings(DTONE_PRODUCT_INDEX_TTL=60)
+class TestDtoneClientProductIndexCache(TestCase):
+    url = (
+        "https://preprod-dvs-api.dtone.com/v1/products?type=FIXED_VALUE_RECHARGE"
+        "&operator_id=123&per_page=100&page=1"
+    )
+
+    def setUp(self):
+        self.client = DtoneClient("fake_apikey", "fake_apisecret", False, account_id=1)
+        responses.add(
+            method=responses.GET,
+            url=self.url,
+            json=[
+                {
+                    "id": 444,
+                    "destination": {"amount": 5},
+                    "service": {"subservice": {"id": 11, "name": "Airtime"}},
+                }
+            ],
+            status=200,
+        )
+
+    def tearDown(self):
+        _product_index_cache.clear()
+        for key in redis_conn.keys("dtone_product_index_*"):
+            redis_conn.delete(key)
+
+    @responses.activate
+    def test_cached(self):
+        self.assertEqual(self.client.get_fixed_value_product(123, 5), 444)
+        self.assertEqual(self.client.get_fixed_value_product(123, 5), 444)
+        self.assertIsNone(self.client.get_fixed_value_product(123, 10))
+        self.assertEqual(len(responses.calls), 1)
+
+        # Other processes use the index cached in Redis
+        _product_index_cache.clear()
+        self.assertEqual(self.client.get_fixed_value_product(123, 5), 444)
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @patch("rp_dtone.tasks.refresh_dtone_product_index.delay")
+    def test_stale_refreshed_in_background(self, mock_refresh):
+        with freeze_time("2026-01-01 00:00:00"):
+            self.client.get_fixed_value_product(123, 5)
+
+        with freeze_time("2026-01-01 00:01:01"):
+            self.assertEqual(self.client.get_fixed_value_product(123, 5), 444)
+            self.assertEqual(self.client.get_fixed_value_product(123, 5), 444)
+
+        self.assertEqual(len(responses.calls), 1)
+        mock_refresh.assert_called_once_with(1, 123)
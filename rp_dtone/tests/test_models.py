@@ -34,6 +34,7 @@ class TestTransaction(TestCase):
                 "operator_id": 1,
                 "product_id": 2,
                 "status": str(Transaction.Status.CREATED),
+                "delivery_status": None,
                 "response": {"test": "response"},
                 "org": self.org.name,
                 "timestamp": "2019-03-14 01:30:00",
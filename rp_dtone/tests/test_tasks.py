@@ -0,0 +1,192 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from requests.exceptions import ConnectTimeout, ReadTimeout
+
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import _prefix_tables
+from rp_dtone.models import Transaction
+from rp_dtone.tasks import (
+    learn_dtone_operator_prefixes,
+    reconcile_dtone_transactions,
+    send_airtime_async,
+)
+from sidekick.tests.utils import create_org
+
+from .utils import create_dtone_account
+
+
+@patch("rp_dtone.tasks.start_flow")
+@patch("rp_dtone.tasks.submit_transaction")
+class TestSendAirtimeAsync(TestCase):
+    def setUp(self):
+        self.org = create_org()
+        create_dtone_account(org=self.org)
+        self.transaction = Transaction.objects.create(
+            org=self.org, msisdn="+27820006000", value=10
+        )
+
+    def test_success_flow(self, mock_submit_transaction, mock_start_flow):
+        mock_submit_transaction.return_value = True, self.transaction.uuid
+
+        send_airtime_async(
+            self.transaction.id,
+            user_uuid="user-uuid",
+            flow_start="success-flow",
+            fail_flow_start="fail-flow",
+        )
+
+        self.assertEqual(mock_submit_transaction.call_args.args[1], self.transaction)
+        mock_start_flow.assert_called_once_with(
+            org=self.org, user_uuid="user-uuid", flow_uuid="success-flow"
+        )
+
+    def test_fail_flow(self, mock_submit_transaction, mock_start_flow):
+        mock_submit_transaction.return_value = False, self.transaction.uuid
+
+        send_airtime_async(
+            self.transaction.id, user_uuid="user-uuid", fail_flow_start="fail-flow"
+        )
+
+        mock_start_flow.assert_called_once_with(
+            org=self.org, user_uuid="user-uuid", flow_uuid="fail-flow"
+        )
+
+    def test_submit_exception(self, mock_submit_transaction, mock_start_flow):
+        mock_submit_transaction.side_effect = Exception("timed out")
+
+        send_airtime_async(
+            self.transaction.id, user_uuid="user-uuid", fail_flow_start="fail-flow"
+        )
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, Transaction.Status.ERROR)
+        self.assertEqual(self.transaction.response, {"error": "timed out"})
+        mock_start_flow.assert_called_once_with(
+            org=self.org, user_uuid="user-uuid", flow_uuid="fail-flow"
+        )
+
+    def submit_error(self, error):
+        def submit_transaction(client, transaction):
+            transaction.product_id = 2
+            raise error
+
+        return submit_transaction
+
+    def test_submit_connect_error(self, mock_submit_transaction, mock_start_flow):
+        """
+        Connection errors happen before anything is sent, so DT One can't have
+        received the transaction
+        """
+        mock_submit_transaction.side_effect = self.submit_error(ConnectTimeout())
+
+        send_airtime_async(
+            self.transaction.id, user_uuid="user-uuid", fail_flow_start="fail-flow"
+        )
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, Transaction.Status.ERROR)
+        mock_start_flow.assert_called_once_with(
+            org=self.org, user_uuid="user-uuid", flow_uuid="fail-flow"
+        )
+
+    def test_submit_read_timeout(self, mock_submit_transaction, mock_start_flow):
+        """
+        DT One may have accepted the transaction before a read timeout, so it should
+        be left pending to be reconciled
+        """
+        mock_submit_transaction.side_effect = self.submit_error(ReadTimeout())
+
+        send_airtime_async(
+            self.transaction.id, user_uuid="user-uuid", fail_flow_start="fail-flow"
+        )
+
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status, Transaction.Status.CREATED)
+        self.assertEqual(
+            self.transaction.delivery_status, Transaction.DeliveryStatus.PENDING
+        )
+        self.assertEqual(self.transaction.product_id, 2)
+        mock_start_flow.assert_not_called()
+
+    def test_no_flow(self, mock_submit_transaction, mock_start_flow):
+        mock_submit_transaction.return_value = True, self.transaction.uuid
+
+        send_airtime_async(self.transaction.id, user_uuid="user-uuid")
+
+        mock_start_flow.assert_not_called()
+
+
+@patch("rp_dtone.tasks.reconcile_transactions")
+class TestReconcileDtoneTransactions(TestCase):
+    def setUp(self):
+        self.org = create_org()
+        self.account = create_dtone_account(org=self.org)
+
+    def create_transaction(self, **kwargs):
+        data = {
+            "org": self.org,
+            "msisdn": "+27820006000",
+            "value": 10,
+            "status": Transaction.Status.SUCCESS,
+            "dtone_id": 1,
+            "delivery_status": Transaction.DeliveryStatus.PENDING,
+        }
+        data.update(kwargs)
+        return Transaction.objects.create(**data)
+
+    def test_reconcile_pending(self, mock_reconcile_transactions):
+        pending = [self.create_transaction() for _ in range(2)]
+        pending.append(self.create_transaction(dtone_id=None))
+        self.create_transaction(delivery_status=Transaction.DeliveryStatus.COMPLETED)
+        self.create_transaction(timestamp=timezone.now() - timedelta(days=30))
+
+        reconcile_dtone_transactions(batch_size=2)
+
+        batches = [call.args[1] for call in mock_reconcile_transactions.call_args_list]
+        self.assertEqual(batches, [pending[:2], pending[2:]])
+        self.assertEqual(
+            mock_reconcile_transactions.call_args.args[0].account_id, self.account.id
+        )
+
+
+@override_settings(OPERATOR_PREFIX_MIN_OBSERVATIONS=3)
+class TestLearnDtoneOperatorPrefixes(TestCase):
+    def setUp(self):
+        self.org = create_org()
+
+    def tearDown(self):
+        _prefix_tables.clear()
+
+    def test_learn_from_lookups_only(self):
+        """
+        Operators resolved from the prefix table shouldn't be learned from
+        """
+        for i in range(5):
+            Transaction.objects.create(
+                org=self.org,
+                msisdn=f"+2782000{i:04d}",
+                value=10,
+                operator_id=1,
+                operator_source=Transaction.OperatorSource.LOOKUP,
+            )
+            Transaction.objects.create(
+                org=self.org,
+                msisdn=f"+2783000{i:04d}",
+                value=10,
+                operator_id=2,
+                operator_source=Transaction.OperatorSource.PREFIX,
+            )
+
+        learn_dtone_operator_prefixes()
+
+        self.assertEqual(
+            dict(
+                OperatorPrefix.objects.filter(
+                    provider=OperatorPrefix.Provider.DTONE
+                ).values_list("prefix", "operator_id")
+            ),
+            {"2782": 1},
+        )
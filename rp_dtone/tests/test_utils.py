@@ -1,10 +1,13 @@
 from unittest.mock import patch
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from requests.exceptions import ConnectTimeout, ReadTimeout
 
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import _prefix_tables
 from rp_dtone.dtone_client import DtoneClient
-from rp_dtone.models import Transaction
-from rp_dtone.utils import send_airtime
+from rp_dtone.models import Transaction, TransactionBatch
+from rp_dtone.utils import reconcile_transactions, send_airtime, send_airtime_batch
 from sidekick.tests.utils import create_org
 
 
@@ -17,6 +20,15 @@ class MockResponse:
         return self.json_data
 
 
+class HTMLResponse:
+    def __init__(self, text, status_code):
+        self.text = text
+        self.status_code = status_code
+
+    def json(self):
+        raise ValueError("Expecting value")
+
+
 class TestSendAirtime(TestCase):
     def setUp(self):
         self.client = DtoneClient("fake_apikey", "fake_apisecret", False)
@@ -102,7 +114,255 @@ class TestSendAirtime(TestCase):
         t = Transaction.objects.get(uuid=transaction_uuid)
         self.assertEqual(t.status, Transaction.Status.SUCCESS)
         self.assertIsNone(t.response)
+        self.assertEqual(t.operator_source, Transaction.OperatorSource.LOOKUP)
 
         mock_get_operator_id.assert_called_with("+27123")
         mock_get_fixed_value_product.assert_called_with(1, 1000)
         mock_submit_transaction.assert_called_with(transaction_uuid, "+27123", 2)
+
+    @patch("rp_dtone.dtone_client.DtoneClient.get_operator_id")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_fixed_value_product")
+    @patch("rp_dtone.dtone_client.DtoneClient.submit_transaction")
+    def test_send_airtime_success_pending_delivery(
+        self,
+        mock_submit_transaction,
+        mock_get_fixed_value_product,
+        mock_get_operator_id,
+    ):
+        mock_get_operator_id.return_value = 1
+        mock_get_fixed_value_product.return_value = 2
+        mock_submit_transaction.return_value = MockResponse({"id": 555}, 201)
+
+        _, transaction_uuid = send_airtime(self.org.id, self.client, "+27123", 1000)
+
+        t = Transaction.objects.get(uuid=transaction_uuid)
+        self.assertEqual(t.dtone_id, 555)
+        self.assertEqual(t.delivery_status, Transaction.DeliveryStatus.PENDING)
+
+
+class TestSendAirtimeBatch(TestCase):
+    def setUp(self):
+        self.client = DtoneClient("fake_apikey", "fake_apisecret", False)
+        self.org = create_org()
+
+    @patch("rp_dtone.dtone_client.DtoneClient.submit_transaction")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_fixed_value_product")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_operator_id")
+    def test_send_airtime_batch(
+        self, mock_get_operator_id, mock_get_fixed_value_product, mock_submit
+    ):
+        """
+        Products should be looked up once per operator and value, and each
+        transaction's result recorded
+        """
+        batch = TransactionBatch.objects.create(org=self.org)
+        recipients = [
+            ("+27820000001", 10),
+            ("+27820000002", 10),
+            ("+27830000001", 10),
+            ("+27840000001", 10),
+            ("+27820000003", 20),
+        ]
+        for msisdn, value in recipients:
+            Transaction.objects.create(
+                org=self.org, batch=batch, msisdn=msisdn, value=value
+            )
+        mock_get_operator_id.side_effect = lambda msisdn: {
+            "+2782": 1,
+            "+2783": 2,
+        }.get(msisdn[:5])
+        mock_get_fixed_value_product.side_effect = lambda operator_id, value: (
+            None if value == 20 else operator_id * 100 + value
+        )
+        mock_submit.side_effect = lambda uuid, msisdn, product_id: (
+            MockResponse({"error": "fail"}, 400)
+            if msisdn == "+27830000001"
+            else MockResponse({}, 201)
+        )
+
+        send_airtime_batch(batch, self.client, chunk_size=2)
+
+        self.assertEqual(mock_get_fixed_value_product.call_count, 3)
+        statuses = dict(batch.transactions.values_list("msisdn", "status"))
+        self.assertEqual(
+            statuses,
+            {
+                "+27820000001": Transaction.Status.SUCCESS,
+                "+27820000002": Transaction.Status.SUCCESS,
+                "+27830000001": Transaction.Status.ERROR,
+                "+27840000001": Transaction.Status.OPERATOR_NOT_FOUND,
+                "+27820000003": Transaction.Status.PRODUCT_NOT_FOUND,
+            },
+        )
+        self.assertEqual(batch.transactions.get(msisdn="+27820000001").product_id, 110)
+        self.assertEqual(
+            batch.transactions.get(msisdn="+27830000001").response, {"error": "fail"}
+        )
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, TransactionBatch.Status.DONE)
+        self.assertEqual(batch.get_summary()["total"], 5)
+
+    @patch("rp_dtone.dtone_client.DtoneClient.submit_transaction")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_fixed_value_product")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_operator_id")
+    def test_send_airtime_batch_submit_errors(
+        self, mock_get_operator_id, mock_get_fixed_value_product, mock_submit
+    ):
+        """
+        A bad response or error for one transaction shouldn't stop the batch, and
+        transactions that DT One may have received should be left pending
+        """
+        batch = TransactionBatch.objects.create(org=self.org)
+        for i in range(4):
+            Transaction.objects.create(
+                org=self.org, batch=batch, msisdn=f"+2782000000{i}", value=10
+            )
+        mock_get_operator_id.return_value = 1
+        mock_get_fixed_value_product.return_value = 2
+        results = {
+            "+27820000000": HTMLResponse("<html>Bad Gateway</html>", 502),
+            "+27820000001": ConnectTimeout("connect timed out"),
+            "+27820000002": ReadTimeout("read timed out"),
+            "+27820000003": MockResponse({}, 201),
+        }
+
+        def submit(uuid, msisdn, product_id):
+            if isinstance(results[msisdn], Exception):
+                raise results[msisdn]
+            return results[msisdn]
+
+        mock_submit.side_effect = submit
+
+        send_airtime_batch(batch, self.client)
+
+        transactions = {t.msisdn: t for t in batch.transactions.all()}
+        self.assertEqual(
+            transactions["+27820000000"].response, "<html>Bad Gateway</html>"
+        )
+        self.assertEqual(
+            {msisdn: t.status for msisdn, t in transactions.items()},
+            {
+                "+27820000000": Transaction.Status.ERROR,
+                "+27820000001": Transaction.Status.ERROR,
+                "+27820000002": Transaction.Status.CREATED,
+                "+27820000003": Transaction.Status.SUCCESS,
+            },
+        )
+        self.assertEqual(
+            transactions["+27820000002"].delivery_status,
+            Transaction.DeliveryStatus.PENDING,
+        )
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, TransactionBatch.Status.DONE)
+
+        # The pending transaction shouldn't be submitted again
+        mock_submit.reset_mock()
+        send_airtime_batch(batch, self.client)
+        mock_submit.assert_not_called()
+
+    @override_settings(OPERATOR_PREFIX_VERIFY_RATE=1)
+    @patch("rp_dtone.dtone_client.DtoneClient.submit_transaction")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_fixed_value_product")
+    @patch("rp_dtone.dtone_client.DtoneClient.get_operator_id")
+    def test_send_airtime_batch_verify_prefix(
+        self, mock_get_operator_id, mock_get_fixed_value_product, mock_submit
+    ):
+        """
+        Operators from the prefix table should be verified with a lookup at
+        OPERATOR_PREFIX_VERIFY_RATE, using the looked up operator
+        """
+        OperatorPrefix.objects.create(
+            provider=OperatorPrefix.Provider.DTONE, prefix="2782", operator_id=1
+        )
+        self.addCleanup(_prefix_tables.clear)
+        batch = TransactionBatch.objects.create(org=self.org)
+        Transaction.objects.create(
+            org=self.org, batch=batch, msisdn="+27820000001", value=10
+        )
+        mock_get_operator_id.return_value = 2
+        mock_get_fixed_value_product.return_value = 210
+        mock_submit.return_value = MockResponse({}, 201)
+
+        send_airtime_batch(batch, self.client)
+
+        mock_get_operator_id.assert_called_once_with("+27820000001")
+        transaction = batch.transactions.get()
+        self.assertEqual(transaction.operator_id, 2)
+        self.assertEqual(transaction.operator_source, Transaction.OperatorSource.LOOKUP)
+        self.assertEqual(transaction.status, Transaction.Status.SUCCESS)
+
+
+class TestReconcileTransactions(TestCase):
+    def setUp(self):
+        self.client = DtoneClient("fake_apikey", "fake_apisecret", False)
+        self.org = create_org()
+
+    def create_transaction(self, dtone_id):
+        return Transaction.objects.create(
+            org=self.org,
+            msisdn="+27123",
+            value=10,
+            status=Transaction.Status.SUCCESS,
+            dtone_id=dtone_id,
+            delivery_status=Transaction.DeliveryStatus.PENDING,
+        )
+
+    @patch("rp_dtone.dtone_client.DtoneClient.get_transaction")
+    def test_reconcile_transactions(self, mock_get_transaction):
+        statuses = {1: "COMPLETED", 2: "DECLINED", 3: "SUBMITTED"}
+
+        def get_transaction(dtone_id):
+            if dtone_id == 4:
+                raise Exception("fail")
+            return {
+                "id": dtone_id,
+                "status": {"class": {"id": 1, "message": statuses[dtone_id]}},
+            }
+
+        mock_get_transaction.side_effect = get_transaction
+        transactions = [self.create_transaction(i) for i in range(1, 5)]
+
+        finished = reconcile_transactions(self.client, transactions)
+
+        self.assertEqual(finished, 2)
+        delivery_statuses = dict(
+            Transaction.objects.values_list("dtone_id", "delivery_status")
+        )
+        self.assertEqual(
+            delivery_statuses,
+            {
+                1: Transaction.DeliveryStatus.COMPLETED,
+                2: Transaction.DeliveryStatus.FAILED,
+                3: Transaction.DeliveryStatus.PENDING,
+                4: Transaction.DeliveryStatus.PENDING,
+            },
+        )
+        self.assertEqual(
+            Transaction.objects.get(dtone_id=2).response,
+            {"class": {"id": 1, "message": "DECLINED"}},
+        )
+
+    @patch("rp_dtone.dtone_client.DtoneClient.get_transaction_by_external_id")
+    def test_reconcile_transactions_external_id(self, mock_get_transaction):
+        """
+        Transactions without a DT One ID should be looked up by their external ID,
+        and failed if DT One didn't receive them
+        """
+        received = self.create_transaction(None)
+        missing = self.create_transaction(None)
+        mock_get_transaction.side_effect = lambda external_id: (
+            {"id": 7, "status": {"class": {"id": 1, "message": "SUBMITTED"}}}
+            if external_id == received.uuid
+            else None
+        )
+
+        finished = reconcile_transactions(self.client, [received, missing])
+
+        self.assertEqual(finished, 1)
+        received.refresh_from_db()
+        self.assertEqual(received.dtone_id, 7)
+        self.assertEqual(received.status, Transaction.Status.SUCCESS)
+        self.assertEqual(received.delivery_status, Transaction.DeliveryStatus.PENDING)
+        missing.refresh_from_db()
+        self.assertEqual(missing.status, Transaction.Status.ERROR)
+        self.assertEqual(missing.delivery_status, Transaction.DeliveryStatus.FAILED)
@@ -7,6 +7,7 @@ from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient, APITestCase
 
+from rp_dtone.models import Transaction, TransactionBatch
 from sidekick.tests.utils import create_org
 
 from .utils import create_dtone_account
@@ -136,3 +137,108 @@ class TestDtoneViews(APITestCase):
             json.loads(response.content), {"error": "no dtone account configured"}
         )
         mock_send_airtime.assert_not_called()
+
+    @patch("rp_dtone.views.process_transaction_batch")
+    def test_create_transaction_batch(self, mock_process_transaction_batch):
+        response = self.api_client.post(
+            reverse("create_transaction_batch", kwargs={"org_id": self.org.id}),
+            {
+                "recipients": [
+                    {"msisdn": "+27820006000", "value": 10},
+                    {"msisdn": "+27820006001", "value": 20},
+                ]
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        batch = TransactionBatch.objects.get(id=response.json()["id"])
+        self.assertEqual(
+            sorted(batch.transactions.values_list("msisdn", "value", "status")),
+            [
+                ("+27820006000", 10, Transaction.Status.CREATED),
+                ("+27820006001", 20, Transaction.Status.CREATED),
+            ],
+        )
+        mock_process_transaction_batch.delay.assert_called_once_with(batch.id)
+
+    def test_create_transaction_batch_invalid(self):
+        response = self.api_client.post(
+            reverse("create_transaction_batch", kwargs={"org_id": self.org.id}),
+            {"recipients": [{"msisdn": "+27820006000"}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(TransactionBatch.objects.exists())
+
+    def test_transaction_batch_status(self):
+        batch = TransactionBatch.objects.create(org=self.org)
+        Transaction.objects.create(
+            org=self.org, batch=batch, msisdn="+27820006000", value=10
+        )
+        response = self.api_client.get(
+            reverse(
+                "transaction_batch",
+                kwargs={"org_id": self.org.id, "batch_id": batch.id},
+            )
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["status"], "created")
+        self.assertEqual(response.json()["transactions"], {"created": 1})
+
+    def test_transaction_batch_wrong_method(self):
+        response = self.api_client.get(
+            reverse("create_transaction_batch", kwargs={"org_id": self.org.id})
+        )
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        response = self.api_client.post(
+            reverse("transaction_batch", kwargs={"org_id": self.org.id, "batch_id": 1}),
+            {},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+    @patch("rp_dtone.views.send_airtime_async")
+    @patch("rp_dtone.views.send_airtime")
+    def test_send_fixed_amount_airtime_async(
+        self, mock_send_airtime, mock_send_airtime_async
+    ):
+        url = reverse(
+            "send_fixed_amount_airtime",
+            kwargs={
+                "org_id": self.org.id,
+                "msisdn": "+27820006000",
+                "airtime_value": 444,
+            },
+        )
+        response = self.api_client.get(
+            f"{url}?async=true&user_uuid=user-uuid&flow_uuid=flow-uuid"
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        transaction = Transaction.objects.get()
+        self.assertEqual(response.json(), {"uuid": str(transaction.uuid)})
+        self.assertEqual(transaction.status, Transaction.Status.CREATED)
+        mock_send_airtime.assert_not_called()
+        mock_send_airtime_async.delay.assert_called_once_with(
+            transaction.id,
+            user_uuid="user-uuid",
+            flow_start="flow-uuid",
+            fail_flow_start=None,
+        )
+
+    def test_transaction_status(self):
+        transaction = Transaction.objects.create(
+            org=self.org, msisdn="+27820006000", value=10
+        )
+        url = reverse(
+            "transaction_status",
+            kwargs={"org_id": self.org.id, "transaction_uuid": transaction.uuid},
+        )
+        response = self.api_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["uuid"], str(transaction.uuid))
+        self.assertEqual(response.json()["status"], "created")
+
+        self.org.users.remove(self.user)
+        response = self.api_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
@@ -8,4 +8,19 @@ urlpatterns = [
         views.SendFixedValueAirtimeView.as_view(),
         name="send_fixed_amount_airtime",
     ),
+    path(
+        "<int:org_id>/transactions/<uuid:transaction_uuid>/",
+        views.TransactionStatusView.as_view(),
+        name="transaction_status",
+    ),
+    path(
+        "<int:org_id>/batches/",
+        views.TransactionBatchView.as_view(),
+        name="create_transaction_batch",
+    ),
+    path(
+        "<int:org_id>/batches/<int:batch_id>/",
+        views.TransactionBatchDetailView.as_view(),
+        name="transaction_batch",
+    ),
 ]
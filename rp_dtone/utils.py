@@ -1,10 +1,54 @@
-from .models import Transaction
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.utils import timezone
+from prometheus_client import Counter
+
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import (
+    get_prefix_operator,
+    operator_prefix_lookups,
+    resolve_operator,
+    verify_operator,
+)
+
+from .models import Transaction, TransactionBatch
+
+dtone_transaction_outcomes = Counter(
+    "dtone_transaction_outcomes",
+    "Final delivery statuses of accepted DT One transactions",
+    ["delivery_status"],
+)
+
+# DT One transaction status classes that mean the airtime will not be delivered
+DTONE_FAILED_STATUSES = {"REJECTED", "CANCELLED", "REVERSED", "DECLINED"}
 
 
 def send_airtime(org_id, client, msisdn, value):
     transaction = Transaction.objects.create(org_id=org_id, msisdn=msisdn, value=value)
-    transaction.operator_id = client.get_operator_id(msisdn)
+    return submit_transaction(client, transaction)
+
+
+def submit_transaction(client, transaction):
+    """
+    Looks up the operator and product for a created transaction, and submits it
+    """
+    msisdn = transaction.msisdn
+    value = transaction.value
+
+    def lookup_operator(msisdn):
+        operator_id = client.get_operator_id(msisdn)
+        if operator_id:
+            transaction.operator_source = Transaction.OperatorSource.LOOKUP
+        return operator_id
+
+    transaction.operator_source = Transaction.OperatorSource.PREFIX
+    transaction.operator_id = resolve_operator(
+        OperatorPrefix.Provider.DTONE, msisdn, lookup_operator
+    )
     if not transaction.operator_id:
+        transaction.operator_source = None
         transaction.status = Transaction.Status.OPERATOR_NOT_FOUND
         transaction.save()
         return False, transaction.uuid
@@ -20,11 +64,252 @@ def send_airtime(org_id, client, msisdn, value):
     response = client.submit_transaction(
         transaction.uuid, msisdn, transaction.product_id
     )
+    record_submission(transaction, response)
+    transaction.save()
+    return transaction.status == Transaction.Status.SUCCESS, transaction.uuid
+
+
+def record_submission(transaction, response):
+    """
+    Updates the transaction with DT One's response to submitting it. Accepted
+    transactions are delivered later, so their delivery status is pending until
+    they are reconciled.
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        # Error pages from proxies aren't JSON
+        body = response.text
     if response.status_code == 201:
         transaction.status = Transaction.Status.SUCCESS
+        transaction.dtone_id = body.get("id") if isinstance(body, dict) else None
+        if transaction.dtone_id:
+            transaction.delivery_status = Transaction.DeliveryStatus.PENDING
     else:
         transaction.status = Transaction.Status.ERROR
-        transaction.response = response.json()
+        transaction.response = body
 
-    transaction.save()
-    return transaction.status == Transaction.Status.SUCCESS, transaction.uuid
+
+def get_delivery_status(dtone_transaction):
+    status = dtone_transaction["status"]["class"]["message"]
+    if status == "COMPLETED":
+        return Transaction.DeliveryStatus.COMPLETED
+    if status in DTONE_FAILED_STATUSES:
+        return Transaction.DeliveryStatus.FAILED
+    return Transaction.DeliveryStatus.PENDING
+
+
+def reconcile_transactions(client, transactions):
+    """
+    Fetches the current status of the pending transactions from DT One, using
+    DTONE_BATCH_WORKERS concurrent requests, and saves the ones that have changed.
+    Returns the number of transactions that finished.
+
+    Transactions without a DT One ID failed in a way that DT One may or may not
+    have received them, so they are looked up by their external ID instead.
+    """
+
+    def get_transaction(transaction):
+        try:
+            if transaction.dtone_id is None:
+                return client.get_transaction_by_external_id(transaction.uuid), None
+            return client.get_transaction(transaction.dtone_id), None
+        except Exception as e:
+            # Try again on the next run
+            return None, e
+
+    updated, finished = [], 0
+    with ThreadPoolExecutor(max_workers=settings.DTONE_BATCH_WORKERS) as executor:
+        for transaction, (dtone_transaction, error) in zip(
+            transactions, executor.map(get_transaction, transactions)
+        ):
+            if error is not None:
+                continue
+
+            if dtone_transaction is None:
+                # DT One never received the transaction
+                transaction.status = Transaction.Status.ERROR
+                delivery_status = Transaction.DeliveryStatus.FAILED
+            elif transaction.dtone_id is None:
+                transaction.dtone_id = dtone_transaction["id"]
+                transaction.status = Transaction.Status.SUCCESS
+                transaction.response = None
+                delivery_status = get_delivery_status(dtone_transaction)
+            else:
+                delivery_status = get_delivery_status(dtone_transaction)
+                if delivery_status == Transaction.DeliveryStatus.PENDING:
+                    continue
+
+            transaction.delivery_status = delivery_status
+            if (
+                delivery_status == Transaction.DeliveryStatus.FAILED
+                and dtone_transaction
+            ):
+                transaction.response = dtone_transaction["status"]
+            updated.append(transaction)
+            if delivery_status == Transaction.DeliveryStatus.PENDING:
+                continue
+            finished += 1
+            dtone_transaction_outcomes.labels(delivery_status=delivery_status).inc()
+
+    Transaction.objects.bulk_update(
+        updated, ["dtone_id", "status", "delivery_status", "response"]
+    )
+    return finished
+
+
+def send_airtime_batch(batch, client, chunk_size=1000):
+    """
+    Submits the created transactions in the batch, chunk_size at a time, using
+    DTONE_BATCH_WORKERS concurrent requests. Products are looked up once for each
+    operator and value in the batch, rather than once per transaction.
+
+    The transaction UUID is sent as the external ID, which DT One only accepts
+    once, so it is safe to run this again for a batch that was interrupted.
+    Transactions that DT One may have received are left pending to be reconciled,
+    rather than submitted again.
+    """
+    batch.status = TransactionBatch.Status.RUNNING
+    batch.started_at = batch.started_at or timezone.now()
+    batch.save(update_fields=["status", "started_at"])
+    provider = OperatorPrefix.Provider.DTONE
+    product_ids = {}
+
+    def call(function, *args):
+        try:
+            return function(*args), None
+        except Exception as e:
+            return None, {"error": str(e)}
+
+    def lookup(transaction):
+        operator_id = client.get_operator_id(transaction.msisdn)
+        if operator_id:
+            transaction.operator_source = Transaction.OperatorSource.LOOKUP
+        return operator_id
+
+    def lookup_operator(transaction):
+        if not transaction.operator_id:
+            return call(lookup, transaction)
+        if transaction.operator_source == Transaction.OperatorSource.PREFIX:
+            operator_id, _ = call(
+                verify_operator,
+                provider,
+                transaction.msisdn,
+                transaction.operator_id,
+                lambda msisdn: lookup(transaction),
+            )
+            return operator_id or transaction.operator_id, None
+        return transaction.operator_id, None
+
+    def submit(transaction):
+        try:
+            response = client.submit_transaction(
+                transaction.uuid, transaction.msisdn, transaction.product_id
+            )
+        except Exception as e:
+            return None, e
+        return response, None
+
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=settings.DTONE_BATCH_WORKERS) as executor:
+        while True:
+            batch_transactions = list(
+                batch.transactions.filter(
+                    status=Transaction.Status.CREATED, id__gt=last_id
+                )
+                .exclude(delivery_status=Transaction.DeliveryStatus.PENDING)
+                .order_by("id")[:chunk_size]
+            )
+            if not batch_transactions:
+                break
+            last_id = batch_transactions[-1].id
+            transactions = batch_transactions
+
+            # Resolve from the prefix table up front, so that the workers don't
+            # need to access the database
+            for transaction in transactions:
+                if not transaction.operator_id:
+                    transaction.operator_id = get_prefix_operator(
+                        provider, transaction.msisdn
+                    )
+                    if transaction.operator_id:
+                        transaction.operator_source = Transaction.OperatorSource.PREFIX
+                operator_prefix_lookups.labels(
+                    provider=provider,
+                    result="hit" if transaction.operator_id else "miss",
+                ).inc()
+
+            for transaction, (operator_id, error) in zip(
+                transactions, executor.map(lookup_operator, transactions)
+            ):
+                transaction.operator_id = operator_id
+                transaction.response = error
+                if not operator_id:
+                    transaction.operator_source = None
+                    transaction.status = (
+                        Transaction.Status.ERROR
+                        if error
+                        else Transaction.Status.OPERATOR_NOT_FOUND
+                    )
+
+            transactions = [t for t in transactions if t.operator_id]
+            products = list(
+                {(t.operator_id, t.value) for t in transactions} - product_ids.keys()
+            )
+            product_ids.update(
+                zip(
+                    products,
+                    executor.map(
+                        lambda product: call(client.get_fixed_value_product, *product),
+                        products,
+                    ),
+                )
+            )
+            for transaction in transactions:
+                product_id, error = product_ids[
+                    (transaction.operator_id, transaction.value)
+                ]
+                transaction.product_id = product_id
+                transaction.response = error
+                if not product_id:
+                    transaction.status = (
+                        Transaction.Status.ERROR
+                        if error
+                        else Transaction.Status.PRODUCT_NOT_FOUND
+                    )
+
+            transactions = [t for t in transactions if t.product_id]
+            for transaction, (response, error) in zip(
+                transactions, executor.map(submit, transactions)
+            ):
+                if error is not None:
+                    transaction.response = {"error": str(error)}
+                    if isinstance(error, requests.exceptions.ConnectionError):
+                        transaction.status = Transaction.Status.ERROR
+                    else:
+                        # DT One may have accepted the transaction before the
+                        # error, so leave it for reconcile_dtone_transactions
+                        transaction.delivery_status = Transaction.DeliveryStatus.PENDING
+                    continue
+                try:
+                    record_submission(transaction, response)
+                except Exception as e:
+                    transaction.status = Transaction.Status.ERROR
+                    transaction.response = {"error": str(e)}
+
+            Transaction.objects.bulk_update(
+                batch_transactions,
+                [
+                    "operator_id",
+                    "operator_source",
+                    "product_id",
+                    "status",
+                    "response",
+                    "dtone_id",
+                    "delivery_status",
+                ],
+            )
+
+    batch.status = TransactionBatch.Status.DONE
+    batch.finished_at = timezone.now()
+    batch.save(update_fields=["status", "finished_at"])
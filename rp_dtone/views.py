@@ -1,9 +1,13 @@
+from django.conf import settings
 from django.http import JsonResponse
 from rest_framework import status
 from rest_framework.views import APIView
 
 from sidekick.models import Organization
 
+from .models import Transaction, TransactionBatch
+from .serializers import TransactionBatchSerializer
+from .tasks import process_transaction_batch, send_airtime_async
 from .utils import send_airtime
 
 
@@ -35,9 +39,126 @@ class SendFixedValueAirtimeView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        if request.GET.get("async", "").lower() == "true":
+            transaction = Transaction.objects.create(
+                org=org, msisdn=msisdn, value=airtime_value
+            )
+            send_airtime_async.delay(
+                transaction.id,
+                user_uuid=request.GET.get("user_uuid"),
+                flow_start=request.GET.get("flow_uuid"),
+                fail_flow_start=request.GET.get("fail_flow_start"),
+            )
+            return JsonResponse(
+                data={"uuid": transaction.uuid}, status=status.HTTP_202_ACCEPTED
+            )
+
         success, transaction_uuid = send_airtime(org_id, client, msisdn, airtime_value)
         return_status = status.HTTP_200_OK
         if not success:
             return_status = status.HTTP_400_BAD_REQUEST
 
         return JsonResponse(data={"uuid": transaction_uuid}, status=return_status)
+
+
+class TransactionStatusView(APIView):
+    def get(self, request, *args, **kwargs):
+        try:
+            transaction = Transaction.objects.get(
+                org_id=kwargs["org_id"],
+                org__users=request.user,
+                uuid=kwargs["transaction_uuid"],
+            )
+        except Transaction.DoesNotExist:
+            return JsonResponse(
+                data={"error": "transaction not found"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        return JsonResponse(transaction.as_dict())
+
+
+class TransactionBatchView(APIView):
+    """
+    Creates a batch of fixed value airtime transactions for a list of recipients,
+    and submits them in the background. The batch status can then be polled with
+    TransactionBatchDetailView.
+    """
+
+    def get_org(self, request, org_id):
+        try:
+            org = Organization.objects.get(id=org_id)
+        except Organization.DoesNotExist:
+            return None, JsonResponse(
+                data={"error": "organisation not found"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if not org.users.filter(id=request.user.id).exists():
+            return None, JsonResponse(
+                data={"error": "user not in org"}, status=status.HTTP_401_UNAUTHORIZED
+            )
+        return org, None
+
+    def post(self, request, *args, **kwargs):
+        org, error_response = self.get_org(request, kwargs["org_id"])
+        if error_response:
+            return error_response
+
+        if not org.dtone_account.exists():
+            return JsonResponse(
+                data={"error": "no dtone account configured"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        serializer = TransactionBatchSerializer(data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        recipients = serializer.validated_data["recipients"]
+        if len(recipients) > settings.DTONE_BATCH_MAX:
+            return JsonResponse(
+                data={
+                    "error": f"at most {settings.DTONE_BATCH_MAX} recipients allowed"
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        batch = TransactionBatch.objects.create(org=org)
+        Transaction.objects.bulk_create(
+            [
+                Transaction(
+                    org=org,
+                    batch=batch,
+                    msisdn=recipient["msisdn"],
+                    value=recipient["value"],
+                )
+                for recipient in recipients
+            ],
+            batch_size=1000,
+        )
+        process_transaction_batch.delay(batch.id)
+
+        return JsonResponse(
+            data={"id": batch.id, "total": len(recipients)},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+
+class TransactionBatchDetailView(TransactionBatchView):
+    """
+    Returns the status of a batch of airtime transactions
+    """
+
+    http_method_names = ["get", "head", "options"]
+
+    def get(self, request, *args, **kwargs):
+        org, error_response = self.get_org(request, kwargs["org_id"])
+        if error_response:
+            return error_response
+
+        try:
+            batch = org.transaction_batches.get(id=kwargs["batch_id"])
+        except TransactionBatch.DoesNotExist:
+            return JsonResponse(
+                data={"error": "batch not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return JsonResponse(batch.get_summary())
@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.urls import reverse
 
-from rp_interceptors.models import Interceptor
+from rp_interceptors.models import Interceptor, SpooledRequest, SpoolWatermark
 
 
 @admin.register(Interceptor)
@@ -10,3 +10,14 @@ class InterceptorAdmin(admin.ModelAdmin):
 
     def view_on_site(self, obj):
         return reverse("interceptor-status", args=[obj.pk])
+
+
+@admin.register(SpooledRequest)
+class SpooledRequestAdmin(admin.ModelAdmin):
+    list_display = ("id", "url", "timestamp")
+    list_filter = ("url",)
+
+
+@admin.register(SpoolWatermark)
+class SpoolWatermarkAdmin(admin.ModelAdmin):
+    list_display = ("url", "last_replayed_id", "timestamp")
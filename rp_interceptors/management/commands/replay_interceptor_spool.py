@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+from django.db import connection
+from requests.exceptions import RequestException
+
+from rp_interceptors.models import SpooledRequest, SpoolWatermark
+from rp_interceptors.utils import all_delivered, mark_delivered
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays spooled interceptor requests to RapidPro. Requests for each channel "
+        "are sent in the order they were spooled, and replay of a channel stops at "
+        "the first request that fails, to be resumed from there next time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="Only replay requests for this channel URL")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="How many requests to load at a time, and how often to save progress",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="How many channels to replay concurrently",
+        )
+        parser.add_argument("--timeout", type=float, default=10)
+
+    def handle(self, *args, **options):
+        if options["url"]:
+            urls = [options["url"]]
+        else:
+            urls = list(
+                SpooledRequest.objects.order_by("url")
+                .values_list("url", flat=True)
+                .distinct()
+            )
+
+        def replay(url):
+            return self.replay_channel(
+                url, options["batch_size"], options["timeout"], options["workers"] > 1
+            )
+
+        if options["workers"] > 1:
+            with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                results = list(executor.map(replay, urls))
+        else:
+            results = [replay(url) for url in urls]
+
+        for url, sent, rejected, error in results:
+            self.stdout.write(f"{url}: {sent} sent, {rejected} rejected")
+            if error:
+                self.stderr.write(f"{url}: stopped, {error}")
+
+    def replay_channel(self, url, batch_size, timeout, threaded):
+        session = requests.Session()
+        watermark, _ = SpoolWatermark.objects.get_or_create(url=url)
+        sent = rejected = 0
+        error = None
+
+        try:
+            while error is None:
+                batch = SpooledRequest.objects.filter(
+                    url=url, id__gt=watermark.last_replayed_id
+                ).order_by("id")[:batch_size]
+                if not batch:
+                    break
+
+                for request in batch:
+                    if not all_delivered(request.delivery_keys):
+                        try:
+                            response = session.request(
+                                request.method,
+                                url,
+                                headers=request.headers,
+                                data=request.body.encode(),
+                                timeout=timeout,
+                            )
+                        except RequestException as e:
+                            error = e
+                            break
+                        if response.status_code >= 500:
+                            error = f"HTTP {response.status_code}"
+                            break
+
+                        if response.ok:
+                            mark_delivered(request.delivery_keys)
+                            sent += 1
+                        else:
+                            # Client errors will never succeed, so they shouldn't
+                            # block the rest of the channel
+                            rejected += 1
+                    watermark.last_replayed_id = request.id
+
+                watermark.save(update_fields=["last_replayed_id", "timestamp"])
+        finally:
+            session.close()
+            if threaded:
+                connection.close()
+
+        return url, sent, rejected, error
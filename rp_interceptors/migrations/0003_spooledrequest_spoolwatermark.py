@@ -0,0 +1,64 @@
+# Generated by Django 4.2.16 on 2026-10-19 17:22
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rp_interceptors", "0002_auto_20230411_1948"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SpoolWatermark",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("url", models.CharField(max_length=255, unique=True)),
+                ("last_replayed_id", models.BigIntegerField(default=0)),
+                ("timestamp", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="SpooledRequest",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "url",
+                    models.CharField(
+                        help_text="The RapidPro channel URL the request was for",
+                        max_length=255,
+                    ),
+                ),
+                ("method", models.CharField(max_length=10)),
+                ("headers", models.JSONField()),
+                ("body", models.TextField()),
+                ("delivery_keys", models.JSONField(null=True)),
+                ("timestamp", models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["url", "id"], name="rp_intercep_url_df90af_idx"
+                    )
+                ],
+            },
+        ),
+    ]
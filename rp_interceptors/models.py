@@ -1,7 +1,16 @@
+import time
+
+from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 
 from sidekick.models import Organization
 
+# pk -> (expiry, interceptor), see Interceptor.get_cached
+_interceptor_cache = {}
+
 
 class Interceptor(models.Model):
     org = models.ForeignKey(Organization, on_delete=models.CASCADE)
@@ -15,3 +24,68 @@ class Interceptor(models.Model):
         blank=True,
         help_text="The secret for the webhook in Turn that calls this",
     )
+
+    @classmethod
+    def get_cached(cls, pk):
+        """
+        Returns the interceptor, with its org, from an in-process cache so that the
+        webhook hot path doesn't query the database. Entries are removed when the
+        interceptor or its org is changed, and expire after INTERCEPTOR_CACHE_TTL
+        seconds so that changes made in other processes are picked up.
+        """
+        pk = int(pk)
+        now = time.monotonic()
+        entry = _interceptor_cache.get(pk)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        interceptor = cls.objects.select_related("org").get(pk=pk)
+        _interceptor_cache[pk] = (now + settings.INTERCEPTOR_CACHE_TTL, interceptor)
+        return interceptor
+
+
+class SpooledRequest(models.Model):
+    """
+    A request to RapidPro that still failed after all of its retries. These are only
+    ever appended, and are replayed in order, per channel, by the
+    replay_interceptor_spool management command.
+    """
+
+    url = models.CharField(
+        max_length=255, help_text="The RapidPro channel URL the request was for"
+    )
+    method = models.CharField(max_length=10)
+    headers = models.JSONField()
+    body = models.TextField()
+    delivery_keys = models.JSONField(null=True)
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [models.Index(fields=["url", "id"])]
+
+
+class SpoolWatermark(models.Model):
+    """
+    The last SpooledRequest that has been replayed for each channel URL
+    """
+
+    url = models.CharField(max_length=255, unique=True)
+    last_replayed_id = models.BigIntegerField(default=0)
+    timestamp = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.url}: {self.last_replayed_id}"
+
+
+@receiver(post_save, sender=Interceptor)
+@receiver(post_delete, sender=Interceptor)
+def invalidate_interceptor_cache(sender, instance, **kwargs):
+    _interceptor_cache.pop(instance.pk, None)
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def invalidate_org_interceptor_cache(sender, instance, **kwargs):
+    for pk, (_, interceptor) in list(_interceptor_cache.items()):
+        if interceptor.org_id == instance.pk:
+            _interceptor_cache.pop(pk, None)
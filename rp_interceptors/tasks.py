@@ -1,11 +1,79 @@
+import inspect
+import json
+from urllib.parse import urljoin, urlparse
+
 import requests
 from celery.exceptions import SoftTimeLimitExceeded
-from requests.exceptions import RequestException
+from django.conf import settings
+from requests.exceptions import HTTPError, RequestException
 
 from config.celery import app
+from rp_interceptors.models import Interceptor, SpooledRequest
+from rp_interceptors.utils import (
+    all_delivered,
+    chunk_status_batch,
+    claim_backlog_drain,
+    claim_status_batch_flush,
+    extend_backlog_drain,
+    generate_hmac_signature,
+    get_backlog_hosts,
+    get_delivery_key,
+    interceptor_circuit_breaker_events,
+    interceptor_duplicates_suppressed,
+    is_circuit_open,
+    mark_delivered,
+    park_request,
+    pop_backlog,
+    pop_status_batch,
+    record_failure,
+    record_success,
+    release_backlog_drain,
+    release_status_batch_flush,
+)
+
+
+def is_host_failure(exc):
+    """
+    Client errors are a problem with the request, not with RapidPro, so they don't
+    count towards opening the circuit breaker
+    """
+    if isinstance(exc, HTTPError) and exc.response is not None:
+        return exc.response.status_code >= 500
+    return True
+
+
+class SpoolOnFailureTask(app.Task):
+    """
+    Once a request has failed all of its retries, write it to the spool so that it
+    isn't lost, and can be replayed later
+    """
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):
+        spool_request(inspect.signature(self.run).bind(*args, **kwargs).arguments)
+
+
+def spool_request(request):
+    SpooledRequest.objects.create(
+        url=request["url"],
+        method=request["method"],
+        headers=request["headers"],
+        body=request["body"],
+        delivery_keys=request.get("delivery_keys"),
+    )
+
+
+def park_or_spool_request(host, request):
+    """
+    Parks the request until the host recovers, or spools it if it has been parked
+    too many times already, or the host's backlog is full
+    """
+    if not park_request(host, request):
+        spool_request(request)
+        interceptor_circuit_breaker_events.labels(event="spooled").inc()
 
 
 @app.task(
+    base=SpoolOnFailureTask,
     autoretry_for=(RequestException, SoftTimeLimitExceeded),
     ignore_result=True,
     retry_backoff=True,
@@ -14,8 +82,143 @@ from config.celery import app
     soft_time_limit=10,
     time_limit=15,
 )
-def http_request(method, url, headers, body):
-    response = requests.request(
-        method=method, url=url, headers=headers, data=body.encode()
+def http_request(method, url, headers, body, delivery_keys=None, parked=0):
+    if all_delivered(delivery_keys):
+        # A previous attempt was delivered, but the task wasn't acked
+        interceptor_duplicates_suppressed.labels(stage="send").inc(len(delivery_keys))
+        return
+
+    host = urlparse(url).netloc
+    request = {
+        "method": method,
+        "url": url,
+        "headers": headers,
+        "body": body,
+        "delivery_keys": delivery_keys,
+        "parked": parked,
+    }
+    if is_circuit_open(host):
+        park_or_spool_request(host, request)
+        return
+
+    try:
+        response = requests.request(
+            method=method, url=url, headers=headers, data=body.encode()
+        )
+        response.raise_for_status()
+    except (RequestException, SoftTimeLimitExceeded) as e:
+        if is_host_failure(e) and record_failure(host):
+            # Don't keep retrying while RapidPro is down, wait for it to recover
+            park_or_spool_request(host, request)
+            return
+        raise
+
+    mark_delivered(delivery_keys)
+    if record_success(host) and claim_backlog_drain(host):
+        drain_backlog.delay(host)
+
+
+def forward_to_rapidpro(interceptor, body, signature=None, delivery_keys=None):
+    """
+    Queues the delivery of the JSON body to the interceptor's RapidPro channel,
+    signing it with the interceptor's secret if no signature is given.
+    delivery_keys are marked as delivered once RapidPro has accepted the body.
+    """
+    if signature is None:
+        signature = generate_hmac_signature(body, interceptor.hmac_secret)
+    path = f"/c/wa/{interceptor.channel_uuid}/receive"
+    http_request.delay(
+        method="POST",
+        url=urljoin(interceptor.org.url, path),
+        headers={
+            "X-Turn-Hook-Signature": signature,
+            "Content-Type": "application/json",
+        },
+        body=body,
+        delivery_keys=delivery_keys,
+    )
+
+
+def schedule_status_batch_flush(interceptor_id, pending):
+    """
+    Flushes the batch straight away if it is full, otherwise makes sure that a flush
+    is scheduled for the end of the current batching window
+    """
+    window = settings.INTERCEPTOR_BATCH_WINDOW
+    if pending >= settings.INTERCEPTOR_BATCH_MAX_COUNT:
+        flush_status_batch.delay(interceptor_id)
+    elif claim_status_batch_flush(interceptor_id, window):
+        flush_status_batch.apply_async(args=(interceptor_id,), countdown=window)
+
+
+@app.task(
+    ignore_result=True,
+    acks_late=True,
+    soft_time_limit=10,
+    time_limit=15,
+)
+def flush_status_batch(interceptor_id):
+    """
+    Coalesces the pending statuses for the interceptor into as few payloads as the
+    size limits allow, and forwards them to RapidPro
+    """
+    release_status_batch_flush(interceptor_id)
+    # Load the interceptor before taking the statuses, so that they're kept if it
+    # can't be loaded
+    interceptor = Interceptor.get_cached(interceptor_id)
+    statuses, pending = pop_status_batch(
+        interceptor_id, settings.INTERCEPTOR_BATCH_MAX_COUNT
     )
-    response.raise_for_status()
+    if pending:
+        schedule_status_batch_flush(interceptor_id, pending)
+    if not statuses:
+        return
+
+    for chunk in chunk_status_batch(statuses, settings.INTERCEPTOR_BATCH_MAX_BYTES):
+        body = '{"statuses":[' + ",".join(chunk) + "]}"
+        delivery_keys = [
+            get_delivery_key(interceptor_id, "statuses", json.loads(status))
+            for status in chunk
+        ]
+        forward_to_rapidpro(
+            interceptor, body, delivery_keys=[key for key in delivery_keys if key]
+        )
+
+
+@app.task(
+    ignore_result=True,
+    acks_late=True,
+    soft_time_limit=10,
+    time_limit=15,
+)
+def drain_backlog(host):
+    """
+    Sends the requests parked while the host's circuit breaker was open, at a rate
+    of INTERCEPTOR_BACKLOG_DRAIN_RATE requests per second. The drain claim is held
+    until the backlog is empty, or the breaker opens again.
+    """
+    if is_circuit_open(host):
+        release_backlog_drain(host)
+        return
+
+    requests, pending = pop_backlog(host, settings.INTERCEPTOR_BACKLOG_DRAIN_RATE)
+    for request in requests:
+        http_request.delay(**request)
+    if requests:
+        interceptor_circuit_breaker_events.labels(event="drained").inc(len(requests))
+    if pending:
+        extend_backlog_drain(host)
+        drain_backlog.apply_async(args=(host,), countdown=1)
+    else:
+        release_backlog_drain(host)
+
+
+@app.task(ignore_result=True)
+def drain_backlogs():
+    """
+    Periodically drains the backlogs of hosts whose circuit breakers have closed,
+    in case no new requests have been sent to them since
+    """
+    for host in get_backlog_hosts():
+        if not is_circuit_open(host) and claim_backlog_drain(host):
+            drain_backlog.delay(host)
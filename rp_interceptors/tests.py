@@ -2,13 +2,27 @@ import base64
 import hmac
 import json
 from hashlib import sha256
+from io import StringIO
+from unittest.mock import patch
 
 import responses
+from django.core.management import call_command
+from django.test.utils import override_settings
 from django.urls import reverse
+from requests.exceptions import HTTPError
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from rp_interceptors.models import Interceptor
+from rp_interceptors.models import Interceptor, SpooledRequest, SpoolWatermark
+from rp_interceptors.tasks import drain_backlog, flush_status_batch, http_request
+from rp_interceptors.utils import (
+    claim_backlog_drain,
+    get_backlog_key,
+    get_breaker_open_key,
+    get_status_batch_key,
+    is_circuit_open,
+    redis_conn,
+)
 from sidekick.tests.utils import create_org
 
 
@@ -17,10 +31,18 @@ def generate_hmac_signature(body: str, secret: str) -> str:
     return base64.b64encode(h.digest()).decode()
 
 
+def clear_interceptor_keys():
+    for key in redis_conn.scan_iter("interceptor_*"):
+        redis_conn.delete(key)
+
+
 class InterceptorViewTests(APITestCase):
     def setUp(self):
         self.org = create_org()
 
+    def tearDown(self):
+        clear_interceptor_keys()
+
     def test_hmac_missing(self):
         """
         If the HMAC secret is configured, and there's no HMAC header, or it's invalid,
@@ -272,3 +294,461 @@ class InterceptorViewTests(APITestCase):
                 call.request.body.decode(), interceptor.hmac_secret
             ),
         )
+
+    @responses.activate
+    def test_unmodified_body_forwarded_as_is(self):
+        """
+        If the request doesn't need to be modified, then the original bytes and
+        signature should be forwarded without being re-serialized
+        """
+        interceptor: Interceptor = Interceptor.objects.create(
+            org=self.org, hmac_secret="test-secret", channel_uuid="1234343212"
+        )
+        url: str = reverse("interceptor-status", args=[interceptor.pk])
+        body = '{"messages": [{"id": "ABGGFmkiWVVPAgo-sKD87hgxPHdF", "type": "text"}]}'
+        signature = generate_hmac_signature(body, interceptor.hmac_secret)
+
+        responses.add(
+            method=responses.POST,
+            url="http://localhost:8002/c/wa/1234343212/receive",
+        )
+
+        response = self.client.post(
+            url,
+            body,
+            content_type="application/json",
+            HTTP_X_TURN_HOOK_SIGNATURE=signature,
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        [call] = responses.calls
+        self.assertEqual(call.request.body.decode(), body)
+        self.assertEqual(call.request.headers["X-Turn-Hook-Signature"], signature)
+
+    def test_invalid_json(self):
+        """
+        If the body is correctly signed but isn't a JSON object, we should return a 400
+        """
+        interceptor: Interceptor = Interceptor.objects.create(
+            org=self.org, hmac_secret="test-secret", channel_uuid="1234343212"
+        )
+        url: str = reverse("interceptor-status", args=[interceptor.pk])
+
+        for body in ["not json", "[]"]:
+            response = self.client.post(
+                url,
+                body,
+                content_type="application/json",
+                HTTP_X_TURN_HOOK_SIGNATURE=generate_hmac_signature(
+                    body, interceptor.hmac_secret
+                ),
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @responses.activate
+    def test_interceptor_cached(self):
+        """
+        Once the interceptor has been looked up, subsequent requests shouldn't query
+        the database, until the interceptor is changed
+        """
+        interceptor: Interceptor = Interceptor.objects.create(
+            org=self.org, hmac_secret="test-secret", channel_uuid="1234343212"
+        )
+        url: str = reverse("interceptor-status", args=[interceptor.pk])
+        data = {"messages": [{"id": "ABGGFmkiWVVPAgo-sKD87hgxPHdF", "type": "text"}]}
+        body = json.dumps(data, separators=(",", ":"))
+        responses.add(
+            method=responses.POST,
+            url="http://localhost:8002/c/wa/1234343212/receive",
+        )
+
+        def post(secret):
+            return self.client.post(
+                url,
+                body,
+                content_type="application/json",
+                HTTP_X_TURN_HOOK_SIGNATURE=generate_hmac_signature(body, secret),
+            )
+
+        self.assertEqual(post("test-secret").status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            self.assertEqual(post("test-secret").status_code, status.HTTP_200_OK)
+
+        interceptor.hmac_secret = "new-secret"
+        interceptor.save()
+        self.assertEqual(post("test-secret").status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(post("new-secret").status_code, status.HTTP_200_OK)
+
+    @responses.activate
+    @override_settings(INTERCEPTOR_DEDUP_TTL=60)
+    def test_duplicate_delivery(self):
+        """
+        If Turn sends us messages or statuses that have already been delivered to
+        RapidPro, they shouldn't be forwarded again
+        """
+        interceptor: Interceptor = Interceptor.objects.create(
+            org=self.org, hmac_secret="test-secret", channel_uuid="1234343212"
+        )
+        url: str = reverse("interceptor-status", args=[interceptor.pk])
+        responses.add(
+            method=responses.POST,
+            url="http://localhost:8002/c/wa/1234343212/receive",
+        )
+
+        def post(data):
+            body = json.dumps(data, separators=(",", ":"))
+            signature = generate_hmac_signature(body, interceptor.hmac_secret)
+            return self.client.post(
+                url, data, format="json", HTTP_X_TURN_HOOK_SIGNATURE=signature
+            )
+
+        message = {"id": "ABGGFmkiWVVPAgo-sKD87hgxPHdF", "type": "text"}
+        sent = {
+            "id": "gBEGRHQnRBM2AglN0MpYOUgzMWo",
+            "recipient_id": "1",
+            "status": "sent",
+        }
+        read = {
+            "id": "gBEGRHQnRBM2AglN0MpYOUgzMWo",
+            "recipient_id": "1",
+            "status": "read",
+        }
+
+        self.assertEqual(post({"messages": [message]}).status_code, 200)
+        self.assertEqual(post({"messages": [message]}).status_code, 200)
+        self.assertEqual(len(responses.calls), 1)
+
+        self.assertEqual(post({"statuses": [sent]}).status_code, 200)
+        self.assertEqual(post({"statuses": [sent, read]}).status_code, 200)
+        self.assertEqual(len(responses.calls), 3)
+        self.assertEqual(
+            json.loads(responses.calls[2].request.body), {"statuses": [read]}
+        )
+
+    @responses.activate
+    @override_settings(INTERCEPTOR_DEDUP_TTL=60)
+    def test_duplicate_delivery_in_task(self):
+        """
+        If the task is retried after the request was delivered, it shouldn't be sent
+        again
+        """
+        responses.add(method=responses.POST, url="http://rapidpro/receive")
+        kwargs = {
+            "method": "POST",
+            "url": "http://rapidpro/receive",
+            "headers": {},
+            "body": "{}",
+            "delivery_keys": ["interceptor_delivered_test"],
+        }
+
+        http_request(**kwargs)
+        http_request(**kwargs)
+        self.assertEqual(len(responses.calls), 1)
+
+
+@override_settings(INTERCEPTOR_BATCH_WINDOW=5)
+class InterceptorBatchingTests(APITestCase):
+    def setUp(self):
+        self.org = create_org()
+        self.interceptor = Interceptor.objects.create(
+            org=self.org, hmac_secret="test-secret", channel_uuid="1234343212"
+        )
+        self.url = reverse("interceptor-status", args=[self.interceptor.pk])
+
+    def tearDown(self):
+        clear_interceptor_keys()
+
+    def post_status(self, status_id):
+        data = {
+            "statuses": [
+                {
+                    "id": status_id,
+                    "recipient_id": "1234567890",
+                    "status": "delivered",
+                    "timestamp": "1680519050",
+                }
+            ]
+        }
+        body = json.dumps(data, separators=(",", ":"))
+        signature = generate_hmac_signature(body, self.interceptor.hmac_secret)
+        return self.client.post(
+            self.url, data, format="json", HTTP_X_TURN_HOOK_SIGNATURE=signature
+        )
+
+    @responses.activate
+    @patch("rp_interceptors.tasks.flush_status_batch.apply_async")
+    def test_statuses_batched(self, mock_apply_async):
+        """
+        Statuses received within the batching window should be forwarded to RapidPro
+        in a single request, with a single flush scheduled for the window
+        """
+        responses.add(
+            method=responses.POST,
+            url="http://localhost:8002/c/wa/1234343212/receive",
+        )
+
+        self.assertEqual(self.post_status("status-1").status_code, 200)
+        self.assertEqual(self.post_status("status-2").status_code, 200)
+        mock_apply_async.assert_called_once_with(
+            args=(self.interceptor.pk,), countdown=5
+        )
+        self.assertEqual(len(responses.calls), 0)
+
+        flush_status_batch(self.interceptor.pk)
+
+        [call] = responses.calls
+        self.assertEqual(
+            [s["id"] for s in json.loads(call.request.body)["statuses"]],
+            ["status-1", "status-2"],
+        )
+        self.assertEqual(
+            call.request.headers["X-Turn-Hook-Signature"],
+            generate_hmac_signature(
+                call.request.body.decode(), self.interceptor.hmac_secret
+            ),
+        )
+
+    @override_settings(INTERCEPTOR_BATCH_MAX_COUNT=2)
+    @patch("rp_interceptors.tasks.flush_status_batch.delay")
+    @patch("rp_interceptors.tasks.flush_status_batch.apply_async")
+    def test_full_batch_flushed_immediately(self, mock_apply_async, mock_delay):
+        """
+        Once the batch reaches the maximum count, it should be flushed without waiting
+        for the window to end
+        """
+        self.post_status("status-1")
+        mock_delay.assert_not_called()
+        self.post_status("status-2")
+        mock_delay.assert_called_once_with(self.interceptor.pk)
+
+    @responses.activate
+    @override_settings(INTERCEPTOR_BATCH_MAX_BYTES=150)
+    @patch("rp_interceptors.tasks.flush_status_batch.apply_async")
+    def test_batch_split_by_size(self, mock_apply_async):
+        """
+        If the batch is larger than the maximum payload size, it should be split into
+        multiple requests
+        """
+        responses.add(
+            method=responses.POST,
+            url="http://localhost:8002/c/wa/1234343212/receive",
+        )
+        self.post_status("status-1")
+        self.post_status("status-2")
+
+        flush_status_batch(self.interceptor.pk)
+
+        self.assertEqual(len(responses.calls), 2)
+
+    @patch("rp_interceptors.tasks.flush_status_batch.apply_async")
+    def test_batch_kept_if_interceptor_not_loaded(self, mock_apply_async):
+        """
+        If the interceptor can't be loaded, the statuses should be kept
+        """
+        self.post_status("status-1")
+
+        with patch.object(Interceptor, "get_cached", side_effect=Exception()):
+            with self.assertRaises(Exception):
+                flush_status_batch(self.interceptor.pk)
+
+        self.assertEqual(redis_conn.llen(get_status_batch_key(self.interceptor.pk)), 1)
+
+    @responses.activate
+    def test_messages_not_batched(self):
+        """
+        Inbound messages should be forwarded immediately
+        """
+        data = {
+            "messages": [
+                {
+                    "text": {"body": "No"},
+                    "from": "16505551234",
+                    "id": "ABGGFmkiWVVPAgo-sKD87hgxPHdF",
+                    "timestamp": "1591210827",
+                    "type": "text",
+                }
+            ]
+        }
+        body = json.dumps(data, separators=(",", ":"))
+        signature = generate_hmac_signature(body, self.interceptor.hmac_secret)
+        responses.add(
+            method=responses.POST,
+            url="http://localhost:8002/c/wa/1234343212/receive",
+            match=[responses.matchers.json_params_matcher(data)],
+        )
+
+        response = self.client.post(
+            self.url, data, format="json", HTTP_X_TURN_HOOK_SIGNATURE=signature
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(responses.calls), 1)
+
+
+@override_settings(INTERCEPTOR_BREAKER_THRESHOLD=2)
+class CircuitBreakerTests(APITestCase):
+    url = "http://rapidpro/c/wa/1234/receive"
+
+    def tearDown(self):
+        clear_interceptor_keys()
+
+    def send(self, body="{}"):
+        return http_request(
+            method="POST", url=self.url, headers={}, body=body, delivery_keys=None
+        )
+
+    @responses.activate
+    def test_breaker_opens_and_drains(self):
+        """
+        After consecutive failures the breaker should open, and requests should be
+        parked instead of retried. Once the host recovers, the parked requests should
+        be sent.
+        """
+        responses.add(method=responses.POST, url=self.url, status=502)
+
+        with self.assertRaises(HTTPError):
+            self.send('{"n":1}')
+        self.assertFalse(is_circuit_open("rapidpro"))
+
+        self.send('{"n":2}')
+        self.assertTrue(is_circuit_open("rapidpro"))
+        self.send('{"n":3}')
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(redis_conn.llen(get_backlog_key("rapidpro")), 2)
+
+        redis_conn.delete(get_breaker_open_key("rapidpro"))
+        responses.replace(responses.POST, self.url, status=200)
+        drain_backlog("rapidpro")
+
+        self.assertEqual(
+            [c.request.body for c in responses.calls[2:]], [b'{"n":2}', b'{"n":3}']
+        )
+        self.assertEqual(redis_conn.llen(get_backlog_key("rapidpro")), 0)
+
+    @override_settings(INTERCEPTOR_BACKLOG_MAX_PARKS=2)
+    def test_parked_too_many_times(self):
+        """
+        Requests that have been parked too many times should be spooled instead
+        """
+        redis_conn.set(get_breaker_open_key("rapidpro"), "1")
+
+        self.send('{"n":1}')
+        [request] = redis_conn.lrange(get_backlog_key("rapidpro"), 0, -1)
+        self.assertEqual(json.loads(request)["parked"], 1)
+
+        http_request(method="POST", url=self.url, headers={}, body='{"n":2}', parked=2)
+        self.assertEqual(redis_conn.llen(get_backlog_key("rapidpro")), 1)
+        [spooled] = SpooledRequest.objects.all()
+        self.assertEqual(spooled.body, '{"n":2}')
+
+    @override_settings(INTERCEPTOR_BACKLOG_MAX_SIZE=2)
+    def test_backlog_full(self):
+        """
+        Once the backlog is full, requests should be spooled instead of parked
+        """
+        redis_conn.set(get_breaker_open_key("rapidpro"), "1")
+
+        for n in range(3):
+            self.send(f'{{"n":{n}}}')
+
+        self.assertEqual(
+            [
+                json.loads(r)["body"]
+                for r in redis_conn.lrange(get_backlog_key("rapidpro"), 0, -1)
+            ],
+            ['{"n":0}', '{"n":1}'],
+        )
+        self.assertEqual(
+            list(SpooledRequest.objects.values_list("body", flat=True)), ['{"n":2}']
+        )
+
+    @responses.activate
+    def test_drain_releases_claim(self):
+        """
+        The drain claim should be held until the backlog has been drained
+        """
+        responses.add(method=responses.POST, url=self.url, status=200)
+        redis_conn.set(get_breaker_open_key("rapidpro"), "1")
+        self.send()
+        redis_conn.delete(get_breaker_open_key("rapidpro"))
+
+        self.assertTrue(claim_backlog_drain("rapidpro"))
+        self.assertFalse(claim_backlog_drain("rapidpro"))
+        drain_backlog("rapidpro")
+
+        self.assertEqual(len(responses.calls), 1)
+        self.assertTrue(claim_backlog_drain("rapidpro"))
+
+    @responses.activate
+    def test_client_errors_dont_open_breaker(self):
+        """
+        4xx responses are a problem with the request rather than the host
+        """
+        responses.add(method=responses.POST, url=self.url, status=400)
+
+        for _ in range(3):
+            with self.assertRaises(HTTPError):
+                self.send()
+        self.assertFalse(is_circuit_open("rapidpro"))
+
+
+class SpoolTests(APITestCase):
+    url = "http://rapidpro/c/wa/1234/receive"
+
+    def tearDown(self):
+        clear_interceptor_keys()
+
+    def test_failed_request_spooled(self):
+        """
+        Once all the retries have failed, the request should be written to the spool
+        """
+        http_request.on_failure(
+            HTTPError(),
+            "task-id",
+            ("POST", self.url),
+            {
+                "headers": {"Content-Type": "application/json"},
+                "body": '{"n":1}',
+                "delivery_keys": ["interceptor_delivered_test"],
+            },
+            None,
+        )
+
+        [request] = SpooledRequest.objects.all()
+        self.assertEqual(request.url, self.url)
+        self.assertEqual(request.method, "POST")
+        self.assertEqual(request.headers, {"Content-Type": "application/json"})
+        self.assertEqual(request.body, '{"n":1}')
+        self.assertEqual(request.delivery_keys, ["interceptor_delivered_test"])
+
+    @responses.activate
+    def test_replay(self):
+        """
+        Spooled requests should be replayed in order, stopping at the first server
+        error, and resuming from there on the next run
+        """
+        for n in range(4):
+            SpooledRequest.objects.create(
+                url=self.url, method="POST", headers={}, body=f'{{"n":{n}}}'
+            )
+        responses.add(method=responses.POST, url=self.url, status=200)
+        responses.add(method=responses.POST, url=self.url, status=400)
+        responses.add(method=responses.POST, url=self.url, status=503)
+
+        call_command("replay_interceptor_spool", workers=1, stdout=StringIO())
+
+        self.assertEqual(len(responses.calls), 3)
+        watermark = SpoolWatermark.objects.get(url=self.url)
+        self.assertEqual(
+            watermark.last_replayed_id,
+            SpooledRequest.objects.order_by("id")[1].id,
+        )
+
+        responses.replace(responses.POST, self.url, status=200)
+        call_command("replay_interceptor_spool", workers=1, stdout=StringIO())
+
+        self.assertEqual(
+            [c.request.body for c in responses.calls],
+            [b'{"n":0}', b'{"n":1}', b'{"n":2}', b'{"n":2}', b'{"n":3}'],
+        )
+        watermark.refresh_from_db()
+        self.assertEqual(watermark.last_replayed_id, SpooledRequest.objects.last().id)
@@ -1,10 +1,277 @@
 import base64
 import hmac
+import json
 from hashlib import sha256
+from typing import Union
 
+import redis
+from django.conf import settings
+from prometheus_client import Counter
 
-def generate_hmac_signature(body: str, secret: str) -> str:
+redis_conn = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+interceptor_duplicates_suppressed = Counter(
+    "interceptor_duplicates_suppressed",
+    "Turn messages and statuses that weren't forwarded because they had already "
+    "been delivered to RapidPro",
+    ["stage"],
+)
+interceptor_circuit_breaker_events = Counter(
+    "interceptor_circuit_breaker_events",
+    "Circuit breaker state changes, and requests parked or spooled while it was open",
+    ["event"],
+)
+
+
+def generate_hmac_signature(body: Union[str, bytes], secret: str) -> str:
     if not body or not secret:
         return ""
-    h = hmac.new(secret.encode(), body.encode(), sha256)
+    if isinstance(body, str):
+        body = body.encode()
+    h = hmac.new(secret.encode(), body, sha256)
     return base64.b64encode(h.digest()).decode()
+
+
+def get_status_batch_key(interceptor_id):
+    return f"interceptor_status_batch_{interceptor_id}"
+
+
+def get_status_batch_flush_key(interceptor_id):
+    return f"interceptor_status_batch_flush_{interceptor_id}"
+
+
+def add_to_status_batch(interceptor_id, statuses):
+    """
+    Appends the already serialized statuses to the interceptor's pending batch, and
+    returns the number of statuses that are now waiting to be delivered.
+    """
+    key = get_status_batch_key(interceptor_id)
+    pipe = redis_conn.pipeline()
+    pipe.rpush(key, *statuses)
+    pipe.llen(key)
+    _, pending = pipe.execute()
+    return pending
+
+
+def claim_status_batch_flush(interceptor_id, window):
+    """
+    Returns True if the caller is responsible for scheduling the next flush of the
+    interceptor's batch, so that only one flush is scheduled per window
+    """
+    return bool(
+        redis_conn.set(
+            get_status_batch_flush_key(interceptor_id),
+            "1",
+            nx=True,
+            ex=max(int(window * 2), 1),
+        )
+    )
+
+
+def release_status_batch_flush(interceptor_id):
+    redis_conn.delete(get_status_batch_flush_key(interceptor_id))
+
+
+def pop_status_batch(interceptor_id, count):
+    """
+    Atomically removes and returns up to `count` of the oldest pending statuses, as
+    well as the number of statuses still pending after that.
+    """
+    key = get_status_batch_key(interceptor_id)
+    pipe = redis_conn.pipeline()
+    pipe.lrange(key, 0, count - 1)
+    pipe.ltrim(key, count, -1)
+    pipe.llen(key)
+    statuses, _, pending = pipe.execute()
+    return statuses, pending
+
+
+def chunk_status_batch(statuses, max_bytes):
+    """
+    Splits the serialized statuses into chunks that, once joined into a single
+    payload, are no larger than max_bytes. A status that is larger than max_bytes on
+    its own is sent in a chunk by itself.
+    """
+    chunk, size = [], 0
+    for status in statuses:
+        length = len(status) + 1
+        if chunk and size + length > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(status)
+        size += length
+    if chunk:
+        yield chunk
+
+
+def get_delivery_key(interceptor_id, kind, item):
+    """
+    Returns the key that marks the Turn message or status as delivered, or None if
+    the item can't be identified. A message goes through multiple statuses, so the
+    status is included in the key for those.
+    """
+    if not isinstance(item, dict) or not item.get("id"):
+        return None
+    if kind == "statuses":
+        return "interceptor_delivered_{}_status_{}_{}".format(
+            interceptor_id, item["id"], item.get("status", "")
+        )
+    return "interceptor_delivered_{}_message_{}".format(interceptor_id, item["id"])
+
+
+def remove_delivered(interceptor_id, kind, items):
+    """
+    Returns the items that haven't been delivered yet, along with their delivery keys
+    """
+    keys = [get_delivery_key(interceptor_id, kind, item) for item in items]
+    known_keys = [key for key in keys if key]
+    delivered = set()
+    if known_keys:
+        delivered = {
+            key
+            for key, value in zip(known_keys, redis_conn.mget(known_keys))
+            if value is not None
+        }
+
+    remaining = [item for item, key in zip(items, keys) if key not in delivered]
+    if delivered:
+        interceptor_duplicates_suppressed.labels(stage="enqueue").inc(
+            len(items) - len(remaining)
+        )
+    return remaining, [key for key in keys if key and key not in delivered]
+
+
+def all_delivered(keys):
+    return bool(keys) and None not in redis_conn.mget(keys)
+
+
+def mark_delivered(keys):
+    if not keys or not settings.INTERCEPTOR_DEDUP_TTL:
+        return
+    pipe = redis_conn.pipeline()
+    for key in keys:
+        pipe.set(key, "1", ex=settings.INTERCEPTOR_DEDUP_TTL)
+    pipe.execute()
+
+
+def get_breaker_failures_key(host):
+    return f"interceptor_breaker_failures_{host}"
+
+
+def get_breaker_open_key(host):
+    return f"interceptor_breaker_open_{host}"
+
+
+def get_backlog_key(host):
+    return f"interceptor_backlog_{host}"
+
+
+BACKLOG_HOSTS_KEY = "interceptor_backlog_hosts"
+# Long enough to cover the delay between the chained drain tasks
+BACKLOG_DRAIN_CLAIM_TTL = 60
+
+
+def is_circuit_open(host):
+    return bool(redis_conn.exists(get_breaker_open_key(host)))
+
+
+def record_failure(host):
+    """
+    Records a failed request to the host, and opens the circuit breaker once there
+    have been enough consecutive failures. Because the failure count is only reset
+    by a successful request, a single failure after the cooldown reopens it.
+
+    Returns True if the breaker is now open.
+    """
+    cooldown = settings.INTERCEPTOR_BREAKER_COOLDOWN
+    key = get_breaker_failures_key(host)
+    pipe = redis_conn.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, cooldown * 2)
+    failures, _ = pipe.execute()
+    if failures < settings.INTERCEPTOR_BREAKER_THRESHOLD:
+        return False
+    if redis_conn.set(get_breaker_open_key(host), "1", nx=True, ex=cooldown):
+        interceptor_circuit_breaker_events.labels(event="opened").inc()
+    return True
+
+
+def record_success(host):
+    """
+    Resets the failure count for the host. Returns True if there are requests parked
+    in the host's backlog that should now be drained.
+    """
+    pipe = redis_conn.pipeline()
+    pipe.delete(get_breaker_failures_key(host))
+    pipe.llen(get_backlog_key(host))
+    _, backlog = pipe.execute()
+    return backlog > 0
+
+
+def park_request(host, request):
+    """
+    Adds the request to the host's backlog, to be sent once the breaker closes.
+
+    Returns False without parking the request if it has already been parked
+    INTERCEPTOR_BACKLOG_MAX_PARKS times, or if the backlog is full.
+    """
+    parked = request.get("parked", 0) + 1
+    if parked > settings.INTERCEPTOR_BACKLOG_MAX_PARKS:
+        return False
+
+    key = get_backlog_key(host)
+    payload = json.dumps(dict(request, parked=parked))
+    pipe = redis_conn.pipeline()
+    pipe.rpush(key, payload)
+    pipe.sadd(BACKLOG_HOSTS_KEY, host)
+    size, _ = pipe.execute()
+    if size > settings.INTERCEPTOR_BACKLOG_MAX_SIZE:
+        redis_conn.lrem(key, -1, payload)
+        return False
+    interceptor_circuit_breaker_events.labels(event="parked").inc()
+    return True
+
+
+def pop_backlog(host, count):
+    """
+    Atomically removes and returns up to `count` of the oldest parked requests for
+    the host, as well as the number still parked after that.
+    """
+    key = get_backlog_key(host)
+    pipe = redis_conn.pipeline()
+    pipe.lrange(key, 0, count - 1)
+    pipe.ltrim(key, count, -1)
+    pipe.llen(key)
+    requests, _, pending = pipe.execute()
+    if not pending:
+        redis_conn.srem(BACKLOG_HOSTS_KEY, host)
+    return [json.loads(request) for request in requests], pending
+
+
+def get_backlog_drain_key(host):
+    return f"interceptor_backlog_drain_{host}"
+
+
+def claim_backlog_drain(host):
+    """
+    Returns True if the caller should start draining the host's backlog, so that
+    only one drain runs at a time. The claim is held until the drain finishes, and
+    only expires in case the drain dies without releasing it.
+    """
+    return bool(
+        redis_conn.set(
+            get_backlog_drain_key(host), "1", nx=True, ex=BACKLOG_DRAIN_CLAIM_TTL
+        )
+    )
+
+
+def extend_backlog_drain(host):
+    redis_conn.expire(get_backlog_drain_key(host), BACKLOG_DRAIN_CLAIM_TTL)
+
+
+def release_backlog_drain(host):
+    redis_conn.delete(get_backlog_drain_key(host))
+
+
+def get_backlog_hosts():
+    return redis_conn.smembers(BACKLOG_HOSTS_KEY)
@@ -1,26 +1,28 @@
 import hmac
 import json
-from urllib.parse import urljoin
 
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from rest_framework.authentication import BaseAuthentication
 from rest_framework.decorators import action
-from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.exceptions import AuthenticationFailed, ParseError
 from rest_framework.response import Response
 from rest_framework.serializers import Serializer
 from rest_framework.viewsets import GenericViewSet
 
 from rp_interceptors.models import Interceptor
-from rp_interceptors.tasks import http_request
-from rp_interceptors.utils import generate_hmac_signature
+from rp_interceptors.tasks import forward_to_rapidpro, schedule_status_batch_flush
+from rp_interceptors.utils import (
+    add_to_status_batch,
+    generate_hmac_signature,
+    remove_delivered,
+)
 
 
 def validate_hmac_signature(secret, signature, body):
     if not secret:
         return
-    if not hmac.compare_digest(
-        generate_hmac_signature(body.decode(), secret), signature or ""
-    ):
+    if not hmac.compare_digest(generate_hmac_signature(body, secret), signature or ""):
         raise AuthenticationFailed("Invalid HMAC signature")
 
 
@@ -37,8 +39,8 @@ class HmacAuthentication(BaseAuthentication):
     def authenticate(self, request):
         try:
             interceptor_pk = request.parser_context["kwargs"]["pk"]
-            interceptor = Interceptor.objects.get(pk=interceptor_pk)
-        except KeyError:
+            interceptor = Interceptor.get_cached(interceptor_pk)
+        except (KeyError, ValueError):
             raise AuthenticationFailed("No Interceptor found")
         except Interceptor.DoesNotExist:
             raise AuthenticationFailed("No Interceptor found")
@@ -64,33 +66,80 @@ class InterceptorViewSet(GenericViewSet):
 
     @action(detail=True, methods=["POST"])
     def status(self, request, pk=None):
-        interceptor = self.get_object()
+        interceptor = request.user.interceptor
 
-        if "statuses" in request.data:
+        # The signature has already been verified against the raw body, so we parse
+        # it ourselves once, rather than letting DRF parse it again
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            raise ParseError("Invalid JSON body")
+        if not isinstance(data, dict):
+            raise ParseError("Invalid JSON body")
+
+        modified = False
+        if "statuses" in data:
             statuses = []
-            for status in request.data.get("statuses", []):
+            for status in data.get("statuses", []):
                 if "recipient_id" not in status and "message" in status:
                     status["recipient_id"] = status["message"].get("recipient_id", "")
+                    modified = True
 
                 if status != {}:
                     statuses.append(status)
+                else:
+                    modified = True
+
+            data["statuses"] = statuses
+
+        delivery_keys = []
+        if settings.INTERCEPTOR_DEDUP_TTL:
+            duplicates = False
+            for kind in ("messages", "statuses"):
+                if isinstance(data.get(kind), list):
+                    items, keys = remove_delivered(interceptor.pk, kind, data[kind])
+                    if len(items) != len(data[kind]):
+                        data[kind] = items
+                        duplicates = modified = True
+                    delivery_keys += keys
+            if duplicates and not data.get("messages") and not data.get("statuses"):
+                return Response()
+
+        if data.get("statuses") == [] and data.get("messages") == []:
+            return Response()
 
-            request.data["statuses"] = statuses
-
-        if request.data.get("statuses") == [] and request.data.get("messages") == []:
+        if settings.INTERCEPTOR_BATCH_WINDOW and self.is_status_only(data):
+            statuses = [
+                json.dumps(status, separators=(",", ":")) for status in data["statuses"]
+            ]
+            if statuses:
+                pending = add_to_status_batch(interceptor.pk, statuses)
+                schedule_status_batch_flush(interceptor.pk, pending)
             return Response()
 
-        body = json.dumps(request.data, separators=(",", ":"))
-        path = f"/c/wa/{interceptor.channel_uuid}/receive"
-        http_request.delay(
-            method="POST",
-            url=urljoin(interceptor.org.url, path),
-            headers={
-                "X-Turn-Hook-Signature": generate_hmac_signature(
-                    body, interceptor.hmac_secret
-                ),
-                "Content-Type": "application/json",
-            },
-            body=body,
-        )
+        if modified:
+            forward_to_rapidpro(
+                interceptor,
+                json.dumps(data, separators=(",", ":")),
+                delivery_keys=delivery_keys,
+            )
+        else:
+            # Nothing changed, so the original body and signature are still valid
+            signature = None
+            if interceptor.hmac_secret:
+                signature = request.META["HTTP_X_TURN_HOOK_SIGNATURE"]
+            forward_to_rapidpro(
+                interceptor, request.body.decode(), signature, delivery_keys
+            )
         return Response()
+
+    @staticmethod
+    def is_status_only(data):
+        """
+        Only status updates are batched, inbound messages are forwarded immediately
+        """
+        return (
+            "statuses" in data
+            and not data.get("messages")
+            and set(data.keys()) <= {"statuses", "messages"}
+        )
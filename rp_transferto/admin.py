@@ -1,5 +1,7 @@
 from django.contrib import admin
 
-from .models import TransferToAccount
+from .models import ProductFallbackChain, TopupBatch, TransferToAccount
 
 admin.site.register(TransferToAccount)
+admin.site.register(TopupBatch)
+admin.site.register(ProductFallbackChain)
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.16 on 2026-10-19 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rp_transferto", "0005_alter_msisdninformation_data_and_more"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="msisdninformation",
+            index=models.Index(
+                fields=["msisdn", "-timestamp"], name="msisdninfo_msisdn_latest"
+            ),
+        ),
+    ]
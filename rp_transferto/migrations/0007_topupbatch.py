@@ -0,0 +1,60 @@
+# Generated by Django 4.2.16 on 2026-10-19 17:37
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sidekick", "0014_organization_contentrepo_token_and_more"),
+        ("rp_transferto", "0006_msisdninformation_latest_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TopupBatch",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("C", "CREATED"), ("R", "RUNNING"), ("D", "DONE")],
+                        default="C",
+                        max_length=1,
+                    ),
+                ),
+                ("simulate", models.BooleanField(default=False)),
+                ("timestamp", models.DateTimeField(default=django.utils.timezone.now)),
+                ("started_at", models.DateTimeField(null=True)),
+                ("finished_at", models.DateTimeField(null=True)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="topup_batches",
+                        to="sidekick.organization",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="topupattempt",
+            name="batch",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="attempts",
+                to="rp_transferto.topupbatch",
+            ),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.16 on 2026-10-19 17:48
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_default_chain(apps, schema_editor):
+    """
+    The fallback products that used to be hardcoded, for 100MB of data in ZAR
+    """
+    ProductFallbackChain = apps.get_model("rp_transferto", "ProductFallbackChain")
+    ProductFallbackChain.objects.create(
+        name="100MB ZAR", product_ids=[1194, 1601, 1630], org=None
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sidekick", "0014_organization_contentrepo_token_and_more"),
+        ("rp_transferto", "0007_topupbatch"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductFallbackChain",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=200)),
+                ("product_ids", models.JSONField(default=list)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="product_fallback_chains",
+                        to="sidekick.organization",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(create_default_chain, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.16 on 2026-10-19 18:05
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("sidekick", "0014_organization_contentrepo_token_and_more"),
+        ("rp_transferto", "0008_productfallbackchain"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MsisdnLookupBatch",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("C", "CREATED"), ("R", "RUNNING"), ("D", "DONE")],
+                        default="C",
+                        max_length=1,
+                    ),
+                ),
+                ("msisdns", models.JSONField(default=list)),
+                ("errors", models.JSONField(default=dict)),
+                ("timestamp", models.DateTimeField(default=django.utils.timezone.now)),
+                ("started_at", models.DateTimeField(null=True)),
+                ("finished_at", models.DateTimeField(null=True)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="msisdn_lookup_batches",
+                        to="sidekick.organization",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -1,12 +1,14 @@
 import json
+from datetime import timedelta
 
 import pkg_resources
+from django.conf import settings
 from django.db import models
-from django.db.models import JSONField
+from django.db.models import Exists, JSONField, OuterRef, Q
 from django.utils import timezone
 
 from sidekick.models import Organization
-from sidekick.utils import clean_msisdn
+from sidekick.utils import clean_msisdn, get_http_session
 
 from .utils import TransferToClient
 
@@ -37,8 +39,106 @@ class MsisdnInformation(models.Model):
         self.msisdn = clean_msisdn(self.msisdn)
         super().save(*args, **kwargs)
 
+    @property
+    def is_stale(self):
+        """
+        Whether this info is older than TRANSFERTO_MSISDN_INFO_TTL, and should be
+        refreshed
+        """
+        age = timezone.now() - self.timestamp
+        return age > timedelta(seconds=settings.TRANSFERTO_MSISDN_INFO_TTL)
+
+    @classmethod
+    def get_latest(cls, msisdn):
+        """
+        Returns the latest info for the MSISDN, or None if there isn't any
+        """
+        return (
+            cls.objects.filter(msisdn=clean_msisdn(msisdn))
+            .order_by("-timestamp", "-id")
+            .first()
+        )
+
+    @classmethod
+    def get_latest_for(cls, msisdns, chunk_size=1000):
+        """
+        Returns a dict of the latest info for each of the (cleaned) MSISDNs that
+        have info
+        """
+        latest = {}
+        for start in range(0, len(msisdns), chunk_size):
+            end = start + chunk_size
+            infos = cls.objects.filter(msisdn__in=msisdns[start:end])
+            for info in infos.order_by("timestamp", "id").iterator():
+                latest[info.msisdn] = info
+        return latest
+
+    @classmethod
+    def get_superseded(cls):
+        """
+        Returns a queryset of all the info that has been replaced by newer info for
+        its MSISDN. Error responses don't replace older info.
+        """
+        newer = (
+            cls.objects.filter(msisdn=OuterRef("msisdn"))
+            .filter(
+                Q(timestamp__gt=OuterRef("timestamp"))
+                | Q(timestamp=OuterRef("timestamp"), id__gt=OuterRef("id"))
+            )
+            .filter(Q(data__error_code="0") | ~Q(data__has_key="error_code"))
+        )
+        return cls.objects.filter(Exists(newer))
+
     class Meta:
         get_latest_by = "timestamp"
+        indexes = [
+            models.Index(
+                fields=["msisdn", "-timestamp"], name="msisdninfo_msisdn_latest"
+            )
+        ]
+
+
+class MsisdnLookupBatch(models.Model):
+    """
+    A bulk lookup of MSISDN info that is too large to do during the request, so is
+    done in the background
+    """
+
+    CREATED = "C"
+    RUNNING = "R"
+    DONE = "D"
+    STATUSES = ((CREATED, "CREATED"), (RUNNING, "RUNNING"), (DONE, "DONE"))
+    status = models.CharField(max_length=1, choices=STATUSES, default=CREATED)
+    msisdns = JSONField(default=list)
+    # MSISDN -> error response, for lookups that failed
+    errors = JSONField(default=dict)
+    org = models.ForeignKey(
+        Organization,
+        related_name="msisdn_lookup_batches",
+        null=False,
+        on_delete=models.CASCADE,
+    )
+    timestamp = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def get_summary(self):
+        """
+        Returns the status of the batch, and the results once it is done
+        """
+        summary = {
+            "id": self.id,
+            "status": dict(self.STATUSES)[self.status],
+            "total": len(self.msisdns),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == self.DONE:
+            results = dict(self.errors)
+            for msisdn, info in MsisdnInformation.get_latest_for(self.msisdns).items():
+                results[msisdn] = info.data
+            summary["results"] = results
+        return summary
 
 
 class TransferToAccount(models.Model):
@@ -54,12 +154,105 @@ class TransferToAccount(models.Model):
     )
 
     def get_transferto_client(self):
-        return TransferToClient(self.login, self.token, self.apikey, self.apisecret)
+        return TransferToClient(
+            self.login,
+            self.token,
+            self.apikey,
+            self.apisecret,
+            account_id=self.id,
+            session=get_http_session("transferto", self.id),
+        )
 
     def __str__(self):
         return self.login
 
 
+class ProductFallbackChain(models.Model):
+    """
+    Products that can be bought instead of each other, in the order that they
+    should be tried, when the product that was asked for isn't available. Chains
+    without an org apply to all orgs.
+    """
+
+    name = models.CharField(max_length=200)
+    product_ids = JSONField(default=list)
+    org = models.ForeignKey(
+        Organization,
+        related_name="product_fallback_chains",
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+    )
+
+    @classmethod
+    def get_fallbacks(cls, org_id, product_id):
+        """
+        Returns the products to try, in order, if the product isn't available. The
+        org's own chains take precedence over the chains for all orgs.
+        """
+        chains = cls.objects.filter(Q(org_id=org_id) | Q(org=None)).order_by(
+            models.F("org_id").asc(nulls_last=True), "id"
+        )
+        for chain in chains:
+            if product_id in chain.product_ids:
+                return [p for p in chain.product_ids if p != product_id]
+        return []
+
+    def __str__(self):
+        return self.name
+
+
+class TopupBatch(models.Model):
+    """
+    A batch of TopupAttempts that are disbursed together, eg. for incentive payouts
+    """
+
+    CREATED = "C"
+    RUNNING = "R"
+    DONE = "D"
+    STATUSES = ((CREATED, "CREATED"), (RUNNING, "RUNNING"), (DONE, "DONE"))
+    status = models.CharField(max_length=1, choices=STATUSES, default=CREATED)
+    simulate = models.BooleanField(default=False)
+    org = models.ForeignKey(
+        Organization,
+        related_name="topup_batches",
+        null=False,
+        on_delete=models.CASCADE,
+    )
+    timestamp = models.DateTimeField(default=timezone.now)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def get_summary(self):
+        """
+        Returns the status of the batch, the number of attempts in each status, and
+        the throughput in attempts per second
+        """
+        counts = dict(
+            self.attempts.values_list("status").annotate(count=models.Count("id"))
+        )
+        statuses = dict(TopupAttempt.STATUSES)
+        completed = counts.get(TopupAttempt.SUCEEDED, 0) + counts.get(
+            TopupAttempt.FAILED, 0
+        )
+        throughput = None
+        if self.started_at:
+            elapsed = (self.finished_at or timezone.now()) - self.started_at
+            if elapsed.total_seconds() > 0:
+                throughput = completed / elapsed.total_seconds()
+
+        return {
+            "id": self.id,
+            "status": dict(self.STATUSES)[self.status],
+            "simulate": self.simulate,
+            "total": sum(counts.values()),
+            "attempts": {statuses[key]: count for key, count in counts.items()},
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "throughput": throughput,
+        }
+
+
 class TopupAttempt(models.Model):
     sidekick_version = models.CharField(max_length=50, null=False, blank=False)
     msisdn = models.CharField(max_length=30, null=False, blank=False)
@@ -85,6 +278,18 @@ class TopupAttempt(models.Model):
         on_delete=models.CASCADE,
     )
     timestamp = models.DateTimeField(default=timezone.now)
+    batch = models.ForeignKey(
+        TopupBatch,
+        related_name="attempts",
+        null=True,
+        on_delete=models.CASCADE,
+    )
+
+    @classmethod
+    def get_status_for_response(cls, response):
+        if "error_code" in response and response["error_code"] in ["0", 0]:
+            return cls.SUCEEDED
+        return cls.FAILED
 
     def make_request(self):
         transferto_client = self.org.transferto_account.first().get_transferto_client()
@@ -103,13 +308,7 @@ class TopupAttempt(models.Model):
 
         # update status based on response field
         if isinstance(self.response, dict):
-            if "error_code" in self.response and self.response["error_code"] in [
-                "0",
-                0,
-            ]:
-                self.status = self.SUCEEDED
-            else:
-                self.status = self.FAILED
+            self.status = self.get_status_for_response(self.response)
 
         self.sidekick_version = pkg_resources.get_distribution("rp-sidekick").version
         self.msisdn = clean_msisdn(self.msisdn)
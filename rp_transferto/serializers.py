@@ -0,0 +1,22 @@
+from rest_framework import serializers
+
+
+class TopupRecipientSerializer(serializers.Serializer):
+    msisdn = serializers.CharField(max_length=30)
+    amount = serializers.IntegerField(min_value=1)
+    # Blank values are allowed, since CSV uploads have empty cells for them
+    from_string = serializers.CharField(
+        max_length=200, required=False, allow_blank=True
+    )
+    user_uuid = serializers.CharField(max_length=200, required=False, allow_blank=True)
+
+
+class TopupBatchSerializer(serializers.Serializer):
+    """
+    Serializer for a batch of airtime topups. from_string is used for recipients
+    that don't have their own.
+    """
+
+    recipients = TopupRecipientSerializer(many=True, allow_empty=False)
+    from_string = serializers.CharField(max_length=200, default="")
+    simulate = serializers.BooleanField(default=False)
@@ -1,23 +1,56 @@
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pkg_resources
 from celery.utils.log import get_task_logger
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
-from django.core.mail import EmailMessage, send_mail
+from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.html import strip_tags
 from json2html import json2html
 
 from config.celery import app
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import (
+    get_prefix_operator,
+    learn_operator_prefixes,
+    resolve_operator,
+)
 from sidekick.models import Organization
-from sidekick.utils import clean_msisdn, get_flow_url, start_flow
-
-from .models import MsisdnInformation, TopupAttempt
+from sidekick.utils import get_flow_url, log_event, log_payload, start_flow
+
+from .models import (
+    MsisdnInformation,
+    MsisdnLookupBatch,
+    ProductFallbackChain,
+    TopupAttempt,
+    TopupBatch,
+    TransferToAccount,
+)
+from .utils import (
+    claim_msisdn_refresh,
+    claim_msisdn_refreshes,
+    get_failure_notification_orgs,
+    get_failure_notifications,
+    get_unavailable_products,
+    is_error_response,
+    mark_product_unavailable,
+    normalize_recharge_value,
+    queue_failure_notification,
+    refresh_catalogue_entry,
+    remove_failure_notifications,
+    transferto_product_fallbacks,
+)
 
 log = get_task_logger(__name__)
 
+SIDEKICK_VERSION = pkg_resources.get_distribution("rp-sidekick").version
+
+# The topup status for a product that isn't available for the MSISDN
+PRODUCT_UNAVAILABLE_STATUS = "1000204"
+
 
 def take_action(
     org, user_uuid, values_to_update=None, call_result=None, flow_start=None
@@ -64,47 +97,68 @@ def update_values(org, user_uuid, values_to_update, transferto_response):
     rapidpro_client.update_contact(user_uuid, fields=fields)
 
 
+def get_cached_operator_id(msisdn):
+    """
+    Returns the operator for the MSISDN from the stored MSISDN info or the prefix
+    table, without making any requests to TransferTo
+    """
+    msisdn_object = MsisdnInformation.get_latest(msisdn)
+    # Error responses don't include an operator
+    if msisdn_object is not None and msisdn_object.data.get("operatorid"):
+        return int(msisdn_object.data["operatorid"])
+    return get_prefix_operator(OperatorPrefix.Provider.TRANSFERTO, msisdn)
+
+
+def find_product(transferto_client, operator_id, recharge_value):
+    """
+    Returns the operator's fixed value recharge for the recharge value, or None if
+    the operator doesn't have one, using the product index. The normalized
+    recharge value must match exactly, so that eg. "1GB" doesn't match "11GB".
+    """
+    index = transferto_client.get_operator_product_index(operator_id)
+    return index.get(normalize_recharge_value(recharge_value))
+
+
 @app.task()
 def topup_data(org_id, msisdn, user_uuid, recharge_value, *args, **kwargs):
     org = Organization.objects.get(id=org_id)
     transferto_client = org.transferto_account.first().get_transferto_client()
     # get msisdn number info
-    try:
-        msisdn_object = MsisdnInformation.objects.filter(
-            msisdn=clean_msisdn(msisdn)
-        ).latest()
+    msisdn_object = MsisdnInformation.get_latest(msisdn)
+    operator_id = None
+    if msisdn_object is not None:
         # use dict to make a copy of the info
         operator_id_info = dict(msisdn_object.data)
-    except ObjectDoesNotExist:
-        operator_id_info = transferto_client.get_misisdn_info(msisdn)
-
-    log.info(json.dumps(operator_id_info, indent=2))
-
-    # extract the user's operator ID
-    operator_id = int(operator_id_info["operatorid"])
-
-    # check the product available and id
-    available_products = transferto_client.get_operator_products(operator_id)
-    log.info(json.dumps(available_products, indent=2))
-
-    # TODO: refactor
-    product_description = None
-    product_id = None
-    for product in available_products["fixed_value_recharges"]:
-        product_name = product["product_short_desc"]
-        if recharge_value in product_name:
-            product_id = product["product_id"]
-            product_description = product["product_short_desc"]
-            break
+        log_payload(log, "msisdn_info", operator_id_info, msisdn=msisdn)
+        if msisdn_object.is_stale:
+            refresh_msisdn_information.delay(org_id, msisdn_object.msisdn)
+        # Error responses don't include an operator
+        if operator_id_info.get("operatorid"):
+            operator_id = int(operator_id_info["operatorid"])
+    if operator_id is None:
+
+        def lookup_operator_id(msisdn):
+            operator_id_info = transferto_client.get_misisdn_info(msisdn)
+            log_payload(log, "msisdn_info", operator_id_info, msisdn=msisdn)
+            return int(operator_id_info["operatorid"])
+
+        operator_id = resolve_operator(
+            OperatorPrefix.Provider.TRANSFERTO, msisdn, lookup_operator_id
+        )
 
-    log.info("product_id: {}".format(product_id))
-    log.info("product_description: {}".format(product_description))
+    product = find_product(transferto_client, operator_id, recharge_value)
+    product_id = product["product_id"] if product else None
 
-    topup_result = transferto_client.topup_data(msisdn, product_id, simulate=False)
+    log_event(
+        log,
+        "product",
+        product_id=product_id,
+        product_description=product["product_short_desc"] if product else None,
+    )
 
-    log.info(json.dumps(topup_result, indent=2))
+    topup_result = transferto_client.topup_data(msisdn, product_id, simulate=False)
 
-    product_id = product["product_id"]
+    log_payload(log, "topup_result", topup_result, msisdn=msisdn)
 
     # update RapidPro with those values
 
@@ -128,54 +182,57 @@ def buy_product_take_action(
     Note: operates under the assumption that org_id is valid and has transferto account
     """
     name = "rp_transferto.tasks.buy_product_take_action"
-    log.info(
-        json.dumps(
-            dict(
-                sidekick_version=pkg_resources.get_distribution("rp-sidekick").version,
-                name=name,
-                org_id=org_id,
-                msisdn=msisdn,
-                product_id=product_id,
-                user_uuid=user_uuid,
-                values_to_update=values_to_update,
-                flow_start=flow_start,
-            ),
-            indent=2,
-        )
+    log_event(
+        log,
+        name,
+        sidekick_version=SIDEKICK_VERSION,
+        org_id=org_id,
+        msisdn=msisdn,
+        product_id=product_id,
+        user_uuid=user_uuid,
+        values_to_update=values_to_update,
+        flow_start=flow_start,
     )
     org = Organization.objects.get(id=org_id)
     transferto_client = org.transferto_account.first().get_transferto_client()
 
     purchase_result = transferto_client.topup_data(msisdn, product_id, simulate=False)
 
-    log.info(json.dumps(purchase_result, indent=2))
+    log_payload(log, "purchase_result", purchase_result, msisdn=msisdn)
 
     if purchase_result["status"] != "0":
-        # HANDLE USE CASE FOR 100MB in ZAR
-        if purchase_result["status"] == "1000204" and product_id in [1194, 1601, 1630]:
-            log.info("{} failed, attempting fallback".format(product_id))
-            remaining_options = [1194, 1601, 1630]
-            remaining_options.remove(product_id)
-
-            for option in remaining_options:
-                log.info(
-                    json.dumps(
-                        dict(
-                            name=name,
-                            msisdn=msisdn,
-                            product_id=option,
-                            user_uuid=user_uuid,
-                            values_to_update=values_to_update,
-                            flow_start=flow_start,
-                        ),
-                        indent=2,
-                    )
+        fallbacks = ProductFallbackChain.get_fallbacks(org_id, product_id)
+        if purchase_result["status"] == PRODUCT_UNAVAILABLE_STATUS and fallbacks:
+            log_event(log, "product_fallback", msisdn=msisdn, product_id=product_id)
+            operator_id = get_cached_operator_id(msisdn)
+            unavailable = set()
+            if operator_id:
+                mark_product_unavailable(operator_id, product_id)
+                unavailable = get_unavailable_products(operator_id, fallbacks)
+
+            tried = []
+            for option in fallbacks:
+                if option in unavailable:
+                    transferto_product_fallbacks.labels(result="skipped").inc()
+                    continue
+                tried.append(option)
+                log_event(
+                    log,
+                    name,
+                    msisdn=msisdn,
+                    product_id=option,
+                    user_uuid=user_uuid,
+                    values_to_update=values_to_update,
+                    flow_start=flow_start,
                 )
                 retry_purchase_result = transferto_client.topup_data(
                     msisdn, option, simulate=False
                 )
-                log.info(json.dumps(retry_purchase_result, indent=2))
+                log_payload(
+                    log, "purchase_result", retry_purchase_result, msisdn=msisdn
+                )
                 if retry_purchase_result["status"] == "0":
+                    transferto_product_fallbacks.labels(result="bought").inc()
                     if user_uuid:
                         take_action(
                             org,
@@ -185,42 +242,44 @@ def buy_product_take_action(
                             flow_start=flow_start,
                         )
                     return None
-            subject = "FAILURE WITH RETRIES: {} {}".format(name, timezone.now())
-            message = (
-                "{}\n"
-                "-------\n"
-                "user_uuid: {}\n"
-                "values_to_update:{}\n"
-                "flow_start: {}\n"
-                "also tried: {}"
-            ).format(
-                json.dumps(purchase_result, indent=2),
-                user_uuid,
-                json.dumps(values_to_update, indent=2),
-                flow_start,
-                remaining_options,
+                transferto_product_fallbacks.labels(result="failed").inc()
+                if (
+                    operator_id
+                    and retry_purchase_result["status"] == PRODUCT_UNAVAILABLE_STATUS
+                ):
+                    mark_product_unavailable(operator_id, option)
+
+            queue_failure_notification(
+                org_id,
+                {
+                    "task_name": name,
+                    "summary": "FAILURE WITH RETRIES",
+                    "timestamp": timezone.now().isoformat(),
+                    "details": {
+                        "purchase_result": purchase_result,
+                        "user_uuid": user_uuid,
+                        "values_to_update": values_to_update,
+                        "flow_start": flow_start,
+                        "also_tried": tried,
+                    },
+                },
             )
-            from_string = "celery@rp-sidekick.prd.mhealthengagementlab.org"
-            email = EmailMessage(subject, message, from_string, [org.point_of_contact])
-            email.send()
             return None
 
-        subject = "FAILURE: {}".format(name)
-        message = (
-            "{}\n"
-            "-------\n"
-            "user_uuid: {}\n"
-            "values_to_update:{}\n"
-            "flow_start: {}"
-        ).format(
-            json.dumps(purchase_result, indent=2),
-            user_uuid,
-            json.dumps(values_to_update, indent=2),
-            flow_start,
+        queue_failure_notification(
+            org_id,
+            {
+                "task_name": name,
+                "summary": "FAILURE",
+                "timestamp": timezone.now().isoformat(),
+                "details": {
+                    "purchase_result": purchase_result,
+                    "user_uuid": user_uuid,
+                    "values_to_update": values_to_update,
+                    "flow_start": flow_start,
+                },
+            },
         )
-        from_string = "celery@rp-sidekick.prd.mhealthengagementlab.org"
-        email = EmailMessage(subject, message, from_string, [org.point_of_contact])
-        email.send()
 
     else:
         if user_uuid:
@@ -248,7 +307,9 @@ def buy_airtime_take_action(
     topup_attempt.make_request()
 
     topup_attempt.refresh_from_db()
-    log.info(json.dumps(topup_attempt.response, indent=2))
+    log_payload(
+        log, "topup_response", topup_attempt.response, topup_attempt=topup_attempt.id
+    )
 
     # take action
     topup_attempt_failed = topup_attempt.status == TopupAttempt.FAILED
@@ -329,56 +390,257 @@ def buy_airtime_take_action(
             and topup_attempt.org.point_of_contact
         )
         if can_send_email:
-            context = {
-                "org_name": topup_attempt.org.name,
-                "task_name": name,
-                "topup_attempt_failed": topup_attempt_failed,
-                "topup_attempt": json2html.convert(json.loads(topup_attempt.__str__())),
-                "values_to_update": json2html.convert(values_to_update),
-                "flow_start": (
-                    get_flow_url(topup_attempt.org, flow_start) if flow_start else None
-                ),
-                "fail_flow_start": (
-                    get_flow_url(topup_attempt.org, fail_flow_start)
-                    if fail_flow_start
-                    else None
-                ),
-                "should_update_fields": should_update_fields,
-                "should_start_success_flow": should_start_success_flow,
-                "should_start_fail_flow": should_start_fail_flow,
-            }
+            details = {"topup": "FAILED" if topup_attempt_failed else "SUCCEEDED"}
             if should_update_fields:
-                context.update(
-                    {
-                        "update_fields_successful": update_fields_successful,
-                        "update_fields_exception": update_fields_exception,
-                    }
+                details["update_fields"] = (
+                    "SUCCEEDED"
+                    if update_fields_successful
+                    else f"FAILED: {update_fields_exception}"
                 )
-
+            if flow_start:
+                details["flow_start"] = get_flow_url(topup_attempt.org, flow_start)
             if should_start_success_flow:
-                context.update(
-                    {
-                        "success_flow_started": success_flow_started,
-                        "success_flow_started_exception": success_flow_started_exception,
-                    }
+                details["start_success_flow"] = (
+                    "SUCCEEDED"
+                    if success_flow_started
+                    else f"FAILED: {success_flow_started_exception}"
+                )
+            if fail_flow_start:
+                details["fail_flow_start"] = get_flow_url(
+                    topup_attempt.org, fail_flow_start
                 )
-
             if should_start_fail_flow:
-                context.update(
-                    {
-                        "fail_flow_started": fail_flow_started,
-                        "fail_flow_started_exception": fail_flow_started_exception,
-                    }
+                details["start_fail_flow"] = (
+                    "SUCCEEDED"
+                    if fail_flow_started
+                    else f"FAILED: {fail_flow_started_exception}"
                 )
-            html_message = render_to_string(
-                "rp_transferto/topup_airtime_take_action_email.html", context
+            details["topup_attempt"] = json.loads(topup_attempt.__str__())
+            details["values_to_update"] = values_to_update
+
+            queue_failure_notification(
+                topup_attempt.org_id,
+                {
+                    "task_name": name,
+                    "summary": "FAILURE",
+                    "timestamp": timezone.now().isoformat(),
+                    "details": details,
+                },
             )
+        else:
+            raise Exception("Error From TransferTo")
+
+
+@app.task(ignore_result=True)
+def send_failure_digests():
+    """
+    Sends each org one email with the failures queued for it since the last digest,
+    so that an outage doesn't send an email for every failed topup. Failures are
+    only removed once their email is sent, so they are retried in the next digest
+    if sending fails.
+    """
+    for org_id in get_failure_notification_orgs():
+        notifications, count = get_failure_notifications(org_id)
+        org = Organization.objects.filter(id=org_id).first()
+        # The notifications can be missing even though failures were counted, so
+        # the digest is still sent with just the count
+        if not count or org is None or not org.point_of_contact:
+            remove_failure_notifications(org_id, notifications, count)
+            continue
+
+        for notification in notifications:
+            notification["details"] = json2html.convert(notification["details"])
+        html_message = render_to_string(
+            "rp_transferto/failure_digest_email.html",
+            {"org_name": org.name, "count": count, "notifications": notifications},
+        )
+        try:
             send_mail(
-                subject="FAILURE: {}".format(name),
+                subject="FAILURES: {} topup failures for {}".format(count, org.name),
                 message=strip_tags(html_message),
                 from_email="celery@rp-sidekick.prd.mhealthengagementlab.org",
-                recipient_list=[topup_attempt.org.point_of_contact],
+                recipient_list=[org.point_of_contact],
                 html_message=html_message,
             )
-        else:
-            raise Exception("Error From TransferTo")
+        except Exception:
+            log.exception("Failed to send the failure digest for org %s", org_id)
+            continue
+        remove_failure_notifications(org_id, notifications, count)
+
+
+@app.task(ignore_result=True)
+def refresh_transferto_catalogue(account_id, method_name, args):
+    account = TransferToAccount.objects.get(id=account_id)
+    refresh_catalogue_entry(account.get_transferto_client(), method_name, args)
+
+
+@app.task(ignore_result=True)
+def refresh_msisdn_information(org_id, msisdn):
+    """
+    Replaces stale MSISDN info with a fresh lookup from TransferTo
+    """
+    if not claim_msisdn_refresh(msisdn):
+        return
+    org = Organization.objects.get(id=org_id)
+    client = org.transferto_account.first().get_transferto_client()
+    info = client.get_misisdn_info(msisdn)
+    if not is_error_response(info):
+        MsisdnInformation.objects.create(msisdn=msisdn, data=info)
+
+
+@app.task(ignore_result=True)
+def refresh_bulk_msisdn_information(org_id, msisdns):
+    """
+    Refreshes the stale info for the MSISDNs of a bulk lookup, in one task rather
+    than one per MSISDN. MSISDNs that are already being refreshed are skipped.
+    """
+    msisdns = claim_msisdn_refreshes(msisdns)
+    if not msisdns:
+        return
+    org = Organization.objects.get(id=org_id)
+    client = org.transferto_account.first().get_transferto_client()
+    lookup_msisdn_information(client, msisdns)
+
+
+@app.task(ignore_result=True)
+def prune_msisdn_information(batch_size=10000):
+    """
+    Deletes all MSISDN info that has been superseded by newer info for the same
+    MSISDN, in batches to avoid long running transactions
+    """
+    superseded = MsisdnInformation.get_superseded()
+    while True:
+        ids = list(superseded.values_list("id", flat=True)[:batch_size])
+        if not ids:
+            break
+        MsisdnInformation.objects.filter(id__in=ids).delete()
+
+
+@app.task(ignore_result=True)
+def learn_transferto_operator_prefixes():
+    """
+    Rebuilds the TransferTo operator prefix table from the cached MSISDN info
+    """
+    observations = (
+        MsisdnInformation.objects.filter(data__has_key="operatorid")
+        .values_list("msisdn", "data__operatorid")
+        .iterator()
+    )
+    learn_operator_prefixes(
+        OperatorPrefix.Provider.TRANSFERTO,
+        ((msisdn, int(operator_id)) for msisdn, operator_id in observations),
+    )
+
+
+def lookup_msisdn_information(client, msisdns, chunk_size=1000):
+    """
+    Looks up the info for the MSISDNs from TransferTo, using
+    TRANSFERTO_BULK_LOOKUP_WORKERS concurrent requests, and returns it by MSISDN.
+
+    A lookup that fails is returned as an error for its MSISDN, rather than failing
+    the rest, and the successful lookups are stored after each chunk.
+    """
+
+    def lookup(msisdn):
+        try:
+            return client.get_misisdn_info(msisdn)
+        except Exception as e:
+            return {"error_code": None, "error_txt": str(e)}
+
+    results = {}
+    with ThreadPoolExecutor(
+        max_workers=settings.TRANSFERTO_BULK_LOOKUP_WORKERS
+    ) as executor:
+        for start in range(0, len(msisdns), chunk_size):
+            end = start + chunk_size
+            chunk = msisdns[start:end]
+            infos = dict(zip(chunk, executor.map(lookup, chunk)))
+            MsisdnInformation.objects.bulk_create(
+                [
+                    MsisdnInformation(msisdn=msisdn, data=info)
+                    for msisdn, info in infos.items()
+                    if not is_error_response(info)
+                ]
+            )
+            results.update(infos)
+    return results
+
+
+@app.task(ignore_result=True)
+def process_msisdn_lookup_batch(batch_id):
+    batch = MsisdnLookupBatch.objects.get(id=batch_id)
+    client = batch.org.transferto_account.first().get_transferto_client()
+    batch.status = MsisdnLookupBatch.RUNNING
+    batch.started_at = batch.started_at or timezone.now()
+    batch.save(update_fields=["status", "started_at"])
+
+    cached = MsisdnInformation.get_latest_for(batch.msisdns)
+    misses = [msisdn for msisdn in batch.msisdns if msisdn not in cached]
+    results = lookup_msisdn_information(client, misses)
+
+    batch.errors = {
+        msisdn: info for msisdn, info in results.items() if is_error_response(info)
+    }
+    batch.status = MsisdnLookupBatch.DONE
+    batch.finished_at = timezone.now()
+    batch.save(update_fields=["errors", "status", "finished_at"])
+
+
+@app.task(ignore_result=True)
+def process_topup_batch(batch_id, chunk_size=1000):
+    """
+    Sends the batch's topups concurrently, using TRANSFERTO_BATCH_WORKERS threads
+    and starting at most TRANSFERTO_BATCH_RATE topups per second.
+
+    Attempts are marked as waiting before they are sent, and only created attempts
+    are sent, so that no-one is paid twice if this is run again for the batch.
+    """
+    batch = TopupBatch.objects.get(id=batch_id)
+    client = batch.org.transferto_account.first().get_transferto_client()
+    batch.status = TopupBatch.RUNNING
+    batch.started_at = batch.started_at or timezone.now()
+    batch.save(update_fields=["status", "started_at"])
+
+    def send(attempt):
+        try:
+            return client.make_topup(
+                attempt.msisdn,
+                attempt.amount,
+                attempt.from_string,
+                simulate=batch.simulate,
+            )
+        except Exception as e:
+            return {"error_code": None, "error_txt": str(e)}
+
+    interval = 1 / settings.TRANSFERTO_BATCH_RATE
+    next_send = time.monotonic()
+    with ThreadPoolExecutor(max_workers=settings.TRANSFERTO_BATCH_WORKERS) as executor:
+        while True:
+            attempts = list(
+                batch.attempts.filter(status=TopupAttempt.CREATED).order_by("id")[
+                    :chunk_size
+                ]
+            )
+            if not attempts:
+                break
+            TopupAttempt.objects.filter(id__in=[a.id for a in attempts]).update(
+                status=TopupAttempt.WAITING
+            )
+
+            futures = []
+            for attempt in attempts:
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                next_send = max(next_send, time.monotonic()) + interval
+                futures.append(executor.submit(send, attempt))
+
+            for attempt, future in zip(attempts, futures):
+                attempt.response = future.result()
+                attempt.status = TopupAttempt.get_status_for_response(attempt.response)
+            TopupAttempt.objects.bulk_update(attempts, ["response", "status"])
+
+    batch.status = TopupBatch.DONE
+    batch.finished_at = timezone.now()
+    batch.save(update_fields=["status", "finished_at"])
+    log_event(log, "topup_batch_done", **batch.get_summary())
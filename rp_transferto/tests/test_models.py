@@ -1,18 +1,82 @@
 import json
+from datetime import timedelta
 from unittest.mock import patch
 
 import pkg_resources
 from django.test import TestCase
+from django.utils import timezone
 from freezegun import freeze_time
 
 from sidekick.tests.utils import create_org
 from sidekick.utils import clean_msisdn
 
-from ..models import TopupAttempt
+from ..models import MsisdnInformation, TopupAttempt
 from .constants import TOPUP_ERROR_RESPONSE_DICT, TOPUP_RESPONSE_DICT
 from .utils import create_transferto_account
 
 
+class TestMsisdnInformation(TestCase):
+    def test_get_latest(self):
+        """
+        Should return the latest info for the MSISDN, or None if there is none
+        """
+        self.assertIsNone(MsisdnInformation.get_latest("+27820000001"))
+        now = timezone.now()
+        MsisdnInformation.objects.create(
+            msisdn="27820000001", data={"v": 1}, timestamp=now - timedelta(days=1)
+        )
+        MsisdnInformation.objects.create(msisdn="27820000001", data={"v": 2})
+        MsisdnInformation.objects.create(msisdn="27820000002", data={"v": 3})
+        self.assertEqual(MsisdnInformation.get_latest("+27820000001").data, {"v": 2})
+
+    def test_is_stale(self):
+        """
+        Info older than the TTL should be stale
+        """
+        info = MsisdnInformation(msisdn="27820000001", data={})
+        self.assertFalse(info.is_stale)
+        info.timestamp = timezone.now() - timedelta(days=31)
+        self.assertTrue(info.is_stale)
+
+    def test_get_superseded(self):
+        """
+        Should return all but the latest info for each MSISDN
+        """
+        now = timezone.now()
+        old = MsisdnInformation.objects.create(
+            msisdn="27820000001", data={}, timestamp=now - timedelta(days=1)
+        )
+        tied = MsisdnInformation.objects.create(
+            msisdn="27820000001", data={}, timestamp=now
+        )
+        MsisdnInformation.objects.create(msisdn="27820000001", data={}, timestamp=now)
+        MsisdnInformation.objects.create(msisdn="27820000002", data={})
+        self.assertEqual(set(MsisdnInformation.get_superseded()), {old, tied})
+
+    def test_get_superseded_error(self):
+        """
+        Error responses shouldn't replace the last good info for the MSISDN
+        """
+        now = timezone.now()
+        good = MsisdnInformation.objects.create(
+            msisdn="27820000001",
+            data={"error_code": "0", "operatorid": "1"},
+            timestamp=now - timedelta(days=1),
+        )
+        MsisdnInformation.objects.create(
+            msisdn="27820000001", data={"error_code": "101"}, timestamp=now
+        )
+        self.assertNotIn(good, MsisdnInformation.get_superseded())
+
+        newer = MsisdnInformation.objects.create(
+            msisdn="27820000001",
+            data={"error_code": "0", "operatorid": "1"},
+            timestamp=now + timedelta(seconds=1),
+        )
+        self.assertNotIn(newer, MsisdnInformation.get_superseded())
+        self.assertIn(good, MsisdnInformation.get_superseded())
+
+
 class TestTopupAttempt(TestCase):
     def setUp(self):
         self.org = create_org()
@@ -1,18 +1,39 @@
 from unittest.mock import MagicMock, patch
 
+from django.core import mail
 from django.test import TestCase
 from django.test.utils import override_settings
 from pytest import raises
 
-from rp_transferto.models import MsisdnInformation, TopupAttempt
+from msisdn_utils.models import OperatorPrefix
+from msisdn_utils.utils import _prefix_tables
+from rp_transferto.models import (
+    MsisdnInformation,
+    ProductFallbackChain,
+    TopupAttempt,
+    TopupBatch,
+)
 from rp_transferto.tasks import (
     buy_airtime_take_action,
     buy_product_take_action,
+    get_cached_operator_id,
+    learn_transferto_operator_prefixes,
+    process_topup_batch,
+    prune_msisdn_information,
+    refresh_bulk_msisdn_information,
+    refresh_msisdn_information,
+    send_failure_digests,
     start_flow,
     take_action,
     topup_data,
     update_values,
 )
+from rp_transferto.utils import (
+    get_failure_notification_orgs,
+    mark_product_unavailable,
+    queue_failure_notification,
+    redis_conn,
+)
 from sidekick.tests.utils import create_org
 from sidekick.utils import clean_msisdn
 
@@ -23,7 +44,11 @@ from .constants import (
     TOPUP_ERROR_RESPONSE_DICT,
     TOPUP_RESPONSE_DICT,
 )
-from .utils import create_transferto_account
+from .utils import (
+    clear_catalogue_cache,
+    clear_failure_notifications,
+    create_transferto_account,
+)
 
 
 class TestFunctions(TestCase):
@@ -162,6 +187,93 @@ class TestTopupDataTask(TestCase):
     def setUp(self):
         self.org = create_org()
         self.transferto_account = create_transferto_account(org=self.org)
+        clear_catalogue_cache()
+
+    def tearDown(self):
+        clear_catalogue_cache()
+
+    def test_product_from_index(
+        self,
+        fake_get_misisdn_info,
+        fake_get_operator_products,
+        fake_topup_data,
+        fake_get_contacts,
+        fake_update_contact,
+    ):
+        """
+        The product should be looked up by its normalized recharge value, and the
+        index reused for later topups
+        """
+        fake_get_misisdn_info.return_value = MSISDN_INFO_RESPONSE_DICT
+        fake_get_operator_products.return_value = GET_PRODUCTS_RESPONSE_DICT
+        fake_topup_data.return_value = POST_TOPUP_DATA_RESPONSE
+
+        topup_data(self.org.id, "+27820000000", "1234-abc", "2 gb")
+        fake_topup_data.assert_called_once_with("+27820000000", 1235, simulate=False)
+
+        topup_data(self.org.id, "+27820000000", "1234-abc", "1GB")
+        fake_topup_data.assert_called_with("+27820000000", 1234, simulate=False)
+        fake_get_operator_products.assert_called_once()
+
+    def test_product_fallback(
+        self,
+        fake_get_misisdn_info,
+        fake_get_operator_products,
+        fake_topup_data,
+        fake_get_contacts,
+        fake_update_contact,
+    ):
+        """
+        If the recharge value isn't one of the products' recharge values, it should
+        be matched against the other parts of the descriptions, from the cached
+        product index
+        """
+        fake_get_misisdn_info.return_value = MSISDN_INFO_RESPONSE_DICT
+        fake_get_operator_products.return_value = GET_PRODUCTS_RESPONSE_DICT
+        fake_topup_data.return_value = POST_TOPUP_DATA_RESPONSE
+
+        topup_data(self.org.id, "+27820000000", "1234-abc", "30 Days")
+        fake_topup_data.assert_called_once_with("+27820000000", 1234, simulate=False)
+        fake_get_operator_products.assert_called_once()
+
+        # Only exact matches are used
+        fake_get_operator_products.return_value = {
+            "fixed_value_recharges": [
+                dict(product, product_short_desc=desc)
+                for product, desc in zip(
+                    GET_PRODUCTS_RESPONSE_DICT["fixed_value_recharges"],
+                    ["11GB / 30 Days", "1GB / 30 Days"],
+                )
+            ]
+        }
+        clear_catalogue_cache()
+        topup_data(self.org.id, "+27820000000", "1234-abc", "1GB")
+        fake_topup_data.assert_called_with("+27820000000", 1235, simulate=False)
+
+    def test_stored_error_info(
+        self,
+        fake_get_misisdn_info,
+        fake_get_operator_products,
+        fake_topup_data,
+        fake_get_contacts,
+        fake_update_contact,
+    ):
+        """
+        If the latest stored MSISDN info is an error, the operator should be
+        looked up instead
+        """
+        MsisdnInformation.objects.create(
+            msisdn=clean_msisdn("+27820000000"), data={"error_code": "101"}
+        )
+        _prefix_tables.clear()
+        fake_get_misisdn_info.return_value = MSISDN_INFO_RESPONSE_DICT
+        fake_get_operator_products.return_value = GET_PRODUCTS_RESPONSE_DICT
+        fake_topup_data.return_value = POST_TOPUP_DATA_RESPONSE
+
+        topup_data(self.org.id, "+27820000000", "1234-abc", "1GB")
+
+        fake_get_misisdn_info.assert_called_once_with("+27820000000")
+        fake_topup_data.assert_called_once_with("+27820000000", 1234, simulate=False)
 
     def test_successsful_run(
         self,
@@ -247,6 +359,175 @@ class TestTopupDataTask(TestCase):
         self.assertTrue(fake_update_contact.called)
 
 
+class TestMsisdnInformationTasks(TestCase):
+    def setUp(self):
+        self.org = create_org()
+        create_transferto_account(org=self.org)
+
+    def tearDown(self):
+        redis_conn.delete("transferto_msisdn_refresh_27820000001")
+
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_refresh_msisdn_information(self, fake_get_misisdn_info):
+        """
+        Should store fresh info for the MSISDN, only once at a time, and not store
+        errors
+        """
+        fake_get_misisdn_info.return_value = MSISDN_INFO_RESPONSE_DICT
+        refresh_msisdn_information(self.org.id, "27820000001")
+        refresh_msisdn_information(self.org.id, "27820000001")
+        self.assertEqual(
+            MsisdnInformation.get_latest("27820000001").data,
+            MSISDN_INFO_RESPONSE_DICT,
+        )
+        fake_get_misisdn_info.assert_called_once_with("27820000001")
+
+        redis_conn.delete("transferto_msisdn_refresh_27820000001")
+        fake_get_misisdn_info.return_value = {"error_code": "101"}
+        refresh_msisdn_information(self.org.id, "27820000001")
+        self.assertEqual(MsisdnInformation.objects.count(), 1)
+
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_refresh_bulk_msisdn_information(self, fake_get_misisdn_info):
+        """
+        Should refresh the MSISDNs that aren't already being refreshed
+        """
+        fake_get_misisdn_info.return_value = {"error_code": "0", "operatorid": "3"}
+        redis_conn.set("transferto_msisdn_refresh_27820000001", 1)
+        self.addCleanup(
+            redis_conn.delete,
+            "transferto_msisdn_refresh_27820000001",
+            "transferto_msisdn_refresh_27820000002",
+        )
+
+        refresh_bulk_msisdn_information(self.org.id, ["27820000001", "27820000002"])
+
+        fake_get_misisdn_info.assert_called_once_with("27820000002")
+        self.assertEqual(
+            list(MsisdnInformation.objects.values_list("msisdn", flat=True)),
+            ["27820000002"],
+        )
+
+    def test_prune_msisdn_information(self):
+        """
+        Should only keep the latest info for each MSISDN
+        """
+        for _ in range(3):
+            MsisdnInformation.objects.create(msisdn="27820000001", data={})
+        latest = MsisdnInformation.objects.create(msisdn="27820000001", data={})
+        other = MsisdnInformation.objects.create(msisdn="27820000002", data={})
+
+        prune_msisdn_information(batch_size=2)
+
+        self.assertEqual(set(MsisdnInformation.objects.all()), {latest, other})
+
+    @override_settings(OPERATOR_PREFIX_MIN_OBSERVATIONS=3)
+    def test_learn_transferto_operator_prefixes(self):
+        """
+        Should learn operator prefixes from the cached MSISDN info
+        """
+        for i in range(3):
+            MsisdnInformation.objects.create(
+                msisdn=f"2782000000{i}", data={"operatorid": "12"}
+            )
+        MsisdnInformation.objects.create(msisdn="27830000000", data={})
+
+        learn_transferto_operator_prefixes()
+
+        prefix = OperatorPrefix.objects.get()
+        self.assertEqual(
+            (prefix.provider, prefix.prefix, prefix.operator_id),
+            (OperatorPrefix.Provider.TRANSFERTO, "2782", 12),
+        )
+
+    def test_get_cached_operator_id(self):
+        """
+        Should use the stored MSISDN info, falling back to the prefix table if
+        the stored info is an error
+        """
+        OperatorPrefix.objects.create(
+            provider=OperatorPrefix.Provider.TRANSFERTO, prefix="2782", operator_id=5
+        )
+        _prefix_tables.clear()
+        self.addCleanup(_prefix_tables.clear)
+        MsisdnInformation.objects.create(
+            msisdn="27820000001", data={"operatorid": "12"}
+        )
+        MsisdnInformation.objects.create(
+            msisdn="27820000002", data={"error_code": "101"}
+        )
+
+        self.assertEqual(get_cached_operator_id("27820000001"), 12)
+        self.assertEqual(get_cached_operator_id("27820000002"), 5)
+        self.assertEqual(get_cached_operator_id("27820000003"), 5)
+
+
+class TestProcessTopupBatch(TestCase):
+    def setUp(self):
+        self.org = create_org()
+        create_transferto_account(org=self.org)
+
+    def create_batch(self, simulate=False):
+        batch = TopupBatch.objects.create(org=self.org, simulate=simulate)
+        for msisdn in ["27820000001", "27820000002", "27820000003"]:
+            TopupAttempt.objects.create(
+                msisdn=msisdn, amount=10, from_string="test", org=self.org, batch=batch
+            )
+        return batch
+
+    @override_settings(TRANSFERTO_BATCH_RATE=1000)
+    @patch("rp_transferto.utils.TransferToClient.make_topup")
+    def test_process_topup_batch(self, fake_make_topup):
+        """
+        Should send all the created topups and record their results
+        """
+        batch = self.create_batch()
+        done = TopupAttempt.objects.create(
+            msisdn="27820000004",
+            amount=10,
+            org=self.org,
+            batch=batch,
+            response=TOPUP_RESPONSE_DICT,
+        )
+        fake_make_topup.side_effect = lambda msisdn, *args, **kwargs: (
+            TOPUP_ERROR_RESPONSE_DICT
+            if msisdn == "27820000002"
+            else TOPUP_RESPONSE_DICT
+        )
+
+        process_topup_batch(batch.id, chunk_size=2)
+
+        self.assertEqual(fake_make_topup.call_count, 3)
+        fake_make_topup.assert_any_call("27820000001", 10, "test", simulate=False)
+        self.assertNotIn(
+            done.msisdn, [call.args[0] for call in fake_make_topup.call_args_list]
+        )
+        summary = TopupBatch.objects.get(id=batch.id).get_summary()
+        self.assertEqual(summary["status"], "DONE")
+        self.assertEqual(summary["total"], 4)
+        self.assertEqual(summary["attempts"], {"SUCEEDED": 3, "FAILED": 1})
+        self.assertIsNotNone(summary["throughput"])
+
+    @override_settings(TRANSFERTO_BATCH_RATE=1000)
+    @patch("rp_transferto.utils.TransferToClient.make_topup")
+    def test_process_topup_batch_simulate(self, fake_make_topup):
+        """
+        Simulated batches should simulate the topups, and failed requests should be
+        recorded as failed
+        """
+        batch = self.create_batch(simulate=True)
+        fake_make_topup.side_effect = Exception("connection error")
+
+        process_topup_batch(batch.id)
+
+        fake_make_topup.assert_any_call("27820000001", 10, "test", simulate=True)
+        attempt = batch.attempts.first()
+        self.assertEqual(attempt.status, TopupAttempt.FAILED)
+        self.assertEqual(
+            attempt.response, {"error_code": None, "error_txt": "connection error"}
+        )
+
+
 class TestBuyProductTakeActionTask(TestCase):
     def setUp(self):
         self.org = create_org()
@@ -328,11 +609,93 @@ class TestBuyProductTakeActionTask(TestCase):
         )
 
 
+class TestBuyProductTakeActionFallback(TestCase):
+    def setUp(self):
+        self.org = create_org()
+        self.org.point_of_contact = "test@example.org"
+        self.org.save()
+        self.transferto_account = create_transferto_account(org=self.org)
+
+    def tearDown(self):
+        for key in redis_conn.keys("transferto_product_unavailable_*"):
+            redis_conn.delete(key)
+        clear_failure_notifications()
+
+    @patch("rp_transferto.tasks.take_action")
+    @patch("rp_transferto.utils.TransferToClient.topup_data")
+    def test_default_chain(self, fake_topup_data, fake_take_action):
+        """
+        If the product isn't available, the other products in the chain should be
+        tried in order until one succeeds
+        """
+        unavailable = dict(POST_TOPUP_DATA_RESPONSE, status="1000204")
+        fake_topup_data.side_effect = [
+            unavailable,
+            unavailable,
+            POST_TOPUP_DATA_RESPONSE,
+        ]
+
+        buy_product_take_action(self.org.id, "+27820000001", 1601, user_uuid="abc")
+
+        self.assertEqual(
+            [c.args[1] for c in fake_topup_data.call_args_list], [1601, 1194, 1630]
+        )
+        fake_take_action.assert_called_once_with(
+            self.org,
+            "abc",
+            values_to_update={},
+            call_result=POST_TOPUP_DATA_RESPONSE,
+            flow_start=None,
+        )
+
+    @patch("rp_transferto.utils.TransferToClient.topup_data")
+    def test_org_chain_skips_unavailable(self, fake_topup_data):
+        """
+        The org's chain should be used instead of the default chain, and products
+        known to be unavailable for the operator should be skipped
+        """
+        ProductFallbackChain.objects.create(
+            name="org chain", product_ids=[1, 1194, 2, 3], org=self.org
+        )
+        MsisdnInformation.objects.create(
+            msisdn="27820000001", data=MSISDN_INFO_RESPONSE_DICT
+        )
+        operator_id = int(MSISDN_INFO_RESPONSE_DICT["operatorid"])
+        mark_product_unavailable(operator_id, 2)
+        fake_topup_data.return_value = dict(POST_TOPUP_DATA_RESPONSE, status="1000204")
+
+        buy_product_take_action(self.org.id, "+27820000001", 1194)
+
+        self.assertEqual(
+            [c.args[1] for c in fake_topup_data.call_args_list], [1194, 1, 3]
+        )
+        send_failure_digests()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn("FAILURE WITH RETRIES", mail.outbox[0].body)
+        self.assertIn("also_tried", mail.outbox[0].alternatives[0][0])
+        self.assertEqual(
+            redis_conn.get(f"transferto_product_unavailable_{operator_id}_1194"), "1"
+        )
+
+    @patch("rp_transferto.utils.TransferToClient.topup_data")
+    def test_no_fallback_for_other_failures(self, fake_topup_data):
+        fake_topup_data.return_value = dict(POST_TOPUP_DATA_RESPONSE, status="1")
+
+        buy_product_take_action(self.org.id, "+27820000001", 1194)
+
+        fake_topup_data.assert_called_once()
+        send_failure_digests()
+        self.assertIn("FAILURE: rp_transferto", mail.outbox[0].body)
+
+
 class TestBuyAirtimeTakeAction(TestCase):
     def setUp(self):
         self.org = create_org()
         self.transferto_account = create_transferto_account(org=self.org)
 
+    def tearDown(self):
+        clear_failure_notifications()
+
     @patch("rp_transferto.tasks.update_values")
     @patch("rp_transferto.tasks.start_flow")
     @patch("rp_transferto.utils.TransferToClient.make_topup")
@@ -530,6 +893,8 @@ class TestBuyAirtimeTakeAction(TestCase):
             transferto_response=TOPUP_ERROR_RESPONSE_DICT,
         )
         self.assertFalse(fake_start_flow.called)
+        self.assertFalse(fake_send.called)
+        send_failure_digests()
         self.assertTrue(fake_send.called)
 
     @override_settings(EMAIL_HOST_USER=None)
@@ -632,6 +997,8 @@ class TestBuyAirtimeTakeAction(TestCase):
         fake_start_flow.assert_called_with(
             org=self.org, user_uuid=user_uuid, flow_uuid=flow_uuid
         )
+        self.assertFalse(fake_send.called)
+        send_failure_digests()
         self.assertTrue(fake_send.called)
 
     @override_settings(EMAIL_HOST_PASSWORD="EMAIL_HOST_PASSWORD")
@@ -676,6 +1043,8 @@ class TestBuyAirtimeTakeAction(TestCase):
         fake_start_flow.assert_called_with(
             org=self.org, user_uuid=user_uuid, flow_uuid=flow_uuid
         )
+        self.assertFalse(fake_send.called)
+        send_failure_digests()
         self.assertTrue(fake_send.called)
 
     @override_settings(EMAIL_HOST_PASSWORD="EMAIL_HOST_PASSWORD")
@@ -738,4 +1107,87 @@ class TestBuyAirtimeTakeAction(TestCase):
         fake_start_flow.assert_called_with(
             org=self.org, user_uuid=user_uuid, flow_uuid=fail_flow_uuid
         )
+        self.assertFalse(fake_send.called)
+        send_failure_digests()
         self.assertTrue(fake_send.called)
+
+
+class TestSendFailureDigests(TestCase):
+    def setUp(self):
+        self.org = create_org()
+        self.org.point_of_contact = "test@example.org"
+        self.org.save()
+
+    def tearDown(self):
+        clear_failure_notifications()
+
+    @override_settings(TRANSFERTO_FAILURE_DIGEST_MAX_EVENTS=2)
+    def test_send_failure_digests(self):
+        """
+        Each org should get one email for all of its failures, describing up to
+        the maximum number of them
+        """
+        for i in range(3):
+            queue_failure_notification(
+                self.org.id,
+                {
+                    "task_name": "test_task",
+                    "summary": "FAILURE",
+                    "timestamp": "2026-01-01T00:00:00",
+                    "details": {"attempt": i},
+                },
+            )
+
+        send_failure_digests()
+        send_failure_digests()
+
+        self.assertEqual(len(mail.outbox), 1)
+        email = mail.outbox[0]
+        self.assertEqual(
+            email.subject, f"FAILURES: 3 topup failures for {self.org.name}"
+        )
+        self.assertEqual(email.to, ["test@example.org"])
+        self.assertIn(
+            "3 failures since the last digest, showing the first 2", email.body
+        )
+        self.assertEqual(email.body.count("FAILURE: test_task"), 2)
+
+    def test_send_failure_digests_send_error(self):
+        """
+        Failures should be kept for the next digest if the email can't be sent
+        """
+        notification = {
+            "task_name": "test_task",
+            "summary": "FAILURE",
+            "timestamp": "2026-01-01T00:00:00",
+            "details": {},
+        }
+        queue_failure_notification(self.org.id, notification)
+
+        with patch("rp_transferto.tasks.send_mail") as fake_send_mail:
+            fake_send_mail.side_effect = ConnectionRefusedError()
+            send_failure_digests()
+        queue_failure_notification(self.org.id, notification)
+        send_failure_digests()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            mail.outbox[0].subject, f"FAILURES: 2 topup failures for {self.org.name}"
+        )
+        self.assertEqual(get_failure_notification_orgs(), set())
+
+    def test_send_failure_digests_no_details(self):
+        """
+        Counted failures should still be reported if their details are missing
+        """
+        redis_conn.set(f"transferto_failures_{self.org.id}_count", 3)
+        redis_conn.sadd("transferto_failure_orgs", self.org.id)
+
+        send_failure_digests()
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(
+            "3 failures since the last digest, details unavailable",
+            mail.outbox[0].body,
+        )
+        self.assertEqual(get_failure_notification_orgs(), set())
@@ -7,10 +7,13 @@ from unittest import TestCase
 from unittest.mock import patch
 
 import responses
+from django.test import override_settings
 from freezegun import freeze_time
 from pytest import raises
 
-from rp_transferto.utils import TransferToClient
+from rp_transferto.utils import TransferToClient, _catalogue_cache
+
+from .utils import clear_catalogue_cache
 
 
 class TestTransferToClient(TestCase):
@@ -49,6 +52,24 @@ class TestTransferToClient(TestCase):
         }
         self.assertDictEqual(output, expected_output)
 
+    @responses.activate
+    @override_settings(
+        HTTP_CLIENT_CONNECT_TIMEOUT=1,
+        TRANSFERTO_TIMEOUT=2,
+        TRANSFERTO_TOPUP_TIMEOUT=3,
+    )
+    def test_make_transferto_request_timeouts(self):
+        """
+        Topups get a longer read timeout than other actions
+        """
+        responses.add(responses.POST, self.client.url, body=b"error_code=0\r\n")
+
+        self.client._make_transferto_request(action="ping")
+        self.client._make_transferto_request(action="topup")
+
+        self.assertEqual(responses.calls[0].request.req_kwargs["timeout"], (1, 2))
+        self.assertEqual(responses.calls[1].request.req_kwargs["timeout"], (1, 3))
+
     def test_ping(self):
         with patch.object(self.client, "_make_transferto_request") as mock:
             self.client.ping()
@@ -139,6 +160,19 @@ class TestTransferToClient(TestCase):
             reserve_id=1234,
         )
 
+    def test_make_topup_simulate(self):
+        with patch.object(self.client, "_make_transferto_request") as mock:
+            self.client.make_topup(
+                "+27820000001", 10, from_string="john", simulate=True
+            )
+
+        mock.assert_called_once_with(
+            action="simulation",
+            destination_msisdn="+27820000001",
+            product=10,
+            msisdn="john",
+        )
+
     def _check_headers(self, headers, time):
         """
         headers is a dict
@@ -305,3 +339,118 @@ class TestTransferToClient(TestCase):
                 },
             },
         )
+
+
+class TestCatalogueCache(TestCase):
+    def setUp(self):
+        self.client = TransferToClient(
+            "fake_login", "fake_token", "fake_apikey", "fake_apisecret", account_id=1
+        )
+        clear_catalogue_cache()
+
+    def tearDown(self):
+        clear_catalogue_cache()
+
+    def test_cached(self):
+        """
+        Catalogue data should only be fetched once, and then served from the cache,
+        both in-process and from Redis
+        """
+        with patch.object(self.client, "_make_transferto_api_request") as mock:
+            mock.return_value = {"fixed_value_recharges": []}
+            self.assertEqual(
+                self.client.get_operator_products(99), {"fixed_value_recharges": []}
+            )
+            self.assertEqual(
+                self.client.get_operator_products(99), {"fixed_value_recharges": []}
+            )
+            _catalogue_cache.clear()
+            self.assertEqual(
+                self.client.get_operator_products(99), {"fixed_value_recharges": []}
+            )
+            mock.assert_called_once()
+
+            self.client.get_operator_products(100)
+            self.assertEqual(mock.call_count, 2)
+
+    def test_not_cached_without_account(self):
+        """
+        Clients that aren't for an account shouldn't be cached
+        """
+        client = TransferToClient(
+            "fake_login", "fake_token", "fake_apikey", "fake_apisecret"
+        )
+        with patch.object(client, "_make_transferto_api_request") as mock:
+            client.get_operator_products(99)
+            client.get_operator_products(99)
+        self.assertEqual(mock.call_count, 2)
+
+    def test_errors_not_cached(self):
+        """
+        Error responses shouldn't be cached
+        """
+        with patch.object(self.client, "_make_transferto_request") as mock:
+            mock.return_value = {"error_code": "101", "error_txt": "Error"}
+            self.client.get_countries()
+            self.client.get_countries()
+        self.assertEqual(mock.call_count, 2)
+
+        with patch.object(self.client, "_make_transferto_api_request") as mock:
+            mock.return_value = {"errors": [{"code": 1000001}]}
+            self.client.get_operator_products(99)
+            self.client.get_operator_products(99)
+        self.assertEqual(mock.call_count, 2)
+
+    @patch("rp_transferto.tasks.refresh_transferto_catalogue")
+    def test_stale_refreshed_in_background(self, mock_refresh):
+        """
+        Once the TTL has passed, the stale data should be returned while it is
+        refreshed in the background
+        """
+        with freeze_time("2000-01-01") as frozen_time:
+            with patch.object(self.client, "_make_transferto_api_request") as mock:
+                mock.return_value = {"fixed_value_recharges": []}
+                self.client.get_operator_products(99)
+
+                frozen_time.tick(60 * 60 + 1)
+                self.assertEqual(
+                    self.client.get_operator_products(99),
+                    {"fixed_value_recharges": []},
+                )
+                self.client.get_operator_products(99)
+                mock.assert_called_once()
+
+        mock_refresh.delay.assert_called_once_with(1, "get_operator_products", [99])
+
+    def test_operator_product_index(self):
+        """
+        The index should map normalized recharge values, and then the other parts
+        of the descriptions, to the first product with that value, and not index
+        error responses
+        """
+        with patch.object(self.client, "_make_transferto_api_request") as mock:
+            mock.return_value = {
+                "fixed_value_recharges": [
+                    {"product_id": 1, "product_short_desc": "1 GB / 30 Days"},
+                    {"product_id": 2, "product_short_desc": "500MB"},
+                    {"product_id": 3, "product_short_desc": "1GB / 7 Days"},
+                ]
+            }
+            self.assertEqual(
+                self.client.get_operator_product_index(99),
+                {
+                    "1gb": {"product_id": 1, "product_short_desc": "1 GB / 30 Days"},
+                    "500mb": {"product_id": 2, "product_short_desc": "500MB"},
+                    "30days": {
+                        "product_id": 1,
+                        "product_short_desc": "1 GB / 30 Days",
+                    },
+                    "7days": {"product_id": 3, "product_short_desc": "1GB / 7 Days"},
+                },
+            )
+
+            mock.return_value = {"errors": [{"code": 1000001}]}
+            self.assertEqual(
+                self.client.get_operator_product_index(100),
+                {"errors": [{"code": 1000001}]},
+            )
@@ -1,11 +1,15 @@
 import json
+from datetime import timedelta
 from unittest.mock import MagicMock, patch
 
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.http import JsonResponse
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
 from pytest import raises
+from requests.exceptions import Timeout
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient, APITestCase
@@ -17,7 +21,7 @@ from rp_transferto.views import process_status_code
 from sidekick.tests.utils import create_org
 from sidekick.utils import clean_msisdn
 
-from ..models import TopupAttempt
+from ..models import TopupAttempt, TopupBatch
 from .constants import (
     GET_COUNTRIES_RESPONSE_DICT,
     GET_COUNTRY_SERVICES_RESPONSE_DICT,
@@ -28,7 +32,7 @@ from .constants import (
     PING_RESPONSE_DICT,
     RESERVE_ID_RESPONSE_DICT,
 )
-from .utils import create_transferto_account
+from .utils import clear_catalogue_cache, create_transferto_account
 
 fake_ping = MagicMock(return_value=PING_RESPONSE_DICT)
 fake_msisdn_info = MagicMock(return_value=MSISDN_INFO_RESPONSE_DICT)
@@ -165,6 +169,166 @@ class TestTransferToViews(APITestCase):
         self.assertFalse(fake_get_misisdn_info.called)
         self.assertEqual(MsisdnInformation.objects.count(), 1)
 
+    @patch("rp_transferto.views.refresh_msisdn_information")
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_msisdn_info_view_stale_object(
+        self, fake_get_misisdn_info, fake_refresh_msisdn_information
+    ):
+        """
+        Stale info should be returned, and refreshed in the background
+        """
+        msisdn = "+27820000000"
+        MsisdnInformation.objects.create(
+            msisdn=msisdn,
+            data=MSISDN_INFO_RESPONSE_DICT,
+            timestamp=timezone.now() - timedelta(days=31),
+        )
+        response = self.api_client.get(
+            reverse("msisdn_info", kwargs={"msisdn": msisdn, "org_id": self.org.id})
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), MSISDN_INFO_RESPONSE_DICT)
+        self.assertFalse(fake_get_misisdn_info.called)
+        fake_refresh_msisdn_information.delay.assert_called_once_with(
+            self.org.id, "27820000000"
+        )
+
+    @patch("rp_transferto.views.refresh_bulk_msisdn_information")
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_bulk_msisdn_info(
+        self, fake_get_misisdn_info, fake_refresh_bulk_msisdn_information
+    ):
+        """
+        Cached info should be used where there is some, and the rest looked up and
+        cached, except for errors
+        """
+        MsisdnInformation.objects.create(msisdn="27820000001", data={"operatorid": "1"})
+        MsisdnInformation.objects.create(
+            msisdn="27820000002",
+            data={"operatorid": "2"},
+            timestamp=timezone.now() - timedelta(days=31),
+        )
+        fake_get_misisdn_info.side_effect = lambda msisdn: (
+            {"error_code": "101"}
+            if msisdn == "27820000004"
+            else {"error_code": "0", "operatorid": "3"}
+        )
+
+        response = self.api_client.post(
+            reverse("bulk_msisdn_info", kwargs={"org_id": self.org.id}),
+            {"msisdns": ["+27820000001", "27820000002", "27820000003", "27820000004"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {
+                "results": {
+                    "27820000001": {"operatorid": "1"},
+                    "27820000002": {"operatorid": "2"},
+                    "27820000003": {"error_code": "0", "operatorid": "3"},
+                    "27820000004": {"error_code": "101"},
+                }
+            },
+        )
+        self.assertEqual(fake_get_misisdn_info.call_count, 2)
+        self.assertEqual(
+            MsisdnInformation.get_latest("27820000003").data,
+            {"error_code": "0", "operatorid": "3"},
+        )
+        self.assertIsNone(MsisdnInformation.get_latest("27820000004"))
+        fake_refresh_bulk_msisdn_information.delay.assert_called_once_with(
+            self.org.id, ["27820000002"]
+        )
+
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_bulk_msisdn_info_lookup_exception(self, fake_get_misisdn_info):
+        """
+        A lookup that raises should be returned as an error for its MSISDN, without
+        losing the other lookups
+        """
+
+        def get_misisdn_info(msisdn):
+            if msisdn == "27820000002":
+                raise Timeout("timed out")
+            return {"error_code": "0", "operatorid": "3"}
+
+        fake_get_misisdn_info.side_effect = get_misisdn_info
+
+        response = self.api_client.post(
+            reverse("bulk_msisdn_info", kwargs={"org_id": self.org.id}),
+            {"msisdns": ["27820000001", "27820000002", "27820000003"]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()["results"]["27820000002"],
+            {"error_code": None, "error_txt": "timed out"},
+        )
+        self.assertEqual(MsisdnInformation.objects.count(), 2)
+
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_bulk_msisdn_info_background(self, fake_get_misisdn_info):
+        """
+        Large lookups should be done in the background, and the results polled for
+        """
+        MsisdnInformation.objects.create(msisdn="27820000001", data={"operatorid": "1"})
+        fake_get_misisdn_info.side_effect = lambda msisdn: (
+            {"error_code": "101"}
+            if msisdn == "27820000003"
+            else {"error_code": "0", "operatorid": "2"}
+        )
+
+        with self.settings(TRANSFERTO_BULK_LOOKUP_SYNC_MAX=1):
+            response = self.api_client.post(
+                reverse("bulk_msisdn_info", kwargs={"org_id": self.org.id}),
+                {"msisdns": ["27820000001", "27820000002", "27820000003"]},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        batch_id = response.json()["id"]
+        self.assertEqual(response.json()["total"], 3)
+
+        response = self.api_client.get(
+            reverse(
+                "msisdn_lookup_batch",
+                kwargs={"org_id": self.org.id, "batch_id": batch_id},
+            )
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["status"], "DONE")
+        self.assertEqual(
+            response.json()["results"],
+            {
+                "27820000001": {"operatorid": "1"},
+                "27820000002": {"error_code": "0", "operatorid": "2"},
+                "27820000003": {"error_code": "101"},
+            },
+        )
+        self.assertEqual(fake_get_misisdn_info.call_count, 2)
+
+        response = self.api_client.get(
+            reverse(
+                "msisdn_lookup_batch",
+                kwargs={"org_id": self.org.id, "batch_id": batch_id + 1},
+            )
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_bulk_msisdn_info_invalid(self):
+        """
+        A list of MSISDNs is required
+        """
+        url = reverse("bulk_msisdn_info", kwargs={"org_id": self.org.id})
+        response = self.api_client.post(url, {"msisdns": "27820000001"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        with self.settings(TRANSFERTO_BULK_LOOKUP_MAX=1):
+            response = self.api_client.post(
+                url, {"msisdns": ["27820000001", "27820000002"]}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
     def test_msisdn_info_no_cache(self, fake_get_misisdn_info):
         fake_get_misisdn_info.return_value = MSISDN_INFO_RESPONSE_DICT
@@ -182,6 +346,20 @@ class TestTransferToViews(APITestCase):
         self.assertTrue(fake_get_misisdn_info.called)
         self.assertEqual(MsisdnInformation.objects.count(), 2)
 
+    @patch("rp_transferto.utils.TransferToClient.get_misisdn_info")
+    def test_msisdn_info_error_not_stored(self, fake_get_misisdn_info):
+        fake_get_misisdn_info.return_value = {"error_code": "101"}
+        msisdn = "+27820000000"
+        MsisdnInformation.objects.create(msisdn=msisdn, data=MSISDN_INFO_RESPONSE_DICT)
+
+        self.api_client.get(
+            "{}?no_cache=True".format(
+                reverse("msisdn_info", kwargs={"msisdn": msisdn, "org_id": self.org.id})
+            )
+        )
+
+        self.assertEqual(MsisdnInformation.objects.count(), 1)
+
     @patch.object(TransferToClient, "reserve_id", fake_reserve_id)
     def test_reserve_id_view(self):
         self.assertFalse(fake_reserve_id.called)
@@ -212,6 +390,26 @@ class TestTransferToViews(APITestCase):
         self.assertEqual(json.loads(response.content), GET_OPERATORS_RESPONSE_DICT)
         self.assertTrue(fake_get_operators.called)
 
+    @patch.object(TransferToClient, "_make_transferto_request")
+    def test_get_operators_view_cached(self, fake_make_transferto_request):
+        """
+        The view's keyword arguments should be passed through the catalogue cache
+        """
+        self.addCleanup(clear_catalogue_cache)
+        fake_make_transferto_request.return_value = GET_OPERATORS_RESPONSE_DICT
+        url = reverse(
+            "get_operators", kwargs={"country_id": 111, "org_id": self.org.id}
+        )
+
+        for _ in range(2):
+            response = self.api_client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(response.content), GET_OPERATORS_RESPONSE_DICT)
+
+        fake_make_transferto_request.assert_called_once_with(
+            action="pricelist", info_type="country", content=111
+        )
+
     @patch.object(
         TransferToClient,
         "get_operator_airtime_products",
@@ -536,3 +734,142 @@ class TestTransferToViews(APITestCase):
             values_to_update={},
             fail_flow_start=fail_flow_uuid,
         )
+
+    @patch("rp_transferto.views.process_topup_batch")
+    def test_create_topup_batch(self, fake_process_topup_batch):
+        """
+        A batch of topups should be created from the JSON recipients, and sent in
+        the background
+        """
+        response = self.api_client.post(
+            reverse("create_topup_batch", kwargs={"org_id": self.org.id}),
+            {
+                "recipients": [
+                    {"msisdn": "+27820000001", "amount": 10},
+                    {
+                        "msisdn": "+27820000002",
+                        "amount": 20,
+                        "from_string": "other",
+                        "user_uuid": "1234",
+                    },
+                ],
+                "from_string": "test",
+                "simulate": True,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        batch = TopupBatch.objects.get(id=response.json()["id"])
+        self.assertTrue(batch.simulate)
+        self.assertEqual(
+            list(
+                batch.attempts.order_by("id").values_list(
+                    "msisdn", "amount", "from_string", "rapidpro_user_uuid", "status"
+                )
+            ),
+            [
+                ("27820000001", 10, "test", None, TopupAttempt.CREATED),
+                ("27820000002", 20, "other", "1234", TopupAttempt.CREATED),
+            ],
+        )
+        fake_process_topup_batch.delay.assert_called_once_with(batch.id)
+
+    @patch("rp_transferto.views.process_topup_batch")
+    def test_create_topup_batch_csv(self, fake_process_topup_batch):
+        """
+        Recipients can be uploaded as a CSV file
+        """
+        csv_file = SimpleUploadedFile(
+            "recipients.csv", b"msisdn,amount\n+27820000001,10\n+27820000002,20\n"
+        )
+        response = self.api_client.post(
+            reverse("create_topup_batch", kwargs={"org_id": self.org.id}),
+            {"file": csv_file, "from_string": "test"},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.json()["total"], 2)
+        batch = TopupBatch.objects.get(id=response.json()["id"])
+        self.assertFalse(batch.simulate)
+        self.assertEqual(
+            sorted(batch.attempts.values_list("amount", flat=True)), [10, 20]
+        )
+
+    @patch("rp_transferto.views.process_topup_batch")
+    def test_create_topup_batch_csv_blank_cells(self, fake_process_topup_batch):
+        """
+        Blank optional cells in the CSV file should use the defaults
+        """
+        csv_file = SimpleUploadedFile(
+            "recipients.csv",
+            b"msisdn,amount,from_string,user_uuid\n"
+            b"+27820000001,10,,\n"
+            b"+27820000002,20,other,1234\n",
+        )
+        response = self.api_client.post(
+            reverse("create_topup_batch", kwargs={"org_id": self.org.id}),
+            {"file": csv_file, "from_string": "test"},
+            format="multipart",
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        batch = TopupBatch.objects.get(id=response.json()["id"])
+        self.assertEqual(
+            list(
+                batch.attempts.order_by("id").values_list(
+                    "msisdn", "from_string", "rapidpro_user_uuid"
+                )
+            ),
+            [("27820000001", "test", None), ("27820000002", "other", "1234")],
+        )
+
+    def test_create_topup_batch_invalid(self):
+        """
+        Invalid recipients should return a Bad Request error, without creating a batch
+        """
+        response = self.api_client.post(
+            reverse("create_topup_batch", kwargs={"org_id": self.org.id}),
+            {"recipients": [{"msisdn": "+27820000001", "amount": "ten"}]},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(TopupBatch.objects.exists())
+
+    def test_topup_batch_status(self):
+        """
+        Should return the summary of the batch, if it belongs to the org
+        """
+        batch = TopupBatch.objects.create(org=self.org)
+        TopupAttempt.objects.create(
+            msisdn="27820000001", amount=10, org=self.org, batch=batch
+        )
+        response = self.api_client.get(
+            reverse("topup_batch", kwargs={"org_id": self.org.id, "batch_id": batch.id})
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["total"], 1)
+        self.assertEqual(response.json()["attempts"], {"CREATED": 1})
+
+        other_batch = TopupBatch.objects.create(org=create_org())
+        response = self.api_client.get(
+            reverse(
+                "topup_batch",
+                kwargs={"org_id": self.org.id, "batch_id": other_batch.id},
+            )
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_topup_batch_wrong_method(self):
+        """
+        Batches can only be created without an ID, and fetched with one
+        """
+        response = self.api_client.get(
+            reverse("create_topup_batch", kwargs={"org_id": self.org.id})
+        )
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        response = self.api_client.post(
+            reverse("topup_batch", kwargs={"org_id": self.org.id, "batch_id": 1}),
+            {},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -1,6 +1,7 @@
 from sidekick.tests.utils import create_org
 
 from ..models import TransferToAccount
+from ..utils import _catalogue_cache, redis_conn
 
 
 def create_transferto_account(org=None, **kwargs):
@@ -14,3 +15,14 @@ def create_transferto_account(org=None, **kwargs):
     }
     data.update(kwargs)
     return TransferToAccount.objects.create(org=org, **data)
+
+
+def clear_catalogue_cache():
+    _catalogue_cache.clear()
+    for key in redis_conn.scan_iter("transferto_catalogue_*"):
+        redis_conn.delete(key)
+
+
+def clear_failure_notifications():
+    for key in redis_conn.scan_iter("transferto_failure*"):
+        redis_conn.delete(key)
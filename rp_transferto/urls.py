@@ -9,6 +9,16 @@ urlpatterns = [
         views.MsisdnInfo.as_view(),
         name="msisdn_info",
     ),
+    path(
+        "<int:org_id>/bulk_msisdn_info/",
+        views.BulkMsisdnInfo.as_view(),
+        name="bulk_msisdn_info",
+    ),
+    path(
+        "<int:org_id>/bulk_msisdn_info/<int:batch_id>/",
+        views.MsisdnLookupBatchView.as_view(),
+        name="msisdn_lookup_batch",
+    ),
     path("<int:org_id>/reserve_id/", views.ReserveId.as_view(), name="reserve_id"),
     path(
         "<int:org_id>/get_countries/",
@@ -38,6 +48,16 @@ urlpatterns = [
         name="get_country_services",
     ),
     path("<int:org_id>/top_up_data/", views.TopUpData.as_view(), name="top_up_data"),
+    path(
+        "<int:org_id>/topup_batches/",
+        views.TopupBatchView.as_view(),
+        name="create_topup_batch",
+    ),
+    path(
+        "<int:org_id>/topup_batches/<int:batch_id>/",
+        views.TopupBatchDetailView.as_view(),
+        name="topup_batch",
+    ),
     path(
         "<int:org_id>/buy/<int:product_id>/<str:msisdn>/",
         views.BuyProductTakeAction.as_view(),
@@ -1,10 +1,19 @@
 import base64
 import hashlib
 import hmac
+import inspect
+import json
+import re
 import time
+from functools import wraps
 
-import requests
-from prometheus_client import Histogram
+import redis
+from django.conf import settings
+from prometheus_client import Counter, Histogram
+
+from sidekick.utils import get_http_session
+
+redis_conn = redis.from_url(settings.REDIS_URL, decode_responses=True)
 
 transferto_request_time = Histogram(
     "transferto_request_time", "request time for calls to transferto", ["action"]
@@ -15,13 +24,245 @@ transferto_goods_and_services_request_time = Histogram(
     ["action"],
 )
 
+transferto_product_fallbacks = Counter(
+    "transferto_product_fallbacks",
+    "Fallback products for unavailable products, by whether they were bought, "
+    "failed, or skipped because they were known to be unavailable",
+    ["result"],
+)
+
+transferto_catalogue_requests = Counter(
+    "transferto_catalogue_requests",
+    "Lookups of TransferTo catalogue data, by where they were served from",
+    ["method", "source"],
+)
+
+# key -> (fresh until, data)
+_catalogue_cache = {}
+
+# Actions that send airtime or data, which get a longer read timeout
+TOPUP_ACTIONS = {"topup", "simulation", "topup_data"}
+
+
+def get_catalogue_key(account_id, method_name, args):
+    return "transferto_catalogue_{}_{}_{}".format(
+        account_id, method_name, ":".join(map(str, args))
+    )
+
+
+def is_error_response(response):
+    """
+    Whether the response from either of the TransferTo APIs is an error, which
+    shouldn't be cached
+    """
+    return str(response.get("error_code", "0")) != "0" or "errors" in response
+
+
+def normalize_recharge_value(value):
+    """
+    Normalizes a recharge value, eg. "1 GB" or "1GB / 30 Days", to the key used in
+    the product index, eg. "1gb"
+    """
+    return re.sub(r"\s+", "", value.split("/")[0]).lower()
+
+
+def get_catalogue_entry(key):
+    """
+    Returns the cached {"fresh_until", "data"} for the key, from the in-process cache
+    if it is still fresh there, otherwise from Redis. Returns None if not cached.
+    """
+    fresh_until, data = _catalogue_cache.get(key, (0, None))
+    if fresh_until > time.time():
+        return {"fresh_until": fresh_until, "data": data, "source": "local"}
+
+    entry = redis_conn.get(key)
+    if entry is None:
+        return None
+    entry = json.loads(entry)
+    _catalogue_cache[key] = (entry["fresh_until"], entry["data"])
+    entry["source"] = "redis"
+    return entry
+
+
+def claim_catalogue_refresh(key):
+    """
+    Returns True for only one caller at a time, so that a stale entry is only
+    refreshed once
+    """
+    return bool(redis_conn.set(f"{key}_refresh", 1, nx=True, ex=60))
+
+
+def claim_msisdn_refresh(msisdn):
+    """
+    Returns True for only one caller at a time, so that stale MSISDN info is only
+    refreshed once
+    """
+    return bool(
+        redis_conn.set(f"transferto_msisdn_refresh_{msisdn}", 1, nx=True, ex=60)
+    )
+
+
+def claim_msisdn_refreshes(msisdns):
+    """
+    Claims the refresh of each of the MSISDNs, like claim_msisdn_refresh, and
+    returns the ones that were claimed
+    """
+    pipe = redis_conn.pipeline()
+    for msisdn in msisdns:
+        pipe.set(f"transferto_msisdn_refresh_{msisdn}", 1, nx=True, ex=60)
+    return [msisdn for msisdn, claimed in zip(msisdns, pipe.execute()) if claimed]
+
+
+def get_unavailable_product_key(operator_id, product_id):
+    return f"transferto_product_unavailable_{operator_id}_{product_id}"
+
+
+def mark_product_unavailable(operator_id, product_id):
+    """
+    Remembers that buying the product failed for an MSISDN on the operator, so that
+    it can be skipped as a fallback for the operator's other MSISDNs for a while
+    """
+    redis_conn.set(
+        get_unavailable_product_key(operator_id, product_id),
+        1,
+        ex=settings.TRANSFERTO_PRODUCT_UNAVAILABLE_TTL,
+    )
+
+
+def get_unavailable_products(operator_id, product_ids):
+    """
+    Returns the set of products that are known to be unavailable for the operator
+    """
+    if not product_ids:
+        return set()
+    keys = [get_unavailable_product_key(operator_id, p) for p in product_ids]
+    return {p for p, v in zip(product_ids, redis_conn.mget(keys)) if v is not None}
+
+
+def queue_failure_notification(org_id, notification):
+    """
+    Queues a failure notification to be emailed to the org in the next digest.
+    Only the first TRANSFERTO_FAILURE_DIGEST_MAX_EVENTS notifications are kept for
+    each digest, but all of them are counted.
+    """
+    key = f"transferto_failures_{org_id}"
+    pipe = redis_conn.pipeline()
+    pipe.rpush(key, json.dumps(notification, default=str))
+    pipe.ltrim(key, 0, settings.TRANSFERTO_FAILURE_DIGEST_MAX_EVENTS - 1)
+    pipe.incr(f"{key}_count")
+    pipe.sadd("transferto_failure_orgs", org_id)
+    pipe.execute()
+
+
+def get_failure_notification_orgs():
+    return redis_conn.smembers("transferto_failure_orgs")
+
+
+def get_failure_notifications(org_id):
+    """
+    Returns the org's queued failure notifications, and the total number of
+    failures
+    """
+    key = f"transferto_failures_{org_id}"
+    pipe = redis_conn.pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.get(f"{key}_count")
+    notifications, count = pipe.execute()
+    return [json.loads(n) for n in notifications], int(count or 0)
+
+
+def remove_failure_notifications(org_id, notifications, count):
+    """
+    Removes the notifications and count returned by get_failure_notifications,
+    keeping any failures that were queued since then for the next digest
+    """
+    key = f"transferto_failures_{org_id}"
+
+    def remove(pipe):
+        remaining = int(pipe.get(f"{key}_count") or 0) - count
+        pipe.multi()
+        pipe.ltrim(key, len(notifications), -1)
+        if remaining > 0:
+            pipe.set(f"{key}_count", remaining)
+        else:
+            pipe.delete(key, f"{key}_count")
+            pipe.srem("transferto_failure_orgs", org_id)
+
+    redis_conn.transaction(remove, f"{key}_count")
+
+
+def refresh_catalogue_entry(client, method_name, args):
+    """
+    Fetches the catalogue data from TransferTo, and caches it if it isn't an error
+    """
+    method = getattr(TransferToClient, method_name)
+    data = method.__wrapped__(client, *args)
+    if not is_error_response(data):
+        key = get_catalogue_key(client.account_id, method_name, args)
+        ttl = getattr(settings, method.catalogue_ttl_setting)
+        fresh_until = time.time() + ttl
+        # Stale entries are kept for another TTL, to be served while refreshing
+        redis_conn.set(
+            key, json.dumps({"fresh_until": fresh_until, "data": data}), ex=ttl * 2
+        )
+        _catalogue_cache[key] = (fresh_until, data)
+        redis_conn.delete(f"{key}_refresh")
+    return data
+
+
+def cached_catalogue(ttl_setting):
+    """
+    Caches the result of the client method in-process and in Redis, for the number
+    of seconds in the ttl_setting. Once that has passed, the stale result is
+    returned while it is refreshed in the background.
+
+    Only clients for a TransferToAccount are cached, since the catalogue differs
+    per account.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.account_id is None:
+                return func(self, *args, **kwargs)
+
+            # Key on the bound arguments, so positional and keyword calls share
+            # a cache entry
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            args = tuple(bound.arguments.values())[1:]
+            name = func.__name__
+            key = get_catalogue_key(self.account_id, name, args)
+            entry = get_catalogue_entry(key)
+            if entry is None:
+                transferto_catalogue_requests.labels(method=name, source="api").inc()
+                return refresh_catalogue_entry(self, name, args)
+
+            transferto_catalogue_requests.labels(
+                method=name, source=entry["source"]
+            ).inc()
+            if entry["fresh_until"] <= time.time() and claim_catalogue_refresh(key):
+                from .tasks import refresh_transferto_catalogue
+
+                refresh_transferto_catalogue.delay(self.account_id, name, list(args))
+            return entry["data"]
+
+        wrapper.catalogue_ttl_setting = ttl_setting
+        return wrapper
+
+    return decorator
+
 
 class TransferToClient:
-    def __init__(self, login, token, apikey, apisecret):
+    def __init__(self, login, token, apikey, apisecret, account_id=None, session=None):
         self.login = login
         self.token = token
         self.apikey = apikey
         self.apisecret = apisecret
+        self.account_id = account_id
+        self.session = session or get_http_session("transferto")
         self.url = "https://airtime.transferto.com/cgi-bin/shop/topup"
 
     def _convert_response_body(self, body_text):
@@ -35,6 +276,13 @@ class TransferToClient:
             data[key] = value
         return data
 
+    def _get_timeout(self, action):
+        if action in TOPUP_ACTIONS:
+            read_timeout = settings.TRANSFERTO_TOPUP_TIMEOUT
+        else:
+            read_timeout = settings.TRANSFERTO_TIMEOUT
+        return (settings.HTTP_CLIENT_CONNECT_TIMEOUT, read_timeout)
+
     def _make_transferto_request(self, action, **kwargs):
         """
         Returns a dict with response from the TransferTo API
@@ -45,7 +293,9 @@ class TransferToClient:
         md5 = hashlib.md5((self.login + self.token + key).encode("UTF-8")).hexdigest()
         data = dict(login=self.login, key=key, md5=md5, action=action, **kwargs)
         with transferto_request_time.labels(action=action).time():
-            response = requests.post(self.url, data=data)
+            response = self.session.post(
+                self.url, data=data, timeout=self._get_timeout(action)
+            )
         return self._convert_response_body(response.content)
 
     def ping(self):
@@ -68,12 +318,14 @@ class TransferToClient:
         """
         return self._make_transferto_request(action="reserve_id")
 
+    @cached_catalogue("TRANSFERTO_COVERAGE_TTL")
     def get_countries(self):
         """
         Returns list of countries offered to your TransferTo account
         """
         return self._make_transferto_request(action="pricelist", info_type="countries")
 
+    @cached_catalogue("TRANSFERTO_COVERAGE_TTL")
     def get_operators(self, country_id):
         """
         Return the list of operators offered to your account, for a specific country
@@ -87,6 +339,7 @@ class TransferToClient:
                 action="pricelist", info_type="country", content=country_id
             )
 
+    @cached_catalogue("TRANSFERTO_PRICELIST_TTL")
     def get_operator_airtime_products(self, operator_id):
         """
         Returns the list of denomination including wholesale and retail prices offered to your account,
@@ -99,7 +352,7 @@ class TransferToClient:
                 action="pricelist", info_type="operator", content=operator_id
             )
 
-    def make_topup(self, msisdn, product, from_string, reserve_id=None):
+    def make_topup(self, msisdn, product, from_string, reserve_id=None, simulate=False):
         """
         Make
 
@@ -107,13 +360,14 @@ class TransferToClient:
         :param int product: integer representing amount of airtime to send to msisdn
         :param str from_string: either in msisdn form or a name. e.g. "+6012345678" or "John" are all valid.
         :param str reserve_id: [optional] see transferto documentation for more details about reserve id
+        :param bool simulate: [optional] simulate the topup, without sending airtime
         :return: dict of transaction response from transferto
         """
         if type(product) is not int:
             raise TypeError("product arg must be an int")
 
         keyword_args = {
-            "action": "topup",
+            "action": "simulation" if simulate else "topup",
             "destination_msisdn": msisdn,
             "msisdn": from_string,
             "product": product,
@@ -139,17 +393,55 @@ class TransferToClient:
 
         with transferto_goods_and_services_request_time.labels(action=action).time():
             if not body:
-                response = requests.get(url, headers=headers)
+                response = self.session.get(
+                    url, headers=headers, timeout=self._get_timeout(action)
+                )
             else:
-                response = requests.post(url, headers=headers, json=body)
+                response = self.session.post(
+                    url, headers=headers, json=body, timeout=self._get_timeout(action)
+                )
         return response.json()
 
+    @cached_catalogue("TRANSFERTO_PRICELIST_TTL")
     def get_operator_products(self, operator_id):
         product_url = "https://api.transferto.com/v1.1/operators/{}/products".format(
             operator_id
         )
         return self._make_transferto_api_request("get_operator_products", product_url)
 
+    @cached_catalogue("TRANSFERTO_PRICELIST_TTL")
+    def get_operator_product_index(self, operator_id):
+        """
+        Returns a dict mapping the normalized recharge value of each of the
+        operator's fixed value recharges to the product, so that products can be
+        looked up without scanning the product list. If more than one product has
+        the same recharge value, the first one listed is used.
+
+        The other parts of the descriptions, eg. "30 Days" in "1GB / 30 Days", are
+        also indexed, for descriptions that aren't in the usual format, but never
+        replace a recharge value.
+        """
+        products = self.get_operator_products(operator_id)
+        if is_error_response(products):
+            return products
+
+        entries = [
+            {
+                "product_id": product["product_id"],
+                "product_short_desc": product["product_short_desc"],
+            }
+            for product in products["fixed_value_recharges"]
+        ]
+        index = {}
+        for entry in entries:
+            key = normalize_recharge_value(entry["product_short_desc"])
+            index.setdefault(key, entry)
+        for entry in entries:
+            for part in entry["product_short_desc"].split("/")[1:]:
+                index.setdefault(normalize_recharge_value(part), entry)
+        return index
+
+    @cached_catalogue("TRANSFERTO_COVERAGE_TTL")
     def get_country_services(self, country_id):
         service_url = "https://api.transferto.com/v1.1/countries/{}/services".format(
             country_id
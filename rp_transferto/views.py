@@ -1,3 +1,8 @@
+import csv
+import io
+
+import pkg_resources
+from django.conf import settings
 from django.http import JsonResponse
 from rest_framework import status
 from rest_framework.views import APIView
@@ -5,8 +10,19 @@ from rest_framework.views import APIView
 from sidekick.models import Organization
 from sidekick.utils import clean_msisdn
 
-from .models import MsisdnInformation, TopupAttempt
-from .tasks import buy_airtime_take_action, buy_product_take_action, topup_data
+from .models import MsisdnInformation, MsisdnLookupBatch, TopupAttempt, TopupBatch
+from .serializers import TopupBatchSerializer
+from .tasks import (
+    buy_airtime_take_action,
+    buy_product_take_action,
+    lookup_msisdn_information,
+    process_msisdn_lookup_batch,
+    process_topup_batch,
+    refresh_bulk_msisdn_information,
+    refresh_msisdn_information,
+    topup_data,
+)
+from .utils import is_error_response
 
 
 def process_status_code(info):
@@ -83,12 +99,8 @@ class MsisdnInfo(APIView):
             request.GET.get("no_cache", False)
             and request.GET.get("no_cache").lower() == "true"
         )
-        if (
-            use_cache
-            or not MsisdnInformation.objects.filter(
-                msisdn=clean_msisdn(msisdn)
-            ).exists()
-        ):
+        msisdn_info = MsisdnInformation.get_latest(msisdn)
+        if use_cache or msisdn_info is None:
             try:
                 client = org.transferto_account.first().get_transferto_client()
             except AttributeError:
@@ -96,17 +108,97 @@ class MsisdnInfo(APIView):
 
             cleaned_msisdn = clean_msisdn(msisdn)
             info = client.get_misisdn_info(cleaned_msisdn)
-            MsisdnInformation.objects.create(data=info, msisdn=cleaned_msisdn)
+            if not is_error_response(info):
+                MsisdnInformation.objects.create(data=info, msisdn=cleaned_msisdn)
         # get cached result
         else:
-            info = dict(
-                MsisdnInformation.objects.filter(msisdn=clean_msisdn(msisdn))
-                .latest()
-                .data
-            )
+            info = dict(msisdn_info.data)
+            if msisdn_info.is_stale:
+                refresh_msisdn_information.delay(org.id, msisdn_info.msisdn)
         return process_status_code(info)
 
 
+class BulkMsisdnInfo(APIView):
+    """
+    Looks up the info for a list of MSISDNs. Cached info is used where there is
+    some, and the rest is fetched from TransferTo concurrently and cached. If more
+    than TRANSFERTO_BULK_LOOKUP_SYNC_MAX MSISDNs aren't cached, they're looked up
+    in the background instead, and the returned batch ID can be polled for the
+    results.
+    """
+
+    def post(self, request, *args, **kwargs):
+        org_id = kwargs["org_id"]
+
+        try:
+            org = Organization.objects.get(id=org_id)
+        except Organization.DoesNotExist:
+            return JsonResponse(data={}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not org.users.filter(id=request.user.id).exists():
+            return JsonResponse(data={}, status=status.HTTP_401_UNAUTHORIZED)
+
+        msisdns = request.data.get("msisdns")
+        if not isinstance(msisdns, list) or not all(
+            isinstance(msisdn, str) for msisdn in msisdns
+        ):
+            return JsonResponse(
+                {"msisdns": ["A list of MSISDNs is required"]},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(msisdns) > settings.TRANSFERTO_BULK_LOOKUP_MAX:
+            return JsonResponse(
+                {
+                    "msisdns": [
+                        "At most {} MSISDNs can be looked up at a time".format(
+                            settings.TRANSFERTO_BULK_LOOKUP_MAX
+                        )
+                    ]
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        msisdns = list(dict.fromkeys(clean_msisdn(msisdn) for msisdn in msisdns))
+        cached = MsisdnInformation.get_latest_for(msisdns)
+        results = {msisdn: info.data for msisdn, info in cached.items()}
+
+        misses = [msisdn for msisdn in msisdns if msisdn not in cached]
+        if misses:
+            try:
+                client = org.transferto_account.first().get_transferto_client()
+            except AttributeError:
+                return JsonResponse(data={}, status=status.HTTP_400_BAD_REQUEST)
+
+        stale = [msisdn for msisdn, info in cached.items() if info.is_stale]
+        if stale:
+            refresh_bulk_msisdn_information.delay(org.id, stale)
+
+        if len(misses) > settings.TRANSFERTO_BULK_LOOKUP_SYNC_MAX:
+            batch = MsisdnLookupBatch.objects.create(org=org, msisdns=msisdns)
+            process_msisdn_lookup_batch.delay(batch.id)
+            return JsonResponse(
+                {"id": batch.id, "total": len(msisdns)},
+                status=status.HTTP_202_ACCEPTED,
+            )
+
+        if misses:
+            results.update(lookup_msisdn_information(client, misses))
+        return JsonResponse({"results": results})
+
+
+class MsisdnLookupBatchView(APIView):
+    def get(self, request, *args, **kwargs):
+        try:
+            batch = MsisdnLookupBatch.objects.get(
+                id=kwargs["batch_id"],
+                org_id=kwargs["org_id"],
+                org__users=request.user,
+            )
+        except MsisdnLookupBatch.DoesNotExist:
+            return JsonResponse(data={}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse(batch.get_summary())
+
+
 class ReserveId(TransferToView):
     client_method_name = "reserve_id"
 
@@ -248,3 +340,102 @@ class BuyAirtimeTakeAction(APIView):
             fail_flow_start=fail_flow_start,
         )
         return JsonResponse({"info_txt": "buy_airtime_take_action"})
+
+
+class TopupBatchView(APIView):
+    """
+    Creates a batch of airtime topups from a JSON list of recipients, or an uploaded
+    CSV file with msisdn, amount, and optional from_string and user_uuid columns,
+    and sends them in the background.
+    """
+
+    def get_org(self, request, org_id):
+        try:
+            org = Organization.objects.get(id=org_id)
+        except Organization.DoesNotExist:
+            return None, JsonResponse(data={}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not org.users.filter(id=request.user.id).exists():
+            return None, JsonResponse(data={}, status=status.HTTP_401_UNAUTHORIZED)
+        return org, None
+
+    def post(self, request, *args, **kwargs):
+        org, error_response = self.get_org(request, kwargs["org_id"])
+        if error_response:
+            return error_response
+
+        try:
+            # check that there is a valid  TransferTo Account attached
+            org.transferto_account.first().get_transferto_client()
+        except AttributeError:
+            return JsonResponse(data={}, status=status.HTTP_400_BAD_REQUEST)
+
+        data = request.data
+        if "file" in request.FILES:
+            data = {
+                "recipients": list(
+                    csv.DictReader(io.TextIOWrapper(request.FILES["file"], "utf-8"))
+                ),
+                "from_string": request.data.get("from_string", ""),
+                "simulate": request.data.get("simulate", False),
+            }
+        serializer = TopupBatchSerializer(data=data)
+        if not serializer.is_valid():
+            return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        recipients = serializer.validated_data["recipients"]
+        if len(recipients) > settings.TRANSFERTO_BATCH_MAX:
+            return JsonResponse(
+                {
+                    "recipients": [
+                        "At most {} recipients can be sent to at a time".format(
+                            settings.TRANSFERTO_BATCH_MAX
+                        )
+                    ]
+                },
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        batch = TopupBatch.objects.create(
+            org=org, simulate=serializer.validated_data["simulate"]
+        )
+        version = pkg_resources.get_distribution("rp-sidekick").version
+        TopupAttempt.objects.bulk_create(
+            [
+                TopupAttempt(
+                    sidekick_version=version,
+                    msisdn=clean_msisdn(recipient["msisdn"]),
+                    from_string=recipient.get("from_string")
+                    or serializer.validated_data["from_string"],
+                    amount=recipient["amount"],
+                    rapidpro_user_uuid=recipient.get("user_uuid") or None,
+                    org=org,
+                    batch=batch,
+                )
+                for recipient in recipients
+            ],
+            batch_size=1000,
+        )
+
+        process_topup_batch.delay(batch.id)
+        return JsonResponse(
+            {"id": batch.id, "total": len(recipients)}, status=status.HTTP_202_ACCEPTED
+        )
+
+
+class TopupBatchDetailView(TopupBatchView):
+    """
+    Returns the summary of a batch of airtime topups
+    """
+
+    http_method_names = ["get", "head", "options"]
+
+    def get(self, request, *args, **kwargs):
+        org, error_response = self.get_org(request, kwargs["org_id"])
+        if error_response:
+            return error_response
+
+        try:
+            batch = org.topup_batches.get(id=kwargs["batch_id"])
+        except TopupBatch.DoesNotExist:
+            return JsonResponse(data={}, status=status.HTTP_404_NOT_FOUND)
+        return JsonResponse(batch.get_summary())
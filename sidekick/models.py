@@ -1,9 +1,12 @@
+import hashlib
+import time
+from functools import cached_property, lru_cache
 from uuid import UUID
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.urls import reverse
 from hashids import Hashids
@@ -12,6 +15,17 @@ from temba_client.v2 import TembaClient
 
 hashids = Hashids(salt=settings.SECRET_KEY)
 
+# pk -> (expiry, consent), see Consent.get_cached
+_consent_cache = {}
+
+
+@lru_cache(maxsize=10000)
+def decode_consent_code(code):
+    """
+    Consent codes never change meaning, so decoding them can be cached indefinitely
+    """
+    return hashids.decode(code)
+
 
 class Organization(models.Model):
     name = models.CharField(max_length=200, null=False, blank=False)
@@ -105,6 +119,22 @@ class Consent(models.Model):
         help_text="The HTML body to display to the user while redirecting. Not escaped",
     )
 
+    @cached_property
+    def version(self):
+        """
+        A hash of the fields that are displayed to the user, that changes whenever
+        the page that we render for this Consent would change
+        """
+        fields = [
+            self.pk,
+            self.preview_title,
+            self.preview_url,
+            self.preview_description,
+            self.preview_image_url,
+            self.body,
+        ]
+        return hashlib.md5("\0".join(map(str, fields)).encode()).hexdigest()
+
     def generate_code(self, contact_uuid):
         return hashids.encode(self.id, contact_uuid.int)
 
@@ -116,16 +146,49 @@ class Consent(models.Model):
         path = reverse("redirect-consent", args=[code])
         return request.build_absolute_uri(path)
 
+    def generate_urls(self, request, contact_uuids):
+        """
+        Returns (contact uuid, URL) for each of the contacts. The base URL is only
+        built once, so this is suitable for large numbers of contacts.
+        """
+        url = request.build_absolute_uri(reverse("redirect-consent", args=["code"]))
+        base_url = url[: -len("code")]
+        for contact_uuid in contact_uuids:
+            yield contact_uuid, base_url + self.generate_code(contact_uuid)
+
     @classmethod
     def from_code(cls, code):
         """
         Returns (consent, contact_uuid) for the given code, where consent is a Consent
         model instance, and contact_uuid is the UUID of the RapidPro contact.
         """
-        id, contact_uuid = hashids.decode(code)
-        consent = Consent.objects.get(id=id)
+        id, contact_uuid = decode_consent_code(code)
+        consent = Consent.get_cached(id)
         contact_uuid = UUID(int=contact_uuid)
         return consent, contact_uuid
 
+    @classmethod
+    def get_cached(cls, pk):
+        """
+        Returns the Consent from an in-process cache, so that the spikes of visits
+        when a campaign goes out don't each need a database query. Entries are
+        removed when the Consent is changed, and expire after CONSENT_CACHE_TTL
+        seconds so that changes made in other processes are picked up.
+        """
+        now = time.monotonic()
+        entry = _consent_cache.get(pk)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        consent = cls.objects.get(id=pk)
+        _consent_cache[pk] = (now + settings.CONSENT_CACHE_TTL, consent)
+        return consent
+
     def __str__(self):
         return self.label
+
+
+@receiver(post_save, sender=Consent)
+@receiver(post_delete, sender=Consent)
+def invalidate_consent_cache(sender, instance, **kwargs):
+    _consent_cache.pop(instance.pk, None)
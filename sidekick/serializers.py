@@ -17,6 +17,24 @@ class RapidProFlowWebhookSerializer(serializers.Serializer):
     contact = Contact()
 
 
+class BulkConsentURLSerializer(serializers.Serializer):
+    """
+    Serializer for the body of the GetBulkConsentURLsView. Either a list of contact
+    UUIDs, or a RapidPro group to fetch the contacts from, must be given.
+    """
+
+    contacts = serializers.ListField(child=serializers.UUIDField(), required=False)
+    group = serializers.CharField(required=False)
+    format = serializers.ChoiceField(choices=["csv", "ndjson"], default="csv")
+
+    def validate(self, data):
+        if ("contacts" in data) == ("group" in data):
+            raise serializers.ValidationError(
+                "Exactly one of contacts or group is required"
+            )
+        return data
+
+
 class LabelTurnConversationSerializer(serializers.Serializer):
     """ "
     Serializer for the query parameters of the LabelTurnConversationView
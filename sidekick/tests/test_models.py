@@ -69,3 +69,22 @@ class ConsentModelTests(TestCase):
 
         self.assertEqual(result_consent, consent)
         self.assertEqual(result_uuid, uuid)
+
+    def test_fetch_from_url_cached(self):
+        """
+        Fetching the same Consent again shouldn't query the database, until the
+        Consent is changed
+        """
+        org = Organization.objects.create()
+        consent = Consent.objects.create(org=org, label="before")
+        code = hashids.encode(consent.id, uuid4().int)
+        Consent.from_code(code)
+
+        with self.assertNumQueries(0):
+            result_consent, _ = Consent.from_code(code)
+        self.assertEqual(result_consent.label, "before")
+
+        consent.label = "after"
+        consent.save()
+        result_consent, _ = Consent.from_code(code)
+        self.assertEqual(result_consent.label, "after")
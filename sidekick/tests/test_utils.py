@@ -3,7 +3,7 @@ from unittest.mock import Mock, patch
 
 import pkg_resources
 import responses
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
 from sidekick import utils
@@ -395,3 +395,90 @@ class UtilsTests(TestCase):
             utils.get_flow_url(test_org, flow_uuid),
             "{}flow/editor/{}".format(base_url, flow_uuid),
         )
+
+    def test_get_http_session(self):
+        """
+        Sessions with a key are reused, and only GET requests are retried after
+        being sent
+        """
+        session = utils.get_http_session("test", 1)
+        self.assertIs(utils.get_http_session("test", 1), session)
+        self.assertIsNot(utils.get_http_session("test", 2), session)
+        self.assertIsNot(utils.get_http_session("test"), utils.get_http_session("test"))
+
+        retries = session.get_adapter("https://example.org").max_retries
+        self.assertTrue(retries.is_retry("GET", 503))
+        self.assertFalse(retries.is_retry("POST", 503))
+
+    @responses.activate
+    def test_get_http_session_metrics(self):
+        responses.add(responses.GET, "https://example.org/", status=200)
+        session = utils.get_http_session("test")
+        before = utils.http_client_requests.labels(
+            client="test", connection="reused"
+        )._value.get()
+
+        session.get("https://example.org/")
+
+        self.assertEqual(
+            utils.http_client_requests.labels(
+                client="test", connection="reused"
+            )._value.get(),
+            before + 1,
+        )
+
+    def test_log_event(self):
+        """
+        Events should be logged as compact JSON, and only encoded if they're emitted
+        """
+        logger = Mock(spec=["info"])
+        utils.log_event(logger, "test", payload={"a": [1, 2]})
+
+        fmt, message = logger.info.call_args.args
+        self.assertIsInstance(message, utils.JSONMessage)
+        self.assertEqual(fmt % message, '{"event":"test","payload":{"a":[1,2]}}')
+
+    def test_log_payload(self):
+        logger = Mock(spec=["info", "isEnabledFor"])
+        logger.isEnabledFor.return_value = True
+
+        with override_settings(PAYMENT_LOG_PAYLOAD_SAMPLE_RATE=1):
+            utils.log_payload(logger, "test", {"a": 1})
+        self.assertTrue(logger.info.called)
+
+        logger.reset_mock()
+        with override_settings(PAYMENT_LOG_PAYLOAD_SAMPLE_RATE=0):
+            utils.log_payload(logger, "test", {"a": 1})
+        self.assertFalse(logger.info.called)
+
+        logger.isEnabledFor.return_value = False
+        with override_settings(PAYMENT_LOG_PAYLOAD_SAMPLE_RATE=1):
+            utils.log_payload(logger, "test", {"a": 1})
+        self.assertFalse(logger.info.called)
+
+    def test_is_crawler(self):
+        self.assertTrue(utils.is_crawler("WhatsApp/2.23.20.0 A"))
+        self.assertTrue(
+            utils.is_crawler("facebookexternalhit/1.1 (+http://www.facebook.com/)")
+        )
+        self.assertTrue(
+            utils.is_crawler(
+                "Mozilla/5.0 (compatible; Googlebot/2.1; "
+                "+http://www.google.com/bot.html)"
+            )
+        )
+        self.assertFalse(utils.is_crawler(None))
+        # Real devices whose names contain "bot"
+        self.assertFalse(
+            utils.is_crawler(
+                "Mozilla/5.0 (Linux; Android 11; CUBOT KINGKONG 5 Pro) "
+                "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 "
+                "Mobile Safari/537.36"
+            )
+        )
+        self.assertFalse(
+            utils.is_crawler(
+                "Mozilla/5.0 (Linux; Android 10; Robot-X1) AppleWebKit/537.36 "
+                "(KHTML, like Gecko) Chrome/114.0.0.0 Mobile Safari/537.36"
+            )
+        )
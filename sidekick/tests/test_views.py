@@ -9,6 +9,7 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Permission
 from django.db.utils import OperationalError
+from django.template.loader import render_to_string
 from django.test import TestCase
 from django.test.utils import override_settings
 from django.urls import reverse
@@ -18,6 +19,7 @@ from rest_framework.test import APIClient, APITestCase
 from temba_client.exceptions import TembaConnectionError
 
 from sidekick.models import Consent, Organization
+from sidekick.utils import redis_conn
 
 from .utils import create_org
 
@@ -58,21 +60,32 @@ class DetailedHealthViewTest(APITestCase):
     def setUp(self):
         self.api_client = APIClient()
 
-    def mock_queue_lookup(self, name="rp_sidekick", messages=1256, rate=1.25):
+    def mock_queue_lookup(
+        self, name="rp_sidekick", messages=1256, rate=1.25, ack_rate=None
+    ):
+        data = {
+            "messages": messages,
+            "messages_details": {"rate": rate},
+            "name": name,
+            "consumers": 4,
+        }
+        if ack_rate is not None:
+            data["message_stats"] = {"ack_details": {"rate": ack_rate}}
         responses.add(
             responses.GET,
             "{}{}".format(settings.RABBITMQ_MANAGEMENT_INTERFACE, name),
-            json={
-                "messages": messages,
-                "messages_details": {"rate": rate},
-                "name": name,
-            },
+            json=data,
             status=200,
         )
 
+    def mock_other_queue_lookups(self):
+        for queue in settings.CELERY_QUEUES[1:]:
+            self.mock_queue_lookup(name=queue.name, messages=0, rate=0.0)
+
     @responses.activate
     def test_detailed_health_endpoint_not_stuck_and_db_available(self):
         self.mock_queue_lookup()
+        self.mock_other_queue_lookups()
 
         response = self.api_client.get(reverse("detailed-health"))
 
@@ -80,15 +93,57 @@ class DetailedHealthViewTest(APITestCase):
         self.assertFalse(response.json()["queues"][0]["stuck"])
         self.assertTrue(response.json()["db_available"])
 
+    @responses.activate
+    def test_detailed_health_endpoint_queue_metrics(self):
+        self.mock_queue_lookup(messages=100, ack_rate=20.0)
+        self.mock_other_queue_lookups()
+
+        response = self.api_client.get(reverse("detailed-health"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        queues = response.json()["queues"]
+        self.assertEqual(
+            [q["name"] for q in queues], [q.name for q in settings.CELERY_QUEUES]
+        )
+        self.assertEqual(queues[0]["consumers"], 4)
+        self.assertEqual(queues[0]["ack_rate"], 20.0)
+        self.assertEqual(queues[0]["latency"], 5.0)
+        self.assertIsNone(queues[1]["latency"])
+
     @responses.activate
     def test_detailed_health_endpoint_stuck(self):
         self.mock_queue_lookup(rate=0.0)
+        self.mock_other_queue_lookups()
 
         response = self.api_client.get(reverse("detailed-health"))
 
         self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
         self.assertTrue(response.json()["queues"][0]["stuck"])
 
+    @responses.activate
+    def test_detailed_health_endpoint_queue_missing(self):
+        """
+        Queues that haven't been declared yet should be reported as missing
+        """
+        self.mock_queue_lookup()
+        for queue in settings.CELERY_QUEUES[1:]:
+            responses.add(
+                responses.GET,
+                "{}{}".format(settings.RABBITMQ_MANAGEMENT_INTERFACE, queue.name),
+                json={"error": "Object Not Found", "reason": "Not Found"},
+                status=404,
+            )
+
+        response = self.api_client.get(reverse("detailed-health"))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        queues = response.json()["queues"]
+        self.assertFalse(queues[0]["missing"])
+        self.assertEqual(
+            queues[1],
+            {"name": settings.CELERY_QUEUES[1].name, "missing": True, "stuck": False},
+        )
+
     @override_settings(RABBITMQ_MANAGEMENT_INTERFACE=False)
     def test_detailed_health_endpoint_deactivated(self):
         response = self.api_client.get(reverse("detailed-health"))
@@ -467,6 +522,122 @@ class GetConsentURLViewTest(APITestCase):
         )
 
 
+class GetBulkConsentURLsViewTest(APITestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user("test")
+        user.user_permissions.add(Permission.objects.get(name="Can add consent"))
+        self.client.force_authenticate(user)
+        self.org = create_org()
+        self.consent = Consent.objects.create(org=self.org, flow_id=uuid4())
+        self.url = reverse("get-bulk-consent-urls", args=[self.consent.id])
+
+    def test_contacts_or_group_required(self):
+        """
+        Exactly one of contacts or group should be given
+        """
+        response = self.client.post(self.url, {}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            self.url, {"contacts": [str(uuid4())], "group": "test"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_contacts_csv(self):
+        """
+        Should stream a CSV with the URL for each contact
+        """
+        contact1, contact2 = uuid4(), uuid4()
+        response = self.client.post(
+            self.url, {"contacts": [str(contact1), str(contact2)]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        request = response.wsgi_request
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            "contact,url\r\n"
+            f"{contact1},{self.consent.generate_url(request, contact1)}\r\n"
+            f"{contact2},{self.consent.generate_url(request, contact2)}\r\n",
+        )
+
+    @patch("temba_client.v2.TembaClient.get_contacts")
+    def test_group_ndjson(self, mock_get_contacts):
+        """
+        Should stream newline delimited JSON with the URL for each contact in the
+        RapidPro group
+        """
+        contact1, contact2 = uuid4(), uuid4()
+        mock_get_contacts.return_value.iterfetches.return_value = [
+            [Mock(uuid=str(contact1))],
+            [Mock(uuid=str(contact2))],
+        ]
+        response = self.client.post(
+            self.url, {"group": "campaign", "format": "ndjson"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        request = response.wsgi_request
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(row) for row in rows],
+            [
+                {
+                    "contact": str(contact),
+                    "url": self.consent.generate_url(request, contact),
+                }
+                for contact in (contact1, contact2)
+            ],
+        )
+        mock_get_contacts.assert_called_once_with(group="campaign")
+
+    @patch("temba_client.v2.TembaClient.get_contacts")
+    def test_group_first_page_error(self, mock_get_contacts):
+        """
+        If the first page of the group can't be fetched, an error status should be
+        returned
+        """
+
+        def batches():
+            raise TembaConnectionError()
+            yield
+
+        mock_get_contacts.return_value.iterfetches.return_value = batches()
+        response = self.client.post(self.url, {"group": "campaign"}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @patch("temba_client.v2.TembaClient.get_contacts")
+    def test_group_later_page_error(self, mock_get_contacts):
+        """
+        If a later page of the group can't be fetched, the stream should end with an
+        error row
+        """
+        contact = uuid4()
+
+        def batches():
+            yield [Mock(uuid=str(contact))]
+            raise TembaConnectionError()
+
+        mock_get_contacts.return_value.iterfetches.return_value = batches()
+        response = self.client.post(
+            self.url, {"group": "campaign", "format": "ndjson"}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(rows[0])["contact"], str(contact))
+        self.assertEqual(
+            json.loads(rows[1]),
+            {"error": "Unable to fetch the group contacts: Unable to connect to host"},
+        )
+
+        mock_get_contacts.return_value.iterfetches.return_value = batches()
+        response = self.client.post(self.url, {"group": "campaign"}, format="json")
+        self.assertEqual(
+            b"".join(response.streaming_content).decode().splitlines()[-1],
+            "error,Unable to fetch the group contacts: Unable to connect to host",
+        )
+
+
 class ConsentRedirectViewTests(TestCase):
     def test_bad_code(self):
         """
@@ -513,8 +684,55 @@ class ConsentRedirectViewTests(TestCase):
         self.assertContains(response, "example.org/preview")
         self.assertContains(response, "example.org/image")
 
+    def test_cache_headers(self):
+        """
+        The response should be cacheable, and a matching If-None-Match should get a
+        Not Modified response
+        """
+        org = Organization.objects.create()
+        consent = Consent.objects.create(org=org, flow_id=uuid4())
+        code = consent.generate_code(uuid4())
+        url = reverse("redirect-consent", args=[code])
+
+        response = self.client.get(url)
+        self.assertIn("max-age=3600", response["Cache-Control"])
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_rendered_once_per_version(self):
+        """
+        The page should only be rendered once for each version of the Consent, with
+        the URL for each code substituted in
+        """
+        org = Organization.objects.create()
+        consent = Consent.objects.create(org=org, flow_id=uuid4(), body="first")
+        code1 = consent.generate_code(uuid4())
+        code2 = consent.generate_code(uuid4())
+
+        with patch(
+            "sidekick.views.render_to_string", wraps=render_to_string
+        ) as render_mock:
+            response = self.client.get(reverse("redirect-consent", args=[code1]))
+            self.assertContains(response, reverse("provide-consent", args=[code1]))
+            response = self.client.get(reverse("redirect-consent", args=[code2]))
+            self.assertContains(response, reverse("provide-consent", args=[code2]))
+            self.assertEqual(render_mock.call_count, 1)
+
+            consent.body = "second"
+            consent.save()
+            response = self.client.get(reverse("redirect-consent", args=[code1]))
+            self.assertContains(response, "second")
+            self.assertEqual(render_mock.call_count, 2)
+
 
 class ProvideConsentViewTest(APITestCase):
+    def tearDown(self):
+        for key in redis_conn.scan_iter("consent_flow_start_*"):
+            redis_conn.delete(key)
+
     def test_invalid_code(self):
         """
         If an invalid code is given, we should respond with a Bad Request error
@@ -540,6 +758,66 @@ class ProvideConsentViewTest(APITestCase):
             org, str(contact_uuid), str(consent.flow_id)
         )
 
+    @override_settings(CONSENT_DEDUP_WINDOW=60)
+    @patch("sidekick.tasks.start_flow")
+    def test_duplicate_clicks(self, start_flow_mock):
+        """
+        Repeated clicks by the same contact should only start the flow once
+        """
+        org = Organization.objects.create()
+        consent = Consent.objects.create(
+            org=org, flow_id=uuid4(), redirect_url="http://example.org"
+        )
+        code = consent.generate_code(uuid4())
+        url = reverse("provide-consent", args=[code])
+
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertRedirects(
+            response, "http://example.org", fetch_redirect_response=False
+        )
+        start_flow_mock.assert_called_once()
+
+        self.client.get(
+            reverse("provide-consent", args=[consent.generate_code(uuid4())])
+        )
+        self.assertEqual(start_flow_mock.call_count, 2)
+
+    @override_settings(CONSENT_DEDUP_WINDOW=0)
+    @patch("sidekick.tasks.start_flow")
+    def test_duplicate_clicks_disabled(self, start_flow_mock):
+        """
+        If deduplication is disabled, every click should start the flow
+        """
+        org = Organization.objects.create()
+        consent = Consent.objects.create(org=org, flow_id=uuid4())
+        url = reverse("provide-consent", args=[consent.generate_code(uuid4())])
+
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(start_flow_mock.call_count, 2)
+
+    @patch("sidekick.tasks.start_flow")
+    def test_crawler(self, start_flow_mock):
+        """
+        Link crawlers should be redirected without starting the flow
+        """
+        org = Organization.objects.create()
+        consent = Consent.objects.create(
+            org=org, flow_id=uuid4(), redirect_url="http://example.org"
+        )
+        url = reverse("provide-consent", args=[consent.generate_code(uuid4())])
+
+        response = self.client.get(url, HTTP_USER_AGENT="WhatsApp/2.23.20.0 A")
+        self.assertRedirects(
+            response, "http://example.org", fetch_redirect_response=False
+        )
+        start_flow_mock.assert_not_called()
+
+        # The crawler shouldn't use up the contact's click
+        self.client.get(url, HTTP_USER_AGENT="Mozilla/5.0 (Linux; Android 13)")
+        start_flow_mock.assert_called_once()
+
     def test_redirect_url(self):
         """
         If the Consent has a redirect url configured, we should redirect to that URL
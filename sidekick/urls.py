@@ -21,6 +21,11 @@ urlpatterns = [
         views.GetConsentURLView.as_view(),
         name="get-consent-url",
     ),
+    path(
+        "api/consent/<int:pk>/bulk",
+        views.GetBulkConsentURLsView.as_view(),
+        name="get-bulk-consent-urls",
+    ),
     path(
         "consent/<str:code>",
         views.ConsentRedirectView.as_view(),
@@ -1,9 +1,15 @@
 import json
+import logging
+import random
+import re
 from urllib.parse import urljoin
 
 import pkg_resources
+import redis
 import requests
+from django.conf import settings
 from django.utils import timezone
+from prometheus_client import Counter
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from rest_framework import status
@@ -12,6 +18,35 @@ from temba_client.v2 import TembaClient
 
 from .models import Organization
 
+redis_conn = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+consent_flow_starts_suppressed = Counter(
+    "consent_flow_starts_suppressed",
+    "Consent clicks that didn't start a flow, because they were duplicates or were "
+    "made by a link crawler",
+    ["reason"],
+)
+
+# Link preview and prefetch crawlers that visit consent links without the user.
+# Only specific tokens are matched, since eg. some device names contain "bot".
+CRAWLER_USER_AGENT_REGEX = re.compile(
+    r"\b(?:facebookexternalhit|facebot|googlebot|bingbot|slurp|duckduckbot|"
+    r"baiduspider|yandexbot|applebot|twitterbot|linkedinbot|slackbot|telegrambot|"
+    r"discordbot|skypeuripreview|pinterestbot|redditbot|embedly|outbrain|vkshare|"
+    r"w3c_validator)\b|\bwhatsapp/",
+    re.IGNORECASE,
+)
+
+http_client_requests = Counter(
+    "http_client_requests",
+    "Requests made through pooled HTTP sessions, by whether they reused a kept-alive "
+    "connection or had to open a new one",
+    ["client", "connection"],
+)
+
+# (client, key) -> requests session
+_http_sessions = {}
+
 
 def get_today():
     return timezone.now().date()
@@ -253,3 +288,102 @@ def start_flow(org, user_uuid, flow_uuid):
     rapidpro_client.create_flow_start(
         flow_uuid, contacts=[user_uuid], restart_participants=True
     )
+
+
+def is_crawler(user_agent):
+    return bool(CRAWLER_USER_AGENT_REGEX.search(user_agent or ""))
+
+
+def claim_consent_flow_start(consent_id, contact_uuid, window):
+    """
+    Returns True for the first consent click for the contact in the window, and False
+    for any repeated clicks after that
+    """
+    if not window:
+        return True
+    key = f"consent_flow_start_{consent_id}_{contact_uuid}"
+    return bool(redis_conn.set(key, 1, nx=True, ex=window))
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    Counts how many requests reuse a kept-alive connection from the pool
+    """
+
+    def __init__(self, client, *args, **kwargs):
+        self.client = client
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, *args, **kwargs):
+        pool = self.poolmanager.connection_from_url(request.url)
+        opened = pool.num_connections
+        response = super().send(request, *args, **kwargs)
+        connection = "new" if pool.num_connections > opened else "reused"
+        http_client_requests.labels(client=self.client, connection=connection).inc()
+        return response
+
+
+def get_http_session(client, key=None):
+    """
+    Returns a requests session that keeps connections alive between requests.
+
+    Only GET requests are retried after the request was sent, since other requests
+    might not be idempotent. Requests that failed to connect are retried for all
+    methods, since they never reached the server.
+
+    If a key is given, the same session is returned for every call with that client
+    and key, so that connections are reused across client instances.
+    """
+    if key is not None and (client, key) in _http_sessions:
+        return _http_sessions[(client, key)]
+
+    retries = Retry(
+        total=settings.HTTP_CLIENT_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    adapter = PooledHTTPAdapter(
+        client, pool_maxsize=settings.HTTP_CLIENT_POOL_SIZE, max_retries=retries
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    if key is not None:
+        _http_sessions[(client, key)] = session
+    return session
+
+
+class JSONMessage:
+    """
+    A log message that is only encoded, as compact JSON, if the record is emitted
+    """
+
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data, separators=(",", ":"), default=str)
+
+
+def log_event(logger, event, **fields):
+    """
+    Logs the event and its fields as a single line of JSON
+    """
+    logger.info("%s", JSONMessage(dict(event=event, **fields)))
+
+
+def log_payload(logger, event, payload, **fields):
+    """
+    Logs a full API payload for PAYMENT_LOG_PAYLOAD_SAMPLE_RATE of the calls, since
+    payloads can be large
+    """
+    if (
+        logger.isEnabledFor(logging.INFO)
+        and random.random() < settings.PAYMENT_LOG_PAYLOAD_SAMPLE_RATE
+    ):
+        log_event(logger, event, payload=payload, **fields)
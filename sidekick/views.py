@@ -1,26 +1,37 @@
+import csv
 import json
+from itertools import chain
 from os import environ
 from urllib.parse import urljoin
+from uuid import UUID
 
 import requests
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import connections
 from django.db.utils import OperationalError
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, reverse
-from django.views.generic import TemplateView
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.html import escape
+from django.views import View
 from rest_framework import status
 from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import AllowAny, DjangoModelPermissions
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from temba_client.exceptions import TembaConnectionError, TembaRateExceededError
+from temba_client.exceptions import (
+    TembaConnectionError,
+    TembaException,
+    TembaRateExceededError,
+)
 
 from .models import Consent, Organization
 from .serializers import (
     URN_REGEX,
     ArchiveTurnConversationSerializer,
+    BulkConsentURLSerializer,
     LabelTurnConversationSerializer,
     RapidProFlowWebhookSerializer,
 )
@@ -29,7 +40,14 @@ from .tasks import (
     archive_turn_conversation,
     start_flow_task,
 )
-from .utils import clean_message, get_whatsapp_contacts, send_whatsapp_template_message
+from .utils import (
+    claim_consent_flow_start,
+    clean_message,
+    consent_flow_starts_suppressed,
+    get_whatsapp_contacts,
+    is_crawler,
+    send_whatsapp_template_message,
+)
 
 
 def health(request):
@@ -45,17 +63,33 @@ def detailed_health(request):
     if settings.RABBITMQ_MANAGEMENT_INTERFACE:
         message = "queues ok"
         for queue in settings.CELERY_QUEUES:
-            queue_results = requests.get(
+            response = requests.get(
                 "{}{}".format(settings.RABBITMQ_MANAGEMENT_INTERFACE, queue.name)
-            ).json()
-
+            )
+            queue_results = response.json() if response.ok else {}
+            if "messages_details" not in queue_results:
+                # Queues are only declared once something is sent to them
+                queues.append({"name": queue.name, "missing": True, "stuck": False})
+                continue
+
+            messages = queue_results.get("messages")
+            ack_rate = (
+                queue_results.get("message_stats", {})
+                .get("ack_details", {})
+                .get("rate")
+            )
             details = {
-                "name": queue_results["name"],
+                "name": queue_results.get("name", queue.name),
+                "missing": False,
                 "stuck": False,
-                "messages": queue_results.get("messages"),
+                "messages": messages,
                 "rate": queue_results["messages_details"]["rate"],
+                "consumers": queue_results.get("consumers"),
+                "ack_rate": ack_rate,
+                # Estimate of how long a message joining the queue now will wait
+                "latency": round((messages or 0) / ack_rate, 2) if ack_rate else None,
             }
-            if details["messages"] > 0 and details["rate"] == 0:
+            if (details["messages"] or 0) > 0 and details["rate"] == 0:
                 stuck = True
                 details["stuck"] = True
 
@@ -176,28 +210,137 @@ class GetConsentURLView(GenericAPIView):
         return JsonResponse({"url": consent.generate_url(request, contact_uuid)})
 
 
-class ConsentRedirectView(TemplateView):
+class Echo:
+    """
+    A file-like object that just returns what is written to it, for streaming the
+    output of csv.writer
+    """
+
+    def write(self, value):
+        return value
+
+
+class GetBulkConsentURLsView(GenericAPIView):
+    queryset = Consent.objects.all()
+    permission_classes = (DjangoModelPermissions,)
+    serializer_class = BulkConsentURLSerializer
+
+    def post(self, request, pk):
+        """
+        Streams the consent URL for each of the given contacts, or each of the
+        contacts in the given RapidPro group, as CSV or newline delimited JSON
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        consent = self.get_object()
+
+        if "group" in serializer.validated_data:
+            # Fetch the first page before streaming starts, so that RapidPro errors
+            # there get an error status
+            client = consent.org.get_rapidpro_client()
+            batches = iter(
+                client.get_contacts(
+                    group=serializer.validated_data["group"]
+                ).iterfetches(retry_on_rate_exceed=True)
+            )
+            try:
+                first_batch = next(batches, [])
+            except TembaException as e:
+                return JsonResponse(
+                    {"error": f"Unable to fetch the group contacts: {e}"},
+                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+            contact_uuids = self.get_group_contacts(chain([first_batch], batches))
+        else:
+            contact_uuids = serializer.validated_data["contacts"]
+        urls = consent.generate_urls(request, contact_uuids)
+
+        if serializer.validated_data["format"] == "ndjson":
+
+            def format_row(contact, url):
+                return json.dumps({"contact": contact, "url": url}) + "\n"
+
+            def format_error(error):
+                return json.dumps({"error": error}) + "\n"
+
+            header = []
+            content_type = "application/x-ndjson"
+        else:
+            writer = csv.writer(Echo())
+
+            def format_row(contact, url):
+                return writer.writerow([contact, url])
+
+            def format_error(error):
+                return writer.writerow(["error", error])
+
+            header = [format_row("contact", "url")]
+            content_type = "text/csv"
+
+        def rows():
+            yield from header
+            try:
+                for contact_uuid, url in urls:
+                    yield format_row(str(contact_uuid), url)
+            except TembaException as e:
+                # The status has already been sent, so end with an error row rather
+                # than silently truncating the response
+                yield format_error(f"Unable to fetch the group contacts: {e}")
+
+        return StreamingHttpResponse(rows(), content_type=content_type)
+
+    def get_group_contacts(self, batches):
+        for batch in batches:
+            for contact in batch:
+                yield UUID(contact.uuid)
+
+
+# Placeholder for the per-code URL in the cached consent pages
+CONSENT_URL_PLACEHOLDER = "__sidekick_consent_url__"
+
+
+class ConsentRedirectView(View):
     """
     This is a view to redirect the user to the actual consent page. This is done using
     a meta refresh tag, so that only when the user visits using a browser does it count
     as consent. This is to avoid the request from WhatsApp to get the media-embed tags
     counting as an opt-in.
+
+    The page only differs by URL for each code, so it is rendered once per version of
+    the Consent, and the URL substituted in for each request.
     """
 
     template_name = "sidekick/consent.html"
+    # consent pk -> (consent version, rendered page)
+    rendered_pages = {}
 
     def get(self, request, code):
         try:
             consent, _ = Consent.from_code(code)
         except (ValueError, Consent.DoesNotExist):
             return HttpResponse("invalid code", status=status.HTTP_400_BAD_REQUEST)
-        return super().get(request, code=code, consent=consent)
 
-    def get_context_data(self, code, consent, **kwargs):
-        context = super().get_context_data(**kwargs)
-        context["url"] = reverse("provide-consent", args=[code])
-        context["consent"] = consent
-        return context
+        etag = f'"{consent.version}-{code}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            url = reverse("provide-consent", args=[code])
+            page = self.get_page(consent).replace(CONSENT_URL_PLACEHOLDER, escape(url))
+            response = HttpResponse(page)
+        response["ETag"] = etag
+        patch_cache_control(
+            response, public=True, max_age=settings.CONSENT_PAGE_MAX_AGE
+        )
+        return response
+
+    def get_page(self, consent):
+        version, page = self.rendered_pages.get(consent.pk, (None, None))
+        if version != consent.version:
+            page = render_to_string(
+                self.template_name,
+                {"consent": consent, "url": CONSENT_URL_PLACEHOLDER},
+            )
+            self.rendered_pages[consent.pk] = (consent.version, page)
+        return page
 
 
 class ProvideConsentView(APIView):
@@ -214,9 +357,16 @@ class ProvideConsentView(APIView):
             return Response("invalid code", status=status.HTTP_400_BAD_REQUEST)
 
         if consent.flow_id:
-            start_flow_task.delay(
-                consent.org_id, str(contact_uuid), str(consent.flow_id)
-            )
+            if is_crawler(request.META.get("HTTP_USER_AGENT")):
+                consent_flow_starts_suppressed.labels(reason="crawler").inc()
+            elif not claim_consent_flow_start(
+                consent.id, contact_uuid, settings.CONSENT_DEDUP_WINDOW
+            ):
+                consent_flow_starts_suppressed.labels(reason="duplicate").inc()
+            else:
+                start_flow_task.delay(
+                    consent.org_id, str(contact_uuid), str(consent.flow_id)
+                )
         if consent.redirect_url:
             return redirect(consent.redirect_url)
 